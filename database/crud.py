@@ -4,8 +4,8 @@ CRUD operations for database models
 from typing import List, Optional, Tuple
 from datetime import datetime
 from venv import logger
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import and_, or_, case
 
 from database.models import (
     CourseReview, NotificationPreference, User, Course, Enrollment, Transaction, Cart,
@@ -166,7 +166,29 @@ def get_user_enrollments(session: Session, user_id: int) -> List[Enrollment]:
     return session.query(Enrollment).filter(Enrollment.user_id == user_id).all()
 
 def get_enrollment_by_id(session: Session, enrollment_id: int) -> Optional[Enrollment]:
-    return session.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
+    # Primary-key get: no SELECT when the enrollment is already in the session
+    return session.get(Enrollment, enrollment_id)
+
+def get_enrollments_by_ids(session: Session, enrollment_ids: List[int], with_user: bool = False) -> List[Enrollment]:
+    """Fetch several enrollments (with their course, and user if asked) in a single IN query"""
+    if not enrollment_ids:
+        return []
+    options = [joinedload(Enrollment.course)]
+    if with_user:
+        options.append(joinedload(Enrollment.user))
+    return session.query(Enrollment).options(
+        *options
+    ).filter(
+        Enrollment.enrollment_id.in_(enrollment_ids)
+    ).all()
+
+def get_user_receipt_phashes(session: Session, user_id: int) -> List[bytes]:
+    """Fetch stored perceptual hashes of all receipts a user has submitted"""
+    rows = session.query(Enrollment.receipt_phash).filter(
+        Enrollment.user_id == user_id,
+        Enrollment.receipt_phash.isnot(None)
+    ).all()
+    return [row.receipt_phash for row in rows]
 
 def update_enrollment_status(session: Session, enrollment_id: int, 
                             status: str, receipt_path: str = None, 
@@ -199,6 +221,37 @@ def update_enrollment_status(session: Session, enrollment_id: int,
     
     return enrollment
 
+def update_enrollments_status(session: Session, enrollment_ids: List[int],
+                              status: PaymentStatus, receipt_path: str = None,
+                              admin_notes: str = None, append_receipt_path: bool = False,
+                              mark_fully_paid: bool = False) -> int:
+    """
+    Bulk version of update_enrollment_status - one UPDATE for all enrollments.
+    append_receipt_path adds receipt_path to each row's comma-separated receipt list
+    instead of replacing it; mark_fully_paid sets amount_paid to payment_amount.
+    """
+    if not enrollment_ids:
+        return 0
+    
+    values = {Enrollment.payment_status: status}
+    if status == PaymentStatus.VERIFIED:
+        values[Enrollment.verification_date] = datetime.now()
+    if receipt_path and append_receipt_path:
+        values[Enrollment.receipt_image_path] = case(
+            (or_(Enrollment.receipt_image_path.is_(None), Enrollment.receipt_image_path == ''), receipt_path),
+            else_=Enrollment.receipt_image_path + ',' + receipt_path
+        )
+    elif receipt_path:
+        values[Enrollment.receipt_image_path] = receipt_path
+    if admin_notes:
+        values[Enrollment.admin_notes] = admin_notes
+    if mark_fully_paid:
+        values[Enrollment.amount_paid] = Enrollment.payment_amount
+    
+    return session.query(Enrollment).filter(
+        Enrollment.enrollment_id.in_(enrollment_ids)
+    ).update(values, synchronize_session=False)
+
 def get_user_pending_payments(session: Session, user_id: int) -> List[Enrollment]:
     return session.query(Enrollment).filter(
         and_(
@@ -223,16 +276,34 @@ def is_user_enrolled(session: Session, user_id: int, course_id: int) -> bool:
 # ==================== TRANSACTION OPERATIONS ====================
 
 def create_transaction(session: Session, enrollment_id: int, 
-                      receipt_image_path: str) -> Transaction:
+                      receipt_image_path: str,
+                      status: TransactionStatus = TransactionStatus.PENDING,
+                      **fields) -> Transaction:
+    """Create a transaction; extra Transaction columns can be set in the same INSERT"""
     transaction = Transaction(
         enrollment_id=enrollment_id,
         receipt_image_path=receipt_image_path,
-        status=TransactionStatus.PENDING
+        status=status,
+        **fields
     )
     session.add(transaction)
     session.flush()
     return transaction
 
+def create_transactions(session: Session, enrollment_ids: List[int],
+                        receipt_image_path: str,
+                        status: TransactionStatus = TransactionStatus.PENDING,
+                        **fields) -> int:
+    """Bulk version of create_transaction - one INSERT for all enrollments, no ORM objects returned"""
+    if not enrollment_ids:
+        return 0
+    
+    session.bulk_insert_mappings(Transaction, [
+        dict(enrollment_id=enrollment_id, receipt_image_path=receipt_image_path, status=status, **fields)
+        for enrollment_id in enrollment_ids
+    ])
+    return len(enrollment_ids)
+
 def update_transaction(
     session,
     transaction_id: int,
@@ -252,7 +323,7 @@ def update_transaction(
     admin_reviewed: int = None
 ) -> Transaction:
     """Update transaction with comprehensive fields"""
-    transaction = session.query(Transaction).filter(Transaction.transaction_id == transaction_id).first()
+    transaction = session.get(Transaction, transaction_id)
     
     if not transaction:
         raise ValueError(f"Transaction {transaction_id} not found")
@@ -295,10 +366,20 @@ def get_pending_transactions(session: Session) -> List[Transaction]:
         Transaction.status == TransactionStatus.PENDING
     ).order_by(Transaction.submitted_date.desc()).all()
 
-def get_transaction_by_id(session: Session, transaction_id: int) -> Optional[Transaction]:
+def get_latest_transaction(session: Session, enrollment_id: int) -> Optional[Transaction]:
+    """Most recent transaction of an enrollment (served by ix_transactions_enrollment_submitted)"""
     return session.query(Transaction).filter(
-        Transaction.transaction_id == transaction_id
-    ).first()
+        Transaction.enrollment_id == enrollment_id
+    ).order_by(Transaction.submitted_date.desc()).first()
+
+def get_transaction_by_id(session: Session, transaction_id: int, with_details: bool = False) -> Optional[Transaction]:
+    """Fetch a transaction, with its enrollment's course and user in the same query if asked"""
+    options = [
+        joinedload(Transaction.enrollment).joinedload(Enrollment.course),
+        joinedload(Transaction.enrollment).joinedload(Enrollment.user)
+    ] if with_details else None
+    # Primary-key get: served from the identity map when already loaded
+    return session.get(Transaction, transaction_id, options=options)
 
 # ==================== ADMIN/STATS OPERATIONS ====================
 
@@ -441,15 +522,14 @@ def get_user_transactions(session: Session, telegram_user_id: int = None, user_i
     if not user_id:
         return []
     
-    # Get all enrollments for this user, then their transactions
-    enrollments = session.query(Enrollment).filter(Enrollment.user_id == user_id).all()
-    enrollment_ids = [e.enrollment_id for e in enrollments]
-    
-    if not enrollment_ids:
-        return []
-    
-    transactions = session.query(Transaction).filter(
-        Transaction.enrollment_id.in_(enrollment_ids)
+    # One query: the user's transactions with their enrollment and course, which
+    # every receipt caption reads
+    transactions = session.query(Transaction).join(
+        Transaction.enrollment
+    ).options(
+        joinedload(Transaction.enrollment).joinedload(Enrollment.course)
+    ).filter(
+        Enrollment.user_id == user_id
     ).order_by(Transaction.submitted_date.desc()).all()
     
     return transactions
@@ -462,7 +542,11 @@ def get_transactions_by_date(session: Session, target_date: datetime) -> List[Tr
     start_of_day = target_date.replace(hour=0, minute=0, second=0, microsecond=0)
     end_of_day = start_of_day + timedelta(days=1)
     
-    transactions = session.query(Transaction).filter(
+    # Enrollment, user and course eager-loaded - the receipt captions read all three
+    transactions = session.query(Transaction).options(
+        joinedload(Transaction.enrollment).joinedload(Enrollment.user),
+        joinedload(Transaction.enrollment).joinedload(Enrollment.course)
+    ).filter(
         Transaction.submitted_date >= start_of_day,
         Transaction.submitted_date < end_of_day
     ).order_by(Transaction.submitted_date.desc()).all()
@@ -477,7 +561,11 @@ def get_transactions_by_date_range(session: Session, start_date: datetime, end_d
     start_of_day = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
     end_of_day = end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
     
-    transactions = session.query(Transaction).filter(
+    # Enrollment, user and course eager-loaded - the receipt captions read all three
+    transactions = session.query(Transaction).options(
+        joinedload(Transaction.enrollment).joinedload(Enrollment.user),
+        joinedload(Transaction.enrollment).joinedload(Enrollment.course)
+    ).filter(
         Transaction.submitted_date >= start_of_day,
         Transaction.submitted_date <= end_of_day
     ).order_by(Transaction.submitted_date.desc()).all()
@@ -671,7 +759,7 @@ def update_enrollment_partial_payment(session: Session, enrollment_id: int, amou
     """Update enrollment with partial payment"""
     from database.models import Enrollment, PaymentStatus
     
-    enrollment = session.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
+    enrollment = session.get(Enrollment, enrollment_id)
     
     if enrollment:
         # Add to existing amount_paid
@@ -819,7 +907,8 @@ def update_enrollment_receipt_metadata(
     enrollment_id: int,
     transaction_id: str = None,
     transfer_date: datetime = None,
-    sender_name: str = None
+    sender_name: str = None,
+    receipt_phash: bytes = None
 ) -> bool:
     """
     Update enrollment with receipt metadata for duplicate detection
@@ -830,6 +919,7 @@ def update_enrollment_receipt_metadata(
         transaction_id: Unique transaction identifier
         transfer_date: Date when transfer was made
         sender_name: Name of person who sent payment
+        receipt_phash: 64-bit perceptual hash of the receipt image
     
     Returns:
         True if updated successfully
@@ -850,6 +940,8 @@ def update_enrollment_receipt_metadata(
             enrollment.receipt_transfer_date = transfer_date
         if sender_name:
             enrollment.receipt_sender_name = sender_name
+        if receipt_phash:
+            enrollment.receipt_phash = receipt_phash
         
         # Always update submission date
         enrollment.receipt_submission_date = datetime.utcnow()
@@ -863,6 +955,47 @@ def update_enrollment_receipt_metadata(
         logger.error(f"Error updating receipt metadata for enrollment {enrollment_id}: {e}")
         return False
 
+def update_enrollments_receipt_metadata(
+    session: Session,
+    enrollment_ids: List[int],
+    transaction_id: str = None,
+    transfer_date: datetime = None,
+    sender_name: str = None,
+    receipt_phash: bytes = None
+) -> int:
+    """
+    Bulk version of update_enrollment_receipt_metadata - one UPDATE for all enrollments
+    
+    Returns:
+        Number of enrollment rows updated
+    """
+    if not enrollment_ids:
+        return 0
+    
+    try:
+        values = {Enrollment.receipt_submission_date: datetime.utcnow()}
+        if transaction_id:
+            values[Enrollment.receipt_transaction_id] = transaction_id
+        if transfer_date:
+            values[Enrollment.receipt_transfer_datetime] = transfer_date
+        if sender_name:
+            values[Enrollment.receipt_sender_name] = sender_name
+        if receipt_phash:
+            values[Enrollment.receipt_phash] = receipt_phash
+        
+        updated = session.query(Enrollment).filter(
+            Enrollment.enrollment_id.in_(enrollment_ids)
+        ).update(values, synchronize_session=False)
+        
+        session.commit()
+        logger.info(f"Updated receipt metadata for enrollments {enrollment_ids}: TxID={transaction_id}, TransferDate={transfer_date}, Sender={sender_name}")
+        return updated
+        
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error updating receipt metadata for enrollments {enrollment_ids}: {e}")
+        return 0
+
 def update_course_group_link(session: Session, course_id: int, group_link: str) -> bool:
     """
     Update course group link (auto-fetched from Telegram)
@@ -0,0 +1,40 @@
+"""
+Migration to add perceptual hash column for receipt duplicate detection
+"""
+
+from sqlalchemy import create_engine, text
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+def migrate():
+    """Add receipt_phash column to enrollments table"""
+    engine = create_engine(DATABASE_URL)
+    
+    print("🔧 Adding receipt perceptual hash field...")
+    
+    try:
+        with engine.connect() as connection:
+            trans = connection.begin()
+            try:
+                migration = "ALTER TABLE enrollments ADD COLUMN IF NOT EXISTS receipt_phash BYTEA"
+                print(f"Executing: {migration}")
+                connection.execute(text(migration))
+                
+                trans.commit()
+                print("✅ Migration completed successfully!")
+                
+            except Exception as e:
+                trans.rollback()
+                print(f"❌ Migration failed: {e}")
+                raise
+                
+    except Exception as e:
+        print(f"❌ Connection failed: {e}")
+        raise
+
+if __name__ == "__main__":
+    migrate()
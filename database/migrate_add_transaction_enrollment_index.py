@@ -0,0 +1,36 @@
+"""
+Migration to index transactions by enrollment and submission date
+(latest-transaction lookups for resubmissions and admin approve/reject)
+"""
+
+from sqlalchemy import create_engine, text
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+def migrate():
+    """Add composite (enrollment_id, submitted_date DESC) index to transactions table"""
+    engine = create_engine(DATABASE_URL)
+    
+    print("🔧 Adding transactions (enrollment_id, submitted_date) index...")
+    
+    try:
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction block
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            migration = (
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_transactions_enrollment_submitted "
+                "ON transactions (enrollment_id, submitted_date DESC)"
+            )
+            print(f"Executing: {migration}")
+            connection.execute(text(migration))
+            print("✅ Migration completed successfully!")
+                
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        raise
+
+if __name__ == "__main__":
+    migrate()
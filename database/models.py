@@ -2,7 +2,7 @@
 SQLAlchemy database models for Course Registration Bot
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, BigInteger, String, Float, Boolean, DateTime, ForeignKey, Text, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, Float, Boolean, DateTime, ForeignKey, Text, Enum, LargeBinary, Index
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
 import enum
@@ -101,6 +101,7 @@ class Enrollment(Base):
     receipt_transfer_datetime = Column(DateTime, nullable=True)
     receipt_sender_name = Column(String(255), nullable=True)
     receipt_submission_date = Column(DateTime, default=datetime.utcnow)
+    receipt_phash = Column(LargeBinary(8), nullable=True)  # 64-bit perceptual hash of latest receipt
     
     # Relationships
     user = relationship("User", back_populates="enrollments")
@@ -143,6 +144,11 @@ class Transaction(Base):
     # Relationships
     enrollment = relationship("Enrollment", back_populates="transactions")
     
+    # Latest-transaction-per-enrollment lookups (resubmissions, admin approve/reject)
+    __table_args__ = (
+        Index("ix_transactions_enrollment_submitted", enrollment_id, submitted_date.desc()),
+    )
+    
     def __repr__(self):
         return f"<Transaction {self.transaction_id} - Status: {self.status.value}>"
 
@@ -4,7 +4,7 @@ Admin data export and analytics dashboard
 from telegram import Update
 from telegram.ext import ContextTypes
 from database import crud, get_db
-from database.models import PaymentStatus, TransactionStatus, CourseReview
+from database.models import PaymentStatus, TransactionStatus, CourseReview, Transaction, Enrollment, User, Course
 from utils.helpers import is_admin_user
 from datetime import datetime
 import csv
@@ -95,7 +95,26 @@ async def export_transactions_command(update: Update, context: ContextTypes.DEFA
     
     try:
         with get_db() as session:
-            transactions = session.query(crud.Transaction).all()
+            # Only the exported columns, joined in one query (no ORM objects, no
+            # per-row lazy loads of enrollment, user and course)
+            transactions = session.query(
+                Transaction.transaction_id,
+                Transaction.enrollment_id,
+                User.first_name,
+                User.last_name,
+                Course.course_name,
+                Transaction.extracted_amount,
+                Transaction.status,
+                Transaction.submitted_date,
+                Transaction.admin_review_date,
+                Transaction.fraud_score
+            ).join(
+                Enrollment, Enrollment.enrollment_id == Transaction.enrollment_id
+            ).join(
+                User, User.user_id == Enrollment.user_id
+            ).join(
+                Course, Course.course_id == Enrollment.course_id
+            ).all()
             
             if not transactions:
                 await update.message.reply_text("📭 No transaction data to export.")
@@ -113,12 +132,11 @@ async def export_transactions_command(update: Update, context: ContextTypes.DEFA
             
             # Data rows
             for transaction in transactions:
-                enrollment = transaction.enrollment
                 writer.writerow([
                     transaction.transaction_id,
                     transaction.enrollment_id,
-                    f"{enrollment.user.first_name} {enrollment.user.last_name or ''}".strip(),
-                    enrollment.course.course_name,
+                    f"{transaction.first_name} {transaction.last_name or ''}".strip(),
+                    transaction.course_name,
                     transaction.extracted_amount or 0,
                     transaction.status.value,
                     transaction.submitted_date.strftime('%Y-%m-%d %H:%M'),
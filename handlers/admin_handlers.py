@@ -7,10 +7,11 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.error import BadRequest
 from utils.keyboards import admin_menu_keyboard, admin_transaction_keyboard, back_to_main_keyboard
-from utils.messages import admin_stats_message, admin_transaction_message, error_message
+from utils.messages import admin_stats_message, admin_transaction_message, error_message, daily_summary_report_message
 from utils.helpers import is_admin_user, send_admin_notification
 from database import crud, get_db
-from database.models import PaymentStatus, TransactionStatus
+from database.models import PaymentStatus, TransactionStatus, Course
+from handlers.group_registration import send_course_invite_link
 import config
 from utils.messages import admin_help_message
 
@@ -67,50 +68,54 @@ async def admin_pending_callback(update: Update, context: ContextTypes.DEFAULT_T
     with get_db() as session:
         transactions = crud.get_pending_transactions(session)
         
-        if not transactions:
-            # FIX: Check if message content is different before editing
-            new_text = "🎉 No pending transactions."
-            new_markup = admin_menu_keyboard()
-            
-            # Only edit if content is actually different
-            try:
-                if query.message.text != new_text:
-                    await query.edit_message_text(new_text, reply_markup=new_markup)
-                else:
-                    # Message is identical, just answer the callback without editing
-                    await query.answer("No pending transactions found.", show_alert=False)
-            except BadRequest as e:
-                if "Message is not modified" in str(e):
-                    logger.warning("Message not modified, skipping edit in admin_pending_callback (no pending transactions).")
-                    pass
-                else:
-                    raise
-            except Exception as e:
-                # Fallback: just answer the callback
-                logger.error(f"Error editing message in admin_pending_callback (no pending transactions): {e}")
-                await query.answer("No pending transactions.", show_alert=False)
-            return
+        # Display first transaction to review (can add pagination); render it
+        # while the session is open so the edit below doesn't hold the connection
+        if transactions:
+            transaction = transactions[0]
+            review_text = admin_transaction_message(transaction)
+            review_markup = admin_transaction_keyboard(transaction.transaction_id)
+    
+    if not transactions:
+        # FIX: Check if message content is different before editing
+        new_text = "🎉 No pending transactions."
+        new_markup = admin_menu_keyboard()
         
-        # Display first transaction to review (can add pagination)
-        transaction = transactions[0]
-
+        # Only edit if content is actually different
         try:
-            await query.edit_message_text(
-                admin_transaction_message(transaction),
-                reply_markup=admin_transaction_keyboard(transaction.transaction_id),
-                parse_mode='Markdown'
-            )
+            if query.message.text != new_text:
+                await query.edit_message_text(new_text, reply_markup=new_markup)
+            else:
+                # Message is identical, just answer the callback without editing
+                await query.answer("No pending transactions found.", show_alert=False)
         except BadRequest as e:
             if "Message is not modified" in str(e):
-                logger.warning("Message not modified, skipping edit in admin_pending_callback (display transaction).")
+                logger.warning("Message not modified, skipping edit in admin_pending_callback (no pending transactions).")
                 pass
             else:
                 raise
         except Exception as e:
-            if "message is not modified" in str(e).lower():
-                await query.answer("Already viewing this transaction.", show_alert=False)
-            else:
-                raise
+            # Fallback: just answer the callback
+            logger.error(f"Error editing message in admin_pending_callback (no pending transactions): {e}")
+            await query.answer("No pending transactions.", show_alert=False)
+        return
+    
+    try:
+        await query.edit_message_text(
+            review_text,
+            reply_markup=review_markup,
+            parse_mode='Markdown'
+        )
+    except BadRequest as e:
+        if "Message is not modified" in str(e):
+            logger.warning("Message not modified, skipping edit in admin_pending_callback (display transaction).")
+            pass
+        else:
+            raise
+    except Exception as e:
+        if "message is not modified" in str(e).lower():
+            await query.answer("Already viewing this transaction.", show_alert=False)
+        else:
+            raise
 
 
 
@@ -188,33 +193,38 @@ async def admin_approve_callback(update: Update, context: ContextTypes.DEFAULT_T
     prefix = config.CallbackPrefix.ADMIN_APPROVE
     transaction_id = int(query.data[len(prefix):])
 
-    user_chat_id, course_names, group_links = None, [], []
+    user_chat_id, course_id, course_names, group_links = None, None, [], []
 
+    # Only DB work happens inside the session; Telegram calls run after it closes
     with get_db() as session:
-        transaction = crud.update_transaction(session, transaction_id, status="VERIFIED", admin_reviewed=admin_user.id)
-        if not transaction:
-            await query.edit_message_text("❌ Transaction not found.")
-            return
+        # One query for the transaction, its enrollment, user and course
+        transaction = crud.get_transaction_by_id(session, transaction_id, with_details=True)
+        if transaction:
+            crud.update_transaction(session, transaction_id, status="VERIFIED", admin_reviewed=admin_user.id)
 
-        enrollment = transaction.enrollment
-        crud.update_enrollment_status(session, enrollment.enrollment_id, "verified", receipt_path=transaction.receipt_image_path)
+            enrollment = transaction.enrollment
+            crud.update_enrollment_status(session, enrollment.enrollment_id, "verified", receipt_path=transaction.receipt_image_path)
         
-        user = enrollment.user
-        user_chat_id = user.telegram_chat_id
+            user = enrollment.user
+            user_chat_id = user.telegram_chat_id
         
-        # Explicitly access course to ensure it's loaded before session closes
-        course = enrollment.course
-        if course:
-            # Force load the course_name attribute
-            course_name = str(course.course_name) if course.course_name else "Unknown Course"
-            telegram_group_link = str(course.telegram_group_link) if course.telegram_group_link else None
+            # Explicitly access course to ensure it's loaded before session closes
+            course = enrollment.course
+            if course:
+                # Force load the course_name attribute
+                course_name = str(course.course_name) if course.course_name else "Unknown Course"
+                telegram_group_link = str(course.telegram_group_link) if course.telegram_group_link else None
             
-            course_names.append(course_name)
-            if telegram_group_link:
-                group_links.append(telegram_group_link)
+                course_names.append(course_name)
+                if telegram_group_link:
+                    group_links.append(telegram_group_link)
         
-        session.commit()
+            course_id = enrollment.course_id
+            session.commit()
 
+    if not transaction:
+        await query.edit_message_text("❌ Transaction not found.")
+        return
 
     if user_chat_id and course_names:
         await notify_user_payment_decision(
@@ -224,8 +234,7 @@ async def admin_approve_callback(update: Update, context: ContextTypes.DEFAULT_T
             course_names=course_names,
             group_links=group_links
         )
-        from handlers.group_registration import send_course_invite_link
-        await send_course_invite_link(update, context, user_chat_id, enrollment.course_id)
+        await send_course_invite_link(update, context, user_chat_id, course_id)
         
     final_text = f"✅ تم قبول المعاملة {transaction_id} بواسطة {admin_user.first_name}.\n\n✉️ تم إشعار المستخدم بنجاح."
 
@@ -316,43 +325,47 @@ async def rejection_reason_message_handler(update: Update, context: ContextTypes
     course_names = []
     
     with get_db() as session:
-        # Update transaction status with rejection reason
-        transaction = crud.update_transaction(
-            session, 
-            transaction_id, 
-            status="rejected", 
-            failure_reason=reason, 
-            admin_reviewed=user_id
-        )
+        # One query for the transaction, its enrollment, user and course
+        transaction = crud.get_transaction_by_id(session, transaction_id, with_details=True)
         
-        if not transaction:
-            await update.message.reply_text(
-                "❌ Transaction not found.",
-                reply_markup=admin_menu_keyboard()
+        if transaction:
+            # Update transaction status with rejection reason
+            crud.update_transaction(
+                session, 
+                transaction_id, 
+                status="rejected", 
+                failure_reason=reason, 
+                admin_reviewed=user_id
             )
-            context.user_data.pop("pending_rejection_transaction_id", None)
-            context.user_data.pop("awaiting_rejection_reason", None)
-            return
         
-        # Get enrollment and update status
-        enrollment = transaction.enrollment
-        crud.update_enrollment_status(
-            session, 
-            enrollment.enrollment_id, 
-            "failed", 
-            admin_notes=reason
-        )
+            # Get enrollment and update status
+            enrollment = transaction.enrollment
+            crud.update_enrollment_status(
+                session, 
+                enrollment.enrollment_id, 
+                "failed", 
+                admin_notes=reason
+            )
         
-        # Get user info for notification - force load relationships
-        user = enrollment.user
-        user_chat_id = user.telegram_chat_id
+            # Get user info for notification - force load relationships
+            user = enrollment.user
+            user_chat_id = user.telegram_chat_id
         
-        # Get course info - force load while session is active
-        course = enrollment.course
-        course_names.append(course.course_name)
+            # Get course info - force load while session is active
+            course = enrollment.course
+            course_names.append(course.course_name)
         
-        # Commit changes
-        session.commit()
+            # Commit changes
+            session.commit()
+
+    if not transaction:
+        await update.message.reply_text(
+            "❌ Transaction not found.",
+            reply_markup=admin_menu_keyboard()
+        )
+        context.user_data.pop("pending_rejection_transaction_id", None)
+        context.user_data.pop("awaiting_rejection_reason", None)
+        return
     
     # Now session is closed, notify user
     if user_chat_id:
@@ -425,27 +438,26 @@ async def admin_approve_failed_callback(update: Update, context: ContextTypes.DE
     enrollment_ids = [int(eid.strip()) for eid in enrollment_ids_str.split(",")]
     telegram_user_id = int(telegram_user_id_str)
     
-    user_chat_id, course_names, group_links = None, [], []
+    user_chat_id, course_names, group_links, invite_course_ids = None, [], [], []
     
     with get_db() as session:
+        # One IN query (course and user eager-loaded) and one UPDATE for all enrollments
+        enrollments_by_id = {e.enrollment_id: e for e in crud.get_enrollments_by_ids(session, enrollment_ids, with_user=True)}
+        crud.update_enrollments_status(
+            session,
+            list(enrollments_by_id),
+            PaymentStatus.VERIFIED,
+            admin_notes=f"Manually approved by admin {admin_user.first_name}"
+        )
+        
         for enrollment_id in enrollment_ids:
-            enrollment = crud.get_enrollment_by_id(session, enrollment_id)
+            enrollment = enrollments_by_id.get(enrollment_id)
             if not enrollment:
                 continue
-            
-            # Update enrollment to verified
-            crud.update_enrollment_status(
-                session, 
-                enrollment_id, 
-                PaymentStatus.VERIFIED,
-                admin_notes=f"Manually approved by admin {admin_user.first_name}"
-            )
+            invite_course_ids.append(enrollment.course_id)
             
             # Update transaction if exists
-            from database.models import Transaction
-            transaction = session.query(Transaction).filter(
-                Transaction.enrollment_id == enrollment_id
-            ).order_by(Transaction.submitted_date.desc()).first()
+            transaction = crud.get_latest_transaction(session, enrollment_id)
             
             if transaction:
                 crud.update_transaction(
@@ -472,7 +484,7 @@ async def admin_approve_failed_callback(update: Update, context: ContextTypes.DE
         
         # Clear user's cart if this was initial payment
         if enrollment_ids:
-            first_enrollment = crud.get_enrollment_by_id(session, enrollment_ids[0])
+            first_enrollment = enrollments_by_id.get(enrollment_ids[0])
             if first_enrollment:
                 crud.clear_user_cart(session, first_enrollment.user_id)
         
@@ -487,12 +499,8 @@ async def admin_approve_failed_callback(update: Update, context: ContextTypes.DE
             course_names=course_names,
             group_links=group_links
         )
-        from handlers.group_registration import send_course_invite_link
-        with get_db() as session:
-            for enrollment_id in enrollment_ids:
-                enrollment = crud.get_enrollment_by_id(session, enrollment_id)
-                if enrollment:
-                    await send_course_invite_link(update, context, user_chat_id, enrollment.course_id)
+        for course_id in invite_course_ids:
+            await send_course_invite_link(update, context, user_chat_id, course_id)
     
     # Update admin message
     final_text = f"✅ Enrollments {enrollment_ids_str} approved by {admin_user.first_name}.\n\n✉️ User {telegram_user_id} has been notified."
@@ -569,24 +577,22 @@ async def failed_rejection_reason_handler(update: Update, context: ContextTypes.
     course_names = []
     
     with get_db() as session:
+        # One IN query (course and user eager-loaded) and one UPDATE for all enrollments
+        enrollments_by_id = {e.enrollment_id: e for e in crud.get_enrollments_by_ids(session, enrollment_ids, with_user=True)}
+        crud.update_enrollments_status(
+            session,
+            list(enrollments_by_id),
+            PaymentStatus.FAILED,
+            admin_notes=f"Rejected: {reason}"
+        )
+        
         for enrollment_id in enrollment_ids:
-            enrollment = crud.get_enrollment_by_id(session, enrollment_id)
+            enrollment = enrollments_by_id.get(enrollment_id)
             if not enrollment:
                 continue
             
-            # Update enrollment to failed
-            crud.update_enrollment_status(
-                session,
-                enrollment_id,
-                PaymentStatus.FAILED,
-                admin_notes=f"Rejected: {reason}"
-            )
-            
             # Update transaction if exists
-            from database.models import Transaction
-            transaction = session.query(Transaction).filter(
-                Transaction.enrollment_id == enrollment_id
-            ).order_by(Transaction.submitted_date.desc()).first()
+            transaction = crud.get_latest_transaction(session, enrollment_id)
             
             if transaction:
                 crud.update_transaction(
@@ -670,20 +676,19 @@ async def send_daily_summary_report(context: ContextTypes.DEFAULT_TYPE):
             enrollments = crud.get_daily_verified_enrollments(session, today_start, today_end)
             
             # Format the report
-            from utils.messages import daily_summary_report_message
             report_message = daily_summary_report_message(
                 enrollments, 
                 today_start_sudan.strftime('%Y-%m-%d')
             )
-            
-            # Send to admin chat
-            await context.bot.send_message(
-                chat_id=config.ADMIN_CHAT_ID,
-                text=report_message,
-                parse_mode='Markdown'
-            )
-            
-            logger.info(f"Daily summary report sent successfully. {len(enrollments)} enrollments reported.")
+        
+        # Send to admin chat once the session is closed
+        await context.bot.send_message(
+            chat_id=config.ADMIN_CHAT_ID,
+            text=report_message,
+            parse_mode='Markdown'
+        )
+        
+        logger.info(f"Daily summary report sent successfully. {len(enrollments)} enrollments reported.")
     
     except Exception as e:
         logger.error(f"Error sending daily summary report: {e}")
@@ -723,16 +728,15 @@ async def manual_daily_report_command(update: Update, context: ContextTypes.DEFA
             enrollments = crud.get_daily_verified_enrollments(session, today_start, today_end)
             
             # Format the report
-            from utils.messages import daily_summary_report_message
             report_message = daily_summary_report_message(
                 enrollments, 
                 today_start_sudan.strftime('%Y-%m-%d')
             )
-            
-            # Send to the chat
-            await update.message.reply_text(report_message, parse_mode='Markdown')
-            
-            logger.info(f"Manual daily summary report sent. {len(enrollments)} enrollments reported.")
+        
+        # Send to the chat once the session is closed
+        await update.message.reply_text(report_message, parse_mode='Markdown')
+        
+        logger.info(f"Manual daily summary report sent. {len(enrollments)} enrollments reported.")
     
     except Exception as e:
         logger.error(f"Error generating manual daily report: {e}")
@@ -761,25 +765,27 @@ async def set_certificate_price_command(update: Update, context: ContextTypes.DE
         course_id = int(args[0])
         certificate_price = float(args[1])
         
+        course_name = None
         with get_db() as session:
-            from database.models import Course
             course = session.query(Course).filter(Course.course_id == course_id).first()
             
-            if not course:
-                await update.message.reply_text(f"❌ Course {course_id} not found.")
-                return
-            
-            course.certificate_price = certificate_price
-            course.certificate_available = certificate_price > 0
-            session.commit()
-            
-            status = "[translate:متاحة]" if certificate_price > 0 else "[translate:غير متاحة]"
-            await update.message.reply_text(
-                f"✅ Certificate price updated!\n\n"
-                f"📚 Course: {course.course_name}\n"
-                f"📜 Certificate Price: {certificate_price} SDG\n"
-                f"Status: {status}"
-            )
+            if course:
+                course.certificate_price = certificate_price
+                course.certificate_available = certificate_price > 0
+                course_name = course.course_name
+                session.commit()
+        
+        if course_name is None:
+            await update.message.reply_text(f"❌ Course {course_id} not found.")
+            return
+        
+        status = "[translate:متاحة]" if certificate_price > 0 else "[translate:غير متاحة]"
+        await update.message.reply_text(
+            f"✅ Certificate price updated!\n\n"
+            f"📚 Course: {course_name}\n"
+            f"📜 Certificate Price: {certificate_price} SDG\n"
+            f"Status: {status}"
+        )
     
     except ValueError:
         await update.message.reply_text("❌ Invalid numbers. Use: /setcert <course_id> <price>")
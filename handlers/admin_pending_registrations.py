@@ -3,6 +3,7 @@ Admin handler for viewing pending registrations (enrollments waiting for payment
 """
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
+from sqlalchemy.orm import joinedload
 from database import crud, get_db
 from database.models import PaymentStatus, Enrollment, User, Course
 from utils.helpers import is_admin_user
@@ -29,8 +30,12 @@ async def admin_pending_registrations_command(update: Update, context: ContextTy
     await update.message.reply_text("🔍 Fetching pending registrations...")
     
     with get_db() as session:
-        # Query all PENDING enrollments with user and course info
-        pending_enrollments = session.query(Enrollment).filter(
+        # Query all PENDING enrollments with user and course info (eager-loaded, so
+        # building the report doesn't lazy-load each row's user and course)
+        pending_enrollments = session.query(Enrollment).options(
+            joinedload(Enrollment.user),
+            joinedload(Enrollment.course)
+        ).filter(
             Enrollment.payment_status == PaymentStatus.PENDING
         ).order_by(Enrollment.enrollment_date.desc()).all()
         
@@ -41,10 +46,12 @@ async def admin_pending_registrations_command(update: Update, context: ContextTy
             )
             return
         
-        # Build the message
-        message = f"📋 **Pending Registrations Report**\n"
-        message += f"_Total: {len(pending_enrollments)} enrollment(s) waiting for payment_\n\n"
-        message += "━━━━━━━━━━━━━━━━━━━━\n\n"
+        # Build the message from a list of parts joined once at the end
+        parts = [
+            f"📋 **Pending Registrations Report**\n"
+            f"_Total: {len(pending_enrollments)} enrollment(s) waiting for payment_\n\n"
+            "━━━━━━━━━━━━━━━━━━━━\n\n"
+        ]
         
         # Group by user for better readability
         user_enrollments = {}
@@ -66,9 +73,11 @@ async def admin_pending_registrations_command(update: Update, context: ContextTy
             if not user_display:
                 user_display = f"User {user.telegram_user_id}"
             
-            message += f"**{idx}. {user_display}**\n"
-            message += f"   📱 Telegram ID: `{user.telegram_user_id}`\n"
-            message += f"   🆔 User DB ID: `{user.user_id}`\n\n"
+            parts.append(
+                f"**{idx}. {user_display}**\n"
+                f"   📱 Telegram ID: `{user.telegram_user_id}`\n"
+                f"   🆔 User DB ID: `{user.user_id}`\n\n"
+            )
             
             # List all pending courses for this user
             total_amount = 0
@@ -80,16 +89,20 @@ async def admin_pending_registrations_command(update: Update, context: ContextTy
                 remaining = amount - amount_paid
                 
                 # Enrollment details
-                message += f"   📚 **{course.course_name}**\n"
-                message += f"      • Enrollment ID: `{enrollment.enrollment_id}`\n"
-                message += f"      • Price: ${amount:.2f}\n"
-                message += f"      • Paid: ${amount_paid:.2f}\n"
-                message += f"      • Remaining: ${remaining:.2f}\n"
-                message += f"      • Date: {enrollment.enrollment_date.strftime('%Y-%m-%d %H:%M')}\n"
-                message += f"      • Receipt: {'✅ Yes' if enrollment.receipt_image_path else '❌ No'}\n\n"
+                parts.append(
+                    f"   📚 **{course.course_name}**\n"
+                    f"      • Enrollment ID: `{enrollment.enrollment_id}`\n"
+                    f"      • Price: ${amount:.2f}\n"
+                    f"      • Paid: ${amount_paid:.2f}\n"
+                    f"      • Remaining: ${remaining:.2f}\n"
+                    f"      • Date: {enrollment.enrollment_date.strftime('%Y-%m-%d %H:%M')}\n"
+                    f"      • Receipt: {'✅ Yes' if enrollment.receipt_image_path else '❌ No'}\n\n"
+                )
             
-            message += f"   💰 **Total for this user: ${total_amount:.2f}**\n"
-            message += "   ━━━━━━━━━━━━━━━\n\n"
+            parts.append(
+                f"   💰 **Total for this user: ${total_amount:.2f}**\n"
+                "   ━━━━━━━━━━━━━━━\n\n"
+            )
         
         # Summary statistics
         total_pending_amount = sum(e.payment_amount or 0 for e in pending_enrollments)
@@ -97,14 +110,17 @@ async def admin_pending_registrations_command(update: Update, context: ContextTy
         with_receipts = sum(1 for e in pending_enrollments if e.receipt_image_path)
         without_receipts = len(pending_enrollments) - with_receipts
         
-        message += "\n📊 **Summary:**\n"
-        message += f"• Total pending enrollments: **{len(pending_enrollments)}**\n"
-        message += f"• Total users waiting: **{len(user_enrollments)}**\n"
-        message += f"• With receipts uploaded: **{with_receipts}**\n"
-        message += f"• Without receipts: **{without_receipts}**\n"
-        message += f"• Total pending amount: **${total_pending_amount:.2f}**\n"
-        message += f"• Total already paid: **${total_paid:.2f}**\n"
-        message += f"• Total remaining: **${total_pending_amount - total_paid:.2f}**\n"
+        parts.append(
+            "\n📊 **Summary:**\n"
+            f"• Total pending enrollments: **{len(pending_enrollments)}**\n"
+            f"• Total users waiting: **{len(user_enrollments)}**\n"
+            f"• With receipts uploaded: **{with_receipts}**\n"
+            f"• Without receipts: **{without_receipts}**\n"
+            f"• Total pending amount: **${total_pending_amount:.2f}**\n"
+            f"• Total already paid: **${total_paid:.2f}**\n"
+            f"• Total remaining: **${total_pending_amount - total_paid:.2f}**\n"
+        )
+        message = "".join(parts)
         
         # Create keyboard with action buttons
         keyboard = [
@@ -117,24 +133,24 @@ async def admin_pending_registrations_command(update: Update, context: ContextTy
         # Split message if too long (Telegram limit is 4096 characters)
         if len(message) > 4000:
             # Send in chunks
-            parts = []
+            chunks = []
             current_part = ""
             for line in message.split("\n"):
                 if len(current_part) + len(line) + 1 > 4000:
-                    parts.append(current_part)
+                    chunks.append(current_part)
                     current_part = line + "\n"
                 else:
                     current_part += line + "\n"
             if current_part:
-                parts.append(current_part)
+                chunks.append(current_part)
             
-            # Send all parts except last without markup
-            for part in parts[:-1]:
+            # Send all chunks except last without markup
+            for part in chunks[:-1]:
                 await update.message.reply_text(part, parse_mode='Markdown')
             
-            # Send last part with keyboard
+            # Send last chunk with keyboard
             await update.message.reply_text(
-                parts[-1],
+                chunks[-1],
                 parse_mode='Markdown',
                 reply_markup=reply_markup
             )
@@ -6,11 +6,12 @@ from telegram.ext import ContextTypes, ConversationHandler
 from database import crud, get_db
 from database.models import TransactionStatus
 from utils.helpers import is_admin_user
-from utils.s3_storage import download_receipt_from_s3
+from utils.s3_storage import download_receipt_bytes_from_s3
 from datetime import datetime
+import asyncio
 import logging
 import os
-import tempfile
+from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +19,13 @@ logger = logging.getLogger(__name__)
 (RECEIPT_USER_ID, RECEIPT_DATE_INPUT, RECEIPT_DATE_RANGE_START,
  RECEIPT_DATE_RANGE_END, RECEIPT_COURSE_SELECT) = range(5)
 
+# Status icon shown in each receipt caption
+TX_STATUS_EMOJI = {
+    TransactionStatus.PENDING: "⏳",
+    TransactionStatus.APPROVED: "✅",
+    TransactionStatus.REJECTED: "❌"
+}
+
 
 async def send_receipt_photo(update: Update, receipt_path: str, caption: str):
     """
@@ -26,32 +34,21 @@ async def send_receipt_photo(update: Update, receipt_path: str, caption: str):
     try:
         # Check if it's an S3 URL
         if receipt_path.startswith('https://') or receipt_path.startswith('http://'):
-            # Download from S3 to temp file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                temp_path = temp_file.name
-            
+            # Download from S3 straight into memory (off the event loop)
             try:
-                download_receipt_from_s3(receipt_path, temp_path)
-                
-                # Send the photo
-                with open(temp_path, 'rb') as photo:
-                    await update.message.reply_photo(photo=photo, caption=caption)
-                
-                # Clean up temp file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                    
+                photo = await asyncio.to_thread(download_receipt_bytes_from_s3, receipt_path)
             except Exception as e:
                 logger.error(f"Failed to download from S3: {e}")
                 await update.message.reply_text(f"{caption}\n\n❌ Failed to load image from S3")
-                # Clean up temp file if it exists
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+                return
+            
+            # Send the photo
+            await update.message.reply_photo(photo=photo, caption=caption)
         else:
             # Local file path
             if os.path.exists(receipt_path):
-                with open(receipt_path, 'rb') as photo:
-                    await update.message.reply_photo(photo=photo, caption=caption)
+                photo = await asyncio.to_thread(Path(receipt_path).read_bytes)
+                await update.message.reply_photo(photo=photo, caption=caption)
             else:
                 await update.message.reply_text(f"{caption}\n\n❌ Receipt image not found")
                 
@@ -141,17 +138,11 @@ async def receipt_user_id_input(update: Update, context: ContextTypes.DEFAULT_TY
             enrollment = transaction.enrollment
             course = enrollment.course
             
-            status_emoji = {
-                TransactionStatus.PENDING: "⏳",
-                TransactionStatus.APPROVED: "✅",
-                TransactionStatus.REJECTED: "❌"
-            }
-            
             caption = (
                 f"📸 Receipt {idx}/{len(transactions)}\n\n"
                 f"🎓 Course: {course.course_name}\n"
                 f"💰 Amount: {enrollment.payment_amount:.0f} SDG\n"
-                f"{status_emoji.get(transaction.status, '❓')} Status: {transaction.status.value}\n"
+                f"{TX_STATUS_EMOJI.get(transaction.status, '❓')} Status: {transaction.status.value}\n"
                 f"📅 Submitted: {transaction.submitted_date.strftime('%Y-%m-%d %H:%M')}\n"
                 f"🆔 Transaction ID: {transaction.transaction_id}"
             )
@@ -201,19 +192,13 @@ async def receipts_today_command(update: Update, context: ContextTypes.DEFAULT_T
             user_obj = enrollment.user
             course = enrollment.course
             
-            status_emoji = {
-                TransactionStatus.PENDING: "⏳",
-                TransactionStatus.APPROVED: "✅",
-                TransactionStatus.REJECTED: "❌"
-            }
-            
             caption = (
                 f"📸 Receipt {idx}/{len(transactions)}\n\n"
                 f"👤 User: {user_obj.first_name} {user_obj.last_name or ''}\n"
                 f"🆔 User ID: {user_obj.telegram_user_id}\n"
                 f"🎓 Course: {course.course_name}\n"
                 f"💰 Amount: {enrollment.payment_amount:.0f} SDG\n"
-                f"{status_emoji.get(transaction.status, '❓')} Status: {transaction.status.value}\n"
+                f"{TX_STATUS_EMOJI.get(transaction.status, '❓')} Status: {transaction.status.value}\n"
                 f"📅 Submitted: {transaction.submitted_date.strftime('%Y-%m-%d %H:%M')}"
             )
             
@@ -280,19 +265,13 @@ async def receipt_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             user_obj = enrollment.user
             course = enrollment.course
             
-            status_emoji = {
-                TransactionStatus.PENDING: "⏳",
-                TransactionStatus.APPROVED: "✅",
-                TransactionStatus.REJECTED: "❌"
-            }
-            
             caption = (
                 f"📸 Receipt {idx}/{len(transactions)}\n\n"
                 f"👤 User: {user_obj.first_name} {user_obj.last_name or ''}\n"
                 f"🆔 User ID: {user_obj.telegram_user_id}\n"
                 f"🎓 Course: {course.course_name}\n"
                 f"💰 Amount: {enrollment.payment_amount:.0f} SDG\n"
-                f"{status_emoji.get(transaction.status, '❓')} Status: {transaction.status.value}\n"
+                f"{TX_STATUS_EMOJI.get(transaction.status, '❓')} Status: {transaction.status.value}\n"
                 f"📅 Submitted: {transaction.submitted_date.strftime('%Y-%m-%d %H:%M')}"
             )
             
@@ -34,7 +34,6 @@ async def show_instructor_reviews_callback(update: Update, context: ContextTypes
         message = instructor_reviews_message(course, reviews, avg_rating)
         
         # Add "Rate Instructor" button
-        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
         keyboard = [
             [InlineKeyboardButton("✍️ قيّم المدرب | Rate Instructor", callback_data=f"start_rate_{course_id}")],
             [InlineKeyboardButton("🔙 عودة | Back", callback_data=f"course_desc_{course_id}")]
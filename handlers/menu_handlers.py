@@ -8,6 +8,8 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.error import BadRequest
 from datetime import datetime, timedelta
+import hashlib
+import time
 import config
 from utils.keyboards import (
     main_menu_reply_keyboard,
@@ -27,7 +29,9 @@ from utils.messages import (
 from utils.helpers import (
     get_user_info,
     get_chat_id,
-    log_user_action
+    log_user_action,
+    remaining_balance,
+    resolve_internal_user_id
 )
 from database import crud, get_db
 from sqlalchemy.orm import joinedload
@@ -36,6 +40,10 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# How long the my-courses screen's enrollment snapshot serves selection toggles
+# before the next tap reloads it from the database
+MY_COURSES_SNAPSHOT_TTL = 30
+
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command and show main menu with ReplyKeyboard"""
@@ -80,23 +88,38 @@ async def preferences_menu_handler(update: Update, context: ContextTypes.DEFAULT
     """Handle '4- الإشعارات 🔔' button"""
     # Redirect to the preferences command
     await student_preferences.preferences_command(update, context)
+
+
+def _render_my_courses(all_enrollments, selected_ids):
+    """
+    Text and keyboard of the my-courses view. The pending count and the remaining
+    balance of the selected enrollments are collected in a single pass.
+    """
+    selected = set(selected_ids)
+    pending_count = 0
+    total_selected_amount = 0  # ✅ REMAINING BALANCE, NOT THE FULL AMOUNT
+    for e in all_enrollments:
+        if e.payment_status in (PaymentStatus.PENDING, PaymentStatus.FAILED):
+            pending_count += 1
+            if e.enrollment_id in selected and e.payment_amount:
+                total_selected_amount += e.payment_amount - (e.amount_paid or 0)
+    
+    new_text = my_courses_message(
+        all_enrollments,
+        pending_count=pending_count,
+        selected_count=len(selected_ids),
+        total_selected=total_selected_amount
+    )
+    return new_text, my_courses_selection_keyboard(all_enrollments, selected_ids)
+
+
 async def handle_my_courses_from_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show my_courses view from a text message (ReplyKeyboard)"""
     telegram_user_id = update.effective_user.id
     context.user_data.setdefault('selected_pending_enrollments', [])
     
+    internal_user_id = resolve_internal_user_id(update.effective_user)
     with get_db() as session:
-        # GET INTERNAL USER ID
-        db_user = crud.get_or_create_user(
-            session,
-            telegram_user_id=telegram_user_id,
-            username=update.effective_user.username,
-            first_name=update.effective_user.first_name,
-            last_name=update.effective_user.last_name
-        )
-        session.flush()
-        internal_user_id = db_user.user_id
-        
         # Query with internal_user_id
         all_enrollments_query = session.query(crud.Enrollment).options(
             joinedload(crud.Enrollment.course)
@@ -127,27 +150,9 @@ async def handle_my_courses_from_message(update: Update, context: ContextTypes.D
 
         all_enrollments = filtered_enrollments
         
-        pending_enrollments = [e for e in all_enrollments if e.payment_status.value in ['PENDING', 'FAILED']]
-        selected_ids = context.user_data['selected_pending_enrollments']
-        
-        # ✅ CALCULATE REMAINING BALANCE INSTEAD OF FULL AMOUNT
-        total_selected_amount = 0
-        for e in pending_enrollments:
-            if e.enrollment_id in selected_ids and e.payment_amount:
-                paid = e.amount_paid or 0
-                remaining = e.payment_amount - paid
-                total_selected_amount += remaining
-        
         log_user_action(telegram_user_id, "my_courses_view_from_message")
         
-        new_text = my_courses_message(
-            all_enrollments,
-            pending_count=len(pending_enrollments),
-            selected_count=len(selected_ids),
-            total_selected=total_selected_amount
-        )
-        
-        markup = my_courses_selection_keyboard(all_enrollments, selected_ids)
+        new_text, markup = _render_my_courses(all_enrollments, context.user_data['selected_pending_enrollments'])
         await update.message.reply_text(new_text, reply_markup=markup, parse_mode='Markdown')
 
 
@@ -163,84 +168,76 @@ async def handle_about_bot_message(update: Update, context: ContextTypes.DEFAULT
     )
 
 
-async def my_courses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show the user's enrolled courses and payment selection (from INLINE callback)"""
+async def my_courses_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, use_cached: bool = False):
+    """
+    Show the user's enrolled courses and payment selection (from INLINE callback).
+    use_cached re-renders from the snapshot taken by a recent full load (selection
+    toggles only change user_data, not the enrollments).
+    """
     query = update.callback_query
     telegram_user_id = query.from_user.id
     context.user_data.setdefault('selected_pending_enrollments', [])
     
-    with get_db() as session:
-        # GET INTERNAL USER ID
-        db_user = crud.get_or_create_user(
-            session,
-            telegram_user_id=telegram_user_id,
-            username=query.from_user.username,
-            first_name=query.from_user.first_name,
-            last_name=query.from_user.last_name
-        )
-        session.flush()
-        internal_user_id = db_user.user_id
-        
-        # Query with internal_user_id
-        all_enrollments_query = session.query(crud.Enrollment).options(
-            joinedload(crud.Enrollment.course)
-        ).filter(
-            crud.Enrollment.user_id == internal_user_id
-        )
-        
-        # Apply the new filtering logic
-        now = datetime.now()
-        seven_days_ago = now - timedelta(days=7)
-        
-        filtered_enrollments = []
-        for enrollment in all_enrollments_query.all():
-            course = enrollment.course
-            if not course or not course.end_date:
-                filtered_enrollments.append(enrollment)
-                continue
-
-            # Rule 1: Hide if it has a certificate and the end date has passed
-            if enrollment.with_certificate and course.end_date < now:
-                continue
+    cached = context.user_data.get('_my_courses_snapshot')
+    if use_cached and cached and time.monotonic() - cached[0] < MY_COURSES_SNAPSHOT_TTL:
+        all_enrollments = cached[2]
+    else:
+        internal_user_id = resolve_internal_user_id(query.from_user)
+        with get_db() as session:
+            # Query with internal_user_id
+            all_enrollments_query = session.query(crud.Enrollment).options(
+                joinedload(crud.Enrollment.course)
+            ).filter(
+                crud.Enrollment.user_id == internal_user_id
+            )
             
-            # Rule 2: Hide if it has NO certificate and the end date was more than 7 days ago
-            if not enrollment.with_certificate and course.end_date < seven_days_ago:
-                continue
+            # Apply the new filtering logic
+            now = datetime.now()
+            seven_days_ago = now - timedelta(days=7)
             
-            filtered_enrollments.append(enrollment)
+            filtered_enrollments = []
+            for enrollment in all_enrollments_query.all():
+                course = enrollment.course
+                if not course or not course.end_date:
+                    filtered_enrollments.append(enrollment)
+                    continue
+
+                # Rule 1: Hide if it has a certificate and the end date has passed
+                if enrollment.with_certificate and course.end_date < now:
+                    continue
+                
+                # Rule 2: Hide if it has NO certificate and the end date was more than 7 days ago
+                if not enrollment.with_certificate and course.end_date < seven_days_ago:
+                    continue
+                
+                filtered_enrollments.append(enrollment)
 
-        all_enrollments = filtered_enrollments
-        
-        pending_enrollments = [e for e in all_enrollments if e.payment_status.value in ['PENDING', 'FAILED']]
-        selected_ids = context.user_data['selected_pending_enrollments']
-        
-        # ✅ CALCULATE REMAINING BALANCE INSTEAD OF FULL AMOUNT
-        total_selected_amount = 0
-        for e in pending_enrollments:
-            if e.enrollment_id in selected_ids and e.payment_amount:
-                paid = e.amount_paid or 0
-                remaining = e.payment_amount - paid
-                total_selected_amount += remaining
+            all_enrollments = filtered_enrollments
         
-        log_user_action(telegram_user_id, "my_courses_view_from_callback")
-        
-        new_text = my_courses_message(
-            all_enrollments,
-            pending_count=len(pending_enrollments),
-            selected_count=len(selected_ids),
-            total_selected=total_selected_amount
-        )
-        
-        markup = my_courses_selection_keyboard(all_enrollments, selected_ids)
-        
-        try:
-            await query.edit_message_text(new_text, reply_markup=markup, parse_mode='Markdown')
-        except BadRequest as e:
-            if "Message is not modified" in str(e):
-                logger.warning("Message not modified, skipping edit.")
-                pass
-            else:
-                raise
+        # Loaded columns (and the joined course) stay readable after the session closes
+        context.user_data['_my_courses_snapshot'] = (time.monotonic(), internal_user_id, all_enrollments)
+    
+    log_user_action(telegram_user_id, "my_courses_view_from_callback")
+    
+    new_text, markup = _render_my_courses(all_enrollments, context.user_data['selected_pending_enrollments'])
+    
+    # Skip the Telegram round-trip when this exact view is already on screen
+    render_hash = (query.message.message_id if query.message else None,
+                   hashlib.blake2b(f"{new_text}|{markup.to_json()}".encode(), digest_size=8).digest())
+    if (context.user_data.get('_last_my_courses_hash') == render_hash
+            and query.message and query.message.reply_markup == markup):
+        logger.debug("my_courses view unchanged, skipping edit.")
+        return
+    
+    try:
+        await query.edit_message_text(new_text, reply_markup=markup, parse_mode='Markdown')
+        context.user_data['_last_my_courses_hash'] = render_hash
+    except BadRequest as e:
+        if "Message is not modified" in str(e):
+            logger.warning("Message not modified, skipping edit.")
+            pass
+        else:
+            raise
 
 
 async def my_course_select_deselect_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -250,35 +247,27 @@ async def my_course_select_deselect_callback(update: Update, context: ContextTyp
     
     telegram_user_id = query.from_user.id
     
-    # === FIX START ===
-    # Correctly parse the callback data
-    # e.g., 'my_course_select_123' -> ['my', 'course', 'select', '123']
-    parts = query.data.split('_')
-    if len(parts) < 4:
-        logger.error(f"Invalid callback data format: {query.data}")
+    # The handler pattern ^my_course_(select|deselect)_(\d+)$ already parsed the data,
+    # e.g. 'my_course_select_123' -> ('select', '123')
+    match = context.matches[0]
+    action = match.group(1)  # 'select' or 'deselect'
+    enrollment_id = int(match.group(2))
+    
+    # Verify enrollment ownership - against the recent my-courses snapshot when there
+    # is one (it holds only this user's enrollments), else from the database
+    snapshot = context.user_data.get('_my_courses_snapshot')
+    use_cached = bool(snapshot) and time.monotonic() - snapshot[0] < MY_COURSES_SNAPSHOT_TTL
+    if use_cached:
+        owned = any(e.enrollment_id == enrollment_id for e in snapshot[2])
+    else:
+        internal_user_id = resolve_internal_user_id(query.from_user)
+        with get_db() as session:
+            # Verify this enrollment belongs to this user
+            enrollment = crud.get_enrollment_by_id(session, enrollment_id)
+            owned = enrollment is not None and enrollment.user_id == internal_user_id
+    if not owned:
+        await query.answer("❌ خطأ: لا يمكنك اختيار هذه الدورة", show_alert=True)
         return
-
-    action = parts[2]  # This is now 'select' or 'deselect'
-    enrollment_id = int(parts[3]) # This is now the ID
-    # === FIX END ===
-    
-    # Get internal user ID and verify enrollment ownership
-    with get_db() as session:
-        db_user = crud.get_or_create_user(
-            session,
-            telegram_user_id=telegram_user_id,
-            username=query.from_user.username,
-            first_name=query.from_user.first_name,
-            last_name=query.from_user.last_name
-        )
-        session.flush()
-        internal_user_id = db_user.user_id
-        
-        # Verify this enrollment belongs to this user
-        enrollment = crud.get_enrollment_by_id(session, enrollment_id)
-        if not enrollment or enrollment.user_id != internal_user_id:
-            await query.answer("❌ خطأ: لا يمكنك اختيار هذه الدورة", show_alert=True)
-            return
     
     # Initialize list if not exists
     context.user_data.setdefault('selected_pending_enrollments', [])
@@ -294,7 +283,7 @@ async def my_course_select_deselect_callback(update: Update, context: ContextTyp
             log_user_action(telegram_user_id, "enrollment_deselected", f"enrollment_id={enrollment_id}")
     
     # Refresh the view by calling my_courses_callback
-    await my_courses_callback(update, context)
+    await my_courses_callback(update, context, use_cached=use_cached)
 
 
 async def proceed_to_pay_selected_pending_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -302,25 +291,14 @@ async def proceed_to_pay_selected_pending_callback(update: Update, context: Cont
     query = update.callback_query
     await query.answer()
     
-    telegram_user_id = query.from_user.id
     selected_ids = context.user_data.get('selected_pending_enrollments', [])
     
     if not selected_ids:
         await query.answer("[translate:لم تختر أي دورات للدفع]!", show_alert=True)
         return
     
+    internal_user_id = resolve_internal_user_id(query.from_user)
     with get_db() as session:
-        # GET INTERNAL USER ID
-        db_user = crud.get_or_create_user(
-            session,
-            telegram_user_id=telegram_user_id,
-            username=query.from_user.username,
-            first_name=query.from_user.first_name,
-            last_name=query.from_user.last_name
-        )
-        session.flush()
-        internal_user_id = db_user.user_id
-        
         # Query with internal_user_id
         enrollments_to_pay = session.query(crud.Enrollment).filter(
             crud.Enrollment.enrollment_id.in_(selected_ids),
@@ -328,12 +306,7 @@ async def proceed_to_pay_selected_pending_callback(update: Update, context: Cont
         ).all()
         
         # ✅ CALCULATE TOTAL REMAINING BALANCE
-        total_amount = 0
-        for e in enrollments_to_pay:
-            if e.payment_amount:
-                paid = e.amount_paid or 0
-                remaining = e.payment_amount - paid
-                total_amount += remaining
+        total_amount = remaining_balance(enrollments_to_pay)
         
         if total_amount <= 0:
             await query.answer("[translate:حدث خطأ في حساب المبلغ]", show_alert=True)
@@ -371,17 +344,8 @@ async def cancel_selected_pending_callback(update: Update, context: ContextTypes
         await query.answer("لم تختر أي دورات للإلغاء!", show_alert=True)
         return
 
+    internal_user_id = resolve_internal_user_id(query.from_user)
     with get_db() as session:
-        db_user = crud.get_or_create_user(
-            session,
-            telegram_user_id=telegram_user_id,
-            username=query.from_user.username,
-            first_name=query.from_user.first_name,
-            last_name=query.from_user.last_name
-        )
-        session.flush()
-        internal_user_id = db_user.user_id
-
         # Find and delete the enrollments
         enrollments_to_delete = session.query(crud.Enrollment).filter(
             crud.Enrollment.enrollment_id.in_(selected_ids),
@@ -396,8 +360,9 @@ async def cancel_selected_pending_callback(update: Update, context: ContextTypes
         
         log_user_action(telegram_user_id, "enrollments_cancelled", f"count={deleted_count}, ids={selected_ids}")
 
-    # Clear selection from user_data
+    # Clear selection and the my-courses snapshot holding the deleted rows
     context.user_data['selected_pending_enrollments'] = []
+    context.user_data.pop('_my_courses_snapshot', None)
     
     await query.answer(f"✅ تم إلغاء {deleted_count} تسجيل بنجاح", show_alert=True)
 
@@ -473,7 +438,7 @@ async def my_course_detail_callback(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
     
-    enrollment_id = int(query.data.split('_')[-1])
+    enrollment_id = int(query.data.rpartition('_')[2])
     
     with get_db() as session:
         enrollment = crud.get_enrollment_by_id(session, enrollment_id)
@@ -552,7 +517,7 @@ async def complete_payment_callback(update: Update, context: ContextTypes.DEFAUL
     query = update.callback_query
     await query.answer()
     
-    enrollment_id = int(query.data.split('_')[-1])
+    enrollment_id = int(query.data.rpartition('_')[2])
     
     with get_db() as session:
         enrollment = crud.get_enrollment_by_id(session, enrollment_id)
@@ -650,7 +615,7 @@ async def certificate_upgrade_callback(update: Update, context: ContextTypes.DEF
     query = update.callback_query
     await query.answer()
 
-    enrollment_id = int(query.data.split('_')[-1])
+    enrollment_id = int(query.data.rpartition('_')[2])
 
     with get_db() as session:
         enrollment = crud.get_enrollment_by_id(session, enrollment_id)
@@ -4,13 +4,18 @@ import json
 import threading
 from telegram import Update, InputFile
 from telegram.ext import ContextTypes
+from telegram.error import BadRequest
 from utils.keyboards import payment_upload_keyboard, back_to_main_keyboard, failed_receipt_admin_keyboard
 from utils.messages import payment_instructions_message, receipt_processing_message, payment_success_message, payment_failed_message, error_message
-from utils.helpers import validate_receipt_file, log_user_action, send_admin_notification
-from utils.s3_storage import upload_receipt_to_s3, download_receipt_from_s3
+from utils.helpers import validate_receipt_file, log_user_action, send_admin_notification, resolve_internal_user_id
+from utils.s3_storage import (
+    upload_receipt_to_s3, download_receipt_bytes_from_s3, cache_receipt_bytes, get_receipt_presigned_url,
+    get_receipt_file_id, remember_receipt_file_id, forget_receipt_file_id
+)
 import config
 from database import crud, get_db
-from database.models import PaymentStatus, TransactionStatus
+from database.models import PaymentStatus, TransactionStatus, Enrollment
+from handlers.group_registration import send_course_invite_link
 from services.gemini_service import validate_receipt_with_gemini_ai
 from services.fraud_detector import calculate_consolidated_fraud_score
 from services.duplicate_detector import check_transaction_id_duplicate
@@ -18,7 +23,7 @@ import logging
 import tempfile
 import os
 from datetime import datetime 
-from typing import Optional
+from typing import List, Optional
 import pytz
 def parse_transfer_datetime(gemini_result: dict) -> Optional[datetime]:
     """Parse date and time from Gemini result into datetime object"""
@@ -29,15 +34,123 @@ def parse_transfer_datetime(gemini_result: dict) -> Optional[datetime]:
         return None
     
     try:
-        # Combine date and time
-        datetime_str = f"{date_str} {time_str}"
-        return datetime.strptime(datetime_str, "%Y-%m-%d %H:%M")
+        # Fixed "%Y-%m-%d %H:%M" format - split by hand, strptime is much slower
+        year, month, day = date_str.split('-')
+        hour, minute = time_str.split(':')
+        parts = (year, month, day, hour, minute)
+        if not all(part.isdigit() for part in parts):
+            raise ValueError("non-numeric date/time component")
+        return datetime(*map(int, parts))
     except Exception as e:
-        logger.error(f"Failed to parse transfer datetime from '{date_str}' and '{time_str}': {e}")
+        logger.error("Failed to parse transfer datetime from '%s' and '%s': %s", date_str, time_str, e)
         return None
 
 logger = logging.getLogger(__name__)
 
+EGYPT_TZ = pytz.timezone('Africa/Cairo')
+
+# Static receipt-outcome texts and admin templates, built once at import
+RECEIPT_REJECTED_MSG = """
+❌ **لم يتم قبول الإيصال**
+
+عذراً، لم نتمكن من التحقق من الإيصال المرسل.
+
+سيتم مراجعته من قبل الإدارة خلال 24-48 ساعة.
+
+إذا كانت لديك أية استفسارات، يرجى التواصل مع الإدارة.
+
+---
+❌ **Receipt Not Accepted**
+
+Sorry, we couldn't verify the submitted receipt.
+
+It will be reviewed by administration within 24-48 hours.
+
+If you have any questions, please contact administration.
+"""
+
+RECEIPT_UNDER_REVIEW_MSG = """
+        ⏳ **قيد المراجعة**
+        تم استلام الإيصال وسيتم مراجعته من قبل الإدارة.
+        ⏱️ سيتم الرد خلال 24-48 ساعة.
+        شكراً لتفهمك.
+
+        ---
+
+        ⏳ **Under Review**
+        Receipt received and will be reviewed by administration.
+        ⏱️ You will receive a response within 24-48 hours.
+        Thank you for your patience.
+        """
+
+MANUAL_REVIEW_ADMIN_HEADER = """
+        ⚠️ <b>MANUAL REVIEW REQUIRED</b>
+
+        👤 <b>User Information:</b>
+        Name: {first_name} {last_name}
+        Username: @{username}
+        ID: <code>{telegram_user_id}</code>
+
+        🟡 <b>Fraud Score: {fraud_score}/100</b>
+        ⚠️ <b>Risk Level: {risk_level}</b>
+
+        <b>⚠️ Warning Indicators:</b>
+        """
+
+MANUAL_REVIEW_ADMIN_FOOTER = """
+        📄 <b>Extracted Data:</b>
+        • Account: {account}
+        • Amount: {amount:.2f} {currency}
+        • Expected: {expected:.2f} SDG
+
+        📚 <b>Courses:</b> {course_names}
+        📝 <b>Enrollment IDs:</b> {enrollment_ids}
+
+        🔍 <b>Action Required:</b> Please review and approve/reject manually.
+        """
+
+PARTIAL_PAYMENT_ADMIN_MSG = """
+        ⚠️ PARTIAL PAYMENT RECEIVED
+
+        👤 User: {first_name} {last_name}
+        🆔 ID: {telegram_user_id}
+
+        💰 Paid: {paid:.0f} SDG
+        📊 Required: {required:.0f} SDG
+        ⚠️ Remaining: {remaining:.0f} SDG
+
+        📚 Courses: {course_names}
+        📝 Enrollment IDs: {enrollment_ids}
+
+        ✅ Account verified: {account}
+        🟢 Fraud score: {fraud_score}/100
+
+        ⏳ Waiting for remaining payment...
+        """
+
+FAILED_RECEIPT_ADMIN_CAPTION = """
+🔴 Receipt Validation Failed
+
+👤 User: {first_name} {last_name}
+Username: @{username}
+ID: {telegram_user_id}
+
+📄 Extracted Data:
+• Account: {account}
+• Amount: {amount:.2f} {currency}
+• Expected: {expected:.2f} SDG
+
+🟢 Fraud Score: {fraud_score}/100 (LOW RISK)
+
+❌ Validation Issue:
+{reason}...
+
+📚 Courses: {course_names}
+📝 Enrollment IDs: {enrollment_ids}
+
+⚠️ Action Required: Manual review recommended
+"""
+
 
 async def proceed_to_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -56,13 +169,13 @@ async def proceed_to_payment_callback(update: Update, context: ContextTypes.DEFA
 
     telegram_user_id = user.id
     
-    logger.info(f"User {telegram_user_id} proceeding to payment")
+    logger.info("User %s proceeding to payment", telegram_user_id)
     
     cart_total = context.user_data.get("cart_total_for_payment")
     pending_enrollment_ids = context.user_data.get("pending_enrollment_ids_for_payment", [])
     
     if not cart_total or not pending_enrollment_ids:
-        logger.error(f"User {telegram_user_id} payment data missing: cart_total={cart_total}, enrollments={pending_enrollment_ids}")
+        logger.error("User %s payment data missing: cart_total=%s, enrollments=%s", telegram_user_id, cart_total, pending_enrollment_ids)
         await responder(error_message("payment_data_missing"), reply_markup=back_to_main_keyboard())
         return
     
@@ -70,7 +183,7 @@ async def proceed_to_payment_callback(update: Update, context: ContextTypes.DEFA
     context.user_data["current_payment_enrollment_ids"] = pending_enrollment_ids
     context.user_data["awaiting_receipt_upload"] = True
     
-    logger.info(f"User {telegram_user_id} payment initiated: amount=${cart_total}, enrollments={pending_enrollment_ids}")
+    logger.info("User %s payment initiated: amount=$%s, enrollments=%s", telegram_user_id, cart_total, pending_enrollment_ids)
     
     await responder(
         payment_instructions_message(cart_total),
@@ -80,51 +193,397 @@ async def proceed_to_payment_callback(update: Update, context: ContextTypes.DEFA
 
 
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 
-# Create a dedicated thread pool executor for Gemini calls
-# Each Gemini call runs in its own thread to avoid blocking other users
-_gemini_executor = ThreadPoolExecutor(max_workers=10, thread_name_prefix="gemini-")
+# receipt transaction id -> telegram_user_id of the receipt currently being processed
+# with it. The duplicate-ID check only sees committed transactions, so two receipts
+# with the same id in flight at once would both pass it; the second one to claim the
+# id is treated as a duplicate instead. Every receipt runs on this event loop, so a
+# plain dict is enough.
+_receipt_ids_in_flight = {}
+
+
+def _claim_receipt_transaction_id(transaction_id: Optional[str], telegram_user_id: int) -> Optional[int]:
+    """
+    Claim transaction_id for this receipt. Returns None when claimed (or there is no
+    id), otherwise the telegram_user_id of the receipt already holding it - which may
+    be the same user sending the receipt twice.
+    """
+    if not transaction_id:
+        return None
+    if transaction_id in _receipt_ids_in_flight:
+        return _receipt_ids_in_flight[transaction_id]
+    _receipt_ids_in_flight[transaction_id] = telegram_user_id
+    return None
+
+# Per-receipt payment state kept in user_data between the payment prompt and the receipt
+PAYMENT_STATE_KEYS = (
+    "cart_total_for_payment",
+    "pending_enrollment_ids_for_payment",
+    "current_payment_enrollment_ids",
+    "current_payment_total",
+    "resubmission_enrollment_id",
+    "reupload_amount",
+    # my-courses enrollment snapshot (menu_handlers); stale once the payment commits
+    "_my_courses_snapshot",
+)
+
+# State of the certificate-upgrade receipt flow, dropped once that receipt is handled
+CERTIFICATE_UPGRADE_STATE_KEYS = (
+    "awaiting_receipt_upload",
+    "certificate_upgrade_enrollment_id",
+    "expected_amount_for_gemini",
+    "_my_courses_snapshot",
+)
+
+
+def _reset_payment_state(user_data: dict):
+    """Stop waiting for a receipt and drop the payment state it was for"""
+    user_data["awaiting_receipt_upload"] = False
+    for key in PAYMENT_STATE_KEYS:
+        user_data.pop(key, None)
+
+
+def _split_payment(amount: float, remaining_balances: List[float]) -> List[float]:
+    """
+    Split a payment across enrollments in proportion to what each still owes.
+    The last share is the exact remainder, so the shares always add up to amount.
+    """
+    if not remaining_balances:
+        return []
+    
+    total_remaining = sum(remaining_balances)
+    if total_remaining > 0:
+        factor = amount / total_remaining
+        shares = [remaining * factor for remaining in remaining_balances[:-1]]
+    else:
+        # Nothing owed anywhere - split evenly rather than divide by zero
+        shares = [amount / len(remaining_balances)] * (len(remaining_balances) - 1)
+    shares.append(amount - sum(shares))
+    return shares
+
+
+async def _send_course_invites(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                               telegram_user_id: int, course_ids: List[int]):
+    """
+    Send the group invite for each course concurrently. Each invite is independent,
+    so one failing is logged instead of cancelling the others.
+    """
+    results = await asyncio.gather(
+        *(send_course_invite_link(update, context, telegram_user_id, course_id) for course_id in course_ids),
+        return_exceptions=True
+    )
+    for course_id, outcome in zip(course_ids, results):
+        if isinstance(outcome, Exception):
+            logger.error("Failed to send invite for course %s to user %s: %s", course_id, telegram_user_id, outcome)
+
+
+def _safe_unlink(path: str):
+    """Remove a temp file if it is still there (no separate exists() check)"""
+    try:
+        os.unlink(path)
+        logger.info("Cleaned up temp file: %s", path)
+    except FileNotFoundError:
+        pass
+    except Exception as cleanup_error:
+        logger.warning("Failed to clean up temp file %s: %s", path, cleanup_error)
+
+
+def _read_file_bytes(path: str) -> bytes:
+    """Whole-file read; callers run it via asyncio.to_thread to keep disk I/O off the event loop"""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def _load_receipt_photo(path_or_url: str) -> bytes:
+    """
+    Receipt content for send_photo: S3 URLs go through the receipt cache (fetched
+    off the event loop on a miss, no temp file), local paths are read in a worker thread
+    """
+    if path_or_url.startswith('https://'):
+        return await asyncio.to_thread(download_receipt_bytes_from_s3, path_or_url)
+    return await asyncio.to_thread(_read_file_bytes, path_or_url)
+
+
+async def _send_admin_receipt_photo(context: ContextTypes.DEFAULT_TYPE, receipt_path: str,
+                                    photo: bytes = None, **kwargs):
+    """
+    Send a stored receipt to the admin chat. Reuses the Telegram file_id from an
+    earlier send of the same receipt when there is one. Otherwise an S3 receipt is
+    handed to Telegram as a pre-signed URL so it fetches the image from S3 itself;
+    only if that fails (or the receipt is local) is the photo loaded and uploaded.
+    Remembers the file_id the receipt gets.
+    """
+    file_id = get_receipt_file_id(receipt_path)
+    if file_id:
+        try:
+            return await context.bot.send_photo(chat_id=config.ADMIN_CHAT_ID, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logger.warning("Cached file_id rejected for %s, re-uploading: %s", receipt_path, e)
+            forget_receipt_file_id(receipt_path)
+    
+    sent = None
+    if photo is None and receipt_path.startswith('https://'):
+        try:
+            sent = await context.bot.send_photo(
+                chat_id=config.ADMIN_CHAT_ID, photo=get_receipt_presigned_url(receipt_path), **kwargs
+            )
+        except Exception as e:
+            # Not signable, or Telegram couldn't fetch it - the upload below still works
+            logger.warning("Could not send %s by URL, uploading it: %s", receipt_path, e)
+    
+    if sent is None:
+        if photo is None:
+            photo = await _load_receipt_photo(receipt_path)
+        sent = await context.bot.send_photo(chat_id=config.ADMIN_CHAT_ID, photo=photo, **kwargs)
+    if sent.photo:
+        remember_receipt_file_id(receipt_path, sent.photo[-1].file_id)
+    return sent
+
 
-def _run_gemini_sync(image_path: str, expected_amount: float, expected_accounts: list):
+async def _send_admin_receipt_alert(context: ContextTypes.DEFAULT_TYPE, file_path: str, caption: str,
+                                    reply_markup=None, duplicate_info: dict = None) -> bool:
     """
-    Run Gemini validation in a synchronous context (thread).
-    This function creates its own event loop in the thread.
+    Send a flagged receipt to the admin chat, preceded by the earlier receipt it
+    duplicates when duplicate_info is given. Local receipts not yet known to Telegram
+    are read concurrently; S3 ones go by URL. They go out as separate photos because the new one carries
+    the admin keyboard, which Telegram does not allow on media groups.
+    If the photos can't be sent, the caption is sent as a text notification instead.
+    Returns True if the photos were sent.
     """
-    # Create a new event loop for this thread
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    original_receipt_path = duplicate_info.get("original_receipt_path") if duplicate_info else None
     try:
-        # Import here to avoid circular imports
-        from services.gemini_service import validate_receipt_with_gemini_ai
-        # Run the async Gemini function in the new loop
-        return loop.run_until_complete(
-            validate_receipt_with_gemini_ai(image_path, expected_amount, expected_accounts)
+        def needs_upload(path):
+            return bool(path) and not path.startswith('https://') and not get_receipt_file_id(path)
+        
+        original_photo, photo_to_send = await asyncio.gather(
+            _load_receipt_photo(original_receipt_path) if needs_upload(original_receipt_path) else asyncio.sleep(0),
+            _load_receipt_photo(file_path) if needs_upload(file_path) else asyncio.sleep(0)
         )
-    finally:
-        # Clean up the event loop
-        loop.close()
+        
+        if original_receipt_path:
+            await _send_admin_receipt_photo(
+                context,
+                original_receipt_path,
+                original_photo,
+                caption=(
+                    f"📸 <b>ORIGINAL RECEIPT (FIRST SUBMISSION)</b>\n\n"
+                    f"👤 Original Owner: {duplicate_info.get('original_user_name')}\n"
+                    f"Username: @{duplicate_info.get('original_user_username')}\n"
+                    f"🆔 Telegram ID: <code>{duplicate_info.get('original_telegram_id')}</code>\n\n"
+                    f"⬇️ See next photo for duplicate attempt"
+                ),
+                parse_mode='HTML'
+            )
+        
+        await _send_admin_receipt_photo(
+            context,
+            file_path,
+            photo_to_send,
+            caption=caption[:1024],
+            reply_markup=reply_markup,
+            parse_mode='HTML'
+        )
+        return True
+    except Exception as e:
+        logger.error("Failed to send admin receipt alert: %s", e)
+        await send_admin_notification(context, caption[:4096])
+        return False
 
-async def run_gemini_in_thread(image_path: str, expected_amount: float, expected_accounts: list):
+
+async def _check_image_duplicate(temp_path: str, image_bytes: bytes, telegram_user_id: int, internal_user_id: int) -> dict:
+    """
+    Same-user image duplicate check against the stored receipt hashes. Needs only
+    the image, so it runs alongside Gemini; informational, so a failure counts as
+    no duplicate rather than failing the receipt.
+    """
+    from services.duplicate_detector import check_duplicate_submission
+    
+    try:
+        with get_db() as dup_session:
+            previous_hashes = crud.get_user_receipt_phashes(dup_session, internal_user_id)
+        
+        logger.info("Checking duplicate against %s stored receipt hashes for user %s", len(previous_hashes), telegram_user_id)
+        return await asyncio.to_thread(
+            check_duplicate_submission, internal_user_id, temp_path,
+            similarity_threshold=95.0, previous_hashes=previous_hashes, image_bytes=image_bytes
+        )
+    except Exception as e:
+        logger.error("Image duplicate check failed for user %s: %s", telegram_user_id, e)
+        return {'is_duplicate': False, 'image_similarity_score': 0}
+
+
+async def _run_fraud_checks(temp_path: str, image_bytes: bytes, gemini_result: dict, transaction_id: str,
+                            transfer_datetime: Optional[datetime], telegram_user_id: int, internal_user_id: int,
+                            image_duplicate_task: "asyncio.Task[dict]", in_flight_owner: Optional[int] = None):
     """
-    Run Gemini validation in a dedicated thread pool.
-    This prevents blocking the main event loop for other users.
-    Returns the Gemini result directly.
+    Fraud detection stage of receipt processing: duplicate transaction ID, stored-hash
+    image duplicate (already started by the caller) and (when useful) ELA/EXIF
+    forensics, then the recommendation. in_flight_owner is the user whose receipt with
+    the same transaction ID is still being processed, if any.
+    
+    Returns:
+        (fraud_analysis, duplicate_check_result, duplicate_image_check)
     """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        _gemini_executor,
-        _run_gemini_sync,
-        image_path,
-        expected_amount,
-        expected_accounts
+    logger.info("🔍 Running fraud detection for user %s", telegram_user_id)
+    duplicate_check_result = {'fraud_score': 0, 'is_duplicate': False}
+
+    # ===== INDEPENDENT CHECKS - RUN CONCURRENTLY =====
+    # Transaction ID lookup (DB), EXIF metadata, ELA (CPU) and image duplicate check
+    # don't depend on each other, so wall time is the slowest check, not the sum
+    from services.image_forensics import analyze_image_metadata
+    from services.ela_detector import perform_ela
+
+    # ELA + EXIF are informational only; skip them when Gemini already decided the
+    # outcome (invalid receipt, or valid with high authenticity)
+    try:
+        authenticity_score = float(gemini_result.get('authenticity_score', 0) or 0)
+    except (TypeError, ValueError):
+        authenticity_score = 0
+    need_forensics = bool(gemini_result.get('is_valid')) and authenticity_score < 90
+
+    if need_forensics:
+        forensics_checks = (
+            asyncio.to_thread(analyze_image_metadata, temp_path, image_bytes),
+            asyncio.to_thread(perform_ela, temp_path, image_bytes=image_bytes),
+        )
+    else:
+        logger.info("Skipping ELA/metadata forensics for user %s (is_valid=%s, authenticity=%s)", telegram_user_id, gemini_result.get('is_valid'), authenticity_score)
+        forensics_checks = (
+            asyncio.sleep(0, {"risk_level": "LOW", "suspicious_flags": []}),
+            asyncio.sleep(0, {"is_suspicious": False, "risk_score": 0, "reasons": []}),
+        )
+
+    if in_flight_owner is not None:
+        # Same ID as a receipt not yet committed - the table can't see it, flag it directly
+        logger.warning("🚨 DUPLICATE TRANSACTION ID in flight: %s (user %s)", transaction_id, in_flight_owner)
+        transaction_id_check = asyncio.sleep(0, {
+            'is_duplicate': True,
+            'fraud_score': 50,
+            'risk_level': 'HIGH',
+            'match_type': 'TRANSACTION_ID',
+            'message': f'Transaction ID {transaction_id} is being processed for another receipt',
+            'original_telegram_id': in_flight_owner
+        })
+    else:
+        transaction_id_check = asyncio.to_thread(check_transaction_id_duplicate, transaction_id, internal_user_id)
+
+    transaction_duplicate_check, metadata_analysis, ela_analysis, duplicate_submission_check = await asyncio.gather(
+        transaction_id_check,  # 50 if duplicate, 0 otherwise
+        *forensics_checks,
+        image_duplicate_task
+    )
+    logger.info("🔍 DUPLICATE CHECK - is_duplicate=%s, fraud_score=%s", transaction_duplicate_check.get('is_duplicate'), transaction_duplicate_check.get('fraud_score', 0))
+
+    # Timezone-aware submission date (GMT+2)
+    submission_date = datetime.now(EGYPT_TZ)
+
+    gemini_result['submission_date'] = submission_date.isoformat()
+    gemini_result['transfer_date'] = transfer_datetime.isoformat() if transfer_datetime else None
+    # Calculate final fraud score
+    fraud_score = transaction_duplicate_check.get('fraud_score', 0)  # 50 if duplicate ID, 0 otherwise
+    logger.info("💯 FRAUD SCORE CALCULATION - Initial score from duplicate check: %s", fraud_score)
+    fraud_analysis = calculate_consolidated_fraud_score(
+    gemini_result=gemini_result,
+    image_forensics_result={'is_forged': False, 'ela_score': 0},  # ✅ Disabled, pass empty dict
+    duplicate_check_result=duplicate_check_result  # ✅ Correct parameter name
     )
+    image_similarity_score = duplicate_submission_check.get('image_similarity_score', 0)  # Always 0
+
+    logger.info("📊 Fraud Scores - Transaction ID: %s, Image: %s", fraud_score, image_similarity_score)
+
+    # Build fraud analysis result
+    fraud_indicators = []
+    if transaction_duplicate_check.get('is_duplicate'):
+        fraud_indicators.append(
+            f"Duplicate transaction ID: {transaction_id} (previously used by user {transaction_duplicate_check.get('original_telegram_id')})"
+        )
+    # ✅ ADD THIS LOG BEFORE THE DECISION
+    logger.info("⚖️ DECISION POINT - Final fraud_score: %s", fraud_score)
+    logger.info("⚖️ DECISION POINT - Thresholds: REJECT>=70, MANUAL_REVIEW>=40")
+
+    # Determine recommendation based on fraud score
+    if fraud_score >= 70:
+        recommendation = 'REJECT'
+    elif fraud_score >= 40:
+        recommendation = 'MANUAL_REVIEW'
+    else:
+        recommendation = 'APPROVE'
+
+    fraud_analysis = {
+        'fraud_score': fraud_score,
+        'recommendation': recommendation,
+        'fraud_indicators': fraud_indicators,
+        'duplicate_check_result': {
+            'is_duplicate': transaction_duplicate_check.get('is_duplicate', False),
+            'similarity_score': transaction_duplicate_check.get('similarity_score', 0)
+    },
+    'ai_validation': gemini_result,
+    'checks_performed': [
+        'Transaction ID duplicate check (from Transaction table)',
+        'Image similarity check (stored pHash, informational - returns 0)',
+        'Gemini AI receipt validation'
+    ]
+    }
+
+    logger.info("🎯 Fraud Analysis: Score=%s, Recommendation=%s", fraud_score, recommendation)
+
+    # Store duplicate check details for admin notifications
+    duplicate_image_check = transaction_duplicate_check  # Use transaction check for admin display
+    duplicate_check_result = {
+    'is_duplicate': transaction_duplicate_check.get('is_duplicate', False),
+    'similarity_score': transaction_duplicate_check.get('similarity_score', 0),
+    'match_type': transaction_duplicate_check.get('match_type', 'NONE'),
+    'risk_level': transaction_duplicate_check.get('risk_level', 'LOW')
+    }
+    # ===== IMAGE FORENSICS ANALYSIS =====
+    image_forensics_result = {
+    "is_forged": ela_analysis.get("is_suspicious", False) or metadata_analysis.get("risk_level") == "HIGH",
+    "ela_score": ela_analysis.get("risk_score", 0) * 20,
+    "metadata_risk": metadata_analysis.get("risk_level", "LOW"),
+    "metadata_flags": metadata_analysis.get("suspicious_flags", []),
+    "ela_reasons": ela_analysis.get("reasons", [])
+    }
+    logger.info("Image forensics: is_forged=%s, ela_score=%s", image_forensics_result.get('is_forged'), image_forensics_result.get('ela_score', 0))
+
+    # The stored-pHash comparison is informational: log a match, but keep it out
+    # of the duplicate verdict admins see (it carries no original-owner details).
+    # Only the computed hash is passed on, to be persisted with the receipt.
+    if duplicate_submission_check.get("is_duplicate"):
+        logger.info("Receipt from user %s resembles one of their earlier receipts (%.1f%%)", telegram_user_id, duplicate_submission_check.get('best_similarity', 0))
+    duplicate_image_check = {
+        'is_duplicate': False,
+        'risk_level': 'LOW',
+        'match_type': 'NONE',
+        'similarity_percentage': 0,
+        'image_phash': duplicate_submission_check.get('image_phash')
+    }
+
+    duplicate_check_result["is_duplicate"] = duplicate_image_check.get("is_duplicate", False)
+    duplicate_check_result["similarity_score"] = duplicate_image_check.get("similarity_percentage", 0)
+
+    if duplicate_check_result["is_duplicate"]:
+        logger.warning("⚠️ DUPLICATE RECEIPT DETECTED! User %s tried to reuse receipt", telegram_user_id)
+        logger.warning("   Original owner: %s (@%s)", duplicate_image_check.get('original_user_name'), duplicate_image_check.get('original_user_username'))
+        logger.warning("   Similarity: %.1f%%", duplicate_check_result['similarity_score'])
+        logger.warning("   Match type: %s", duplicate_image_check.get('match_type'))
+        
+        # Add high fraud contribution for duplicates
+        duplicate_check_result["fraud_contribution"] = 55
+        logger.info("⚠️ Duplicate detected - adding 55 points to fraud score")
+    else:
+        duplicate_check_result["fraud_contribution"] = 0
+    logger.info("🎯 Fraud Analysis - Score: %s/100, Risk: %s, Action: %s", fraud_analysis.get('fraud_score', 0), fraud_analysis.get('risk_level', 'UNKNOWN'), fraud_analysis.get('recommendation', 'UNKNOWN'))
+    logger.info("📋 Fraud indicators: %s", fraud_analysis['fraud_indicators'])
+
+    return fraud_analysis, duplicate_check_result, duplicate_image_check
+
 
 async def _process_receipt_async(update: Update, context: ContextTypes.DEFAULT_TYPE, temp_path: str, 
                                   telegram_user_id: int, internal_user_id: int, expected_amount_for_gemini: float, user):
     """
-    Process receipt in the main event loop - only Gemini runs in a thread.
-    All Telegram API calls stay in the main event loop to avoid "Event loop is closed" errors.
+    Process receipt in the main event loop. Gemini's blocking SDK call is offloaded
+    to a worker thread inside gemini_service; everything else stays on this loop to
+    avoid "Event loop is closed" errors.
     """
     # Initialize variables for processing
     file_path = None
@@ -135,206 +594,73 @@ async def _process_receipt_async(update: Update, context: ContextTypes.DEFAULT_T
     transfer_datetime = None
     sender_name = None
     extracted_amount = None
-    fraud_score = 0 
-    duplicate_check_result = {'fraud_score': 0, 'is_duplicate': False}
-    fraud_indicators = []
+    s3_upload_task = None
+    claimed_transaction_id = None
     
     try:
+        # ==================== STEP 0: START S3 UPLOAD IN BACKGROUND ====================
+        # Nothing needs the S3 URL until the decision logic, so the upload overlaps
+        # Gemini and the fraud checks instead of adding its latency after them
+        resubmission_enrollment_id = context.user_data.get("resubmission_enrollment_id")
+        if resubmission_enrollment_id:
+            enrollment_id_for_s3 = resubmission_enrollment_id
+        else:
+            current_payment_enrollment_ids = context.user_data.get("current_payment_enrollment_ids", [])
+            enrollment_id_for_s3 = current_payment_enrollment_ids[0] if current_payment_enrollment_ids else 0
+        
+        # Read the receipt once; the upload, Gemini and the fraud checks all use these bytes
+        image_bytes = await asyncio.to_thread(_read_file_bytes, temp_path)
+        
+        s3_upload_task = asyncio.create_task(
+            asyncio.to_thread(upload_receipt_to_s3, temp_path, internal_user_id, enrollment_id_for_s3, image_bytes)
+        )
+
         # ==================== STEP 1: GEMINI AI VALIDATION ====================
-        logger.info(f"Starting Gemini validation for user {telegram_user_id}: expected_amount=${expected_amount_for_gemini}")
+        logger.info("Starting Gemini validation for user %s: expected_amount=$%s", telegram_user_id, expected_amount_for_gemini)
+
+        # The image duplicate check doesn't need Gemini's output - overlap it with the call
+        image_duplicate_task = asyncio.create_task(
+            _check_image_duplicate(temp_path, image_bytes, telegram_user_id, internal_user_id)
+        )
 
-        # Run Gemini validation in a separate thread to avoid blocking other users
-        # This is the ONLY blocking operation that runs in a thread
+        # validate_receipt_with_gemini_ai is a native coroutine - await it directly
         gemini_result = await validate_receipt_with_gemini_ai(
             temp_path,
             expected_amount_for_gemini,
             config.EXPECTED_ACCOUNTS,
-            user_id=telegram_user_id  # ✅ NEW: Enable per-user threading
+            user_id=telegram_user_id,  # ✅ NEW: Enable per-user threading
+            image_bytes=image_bytes
         )
         transaction_id = gemini_result.get('transaction_id')
-        logger.info(f"🔍 DUPLICATE CHECK - Transaction ID extracted: '{transaction_id}' (type: {type(transaction_id)})")
-        # Check for duplicate transaction ID
-        transaction_duplicate_check = check_transaction_id_duplicate(transaction_id, internal_user_id)
-
-        # ✅ ADD THIS LOG
-        logger.info(f"🔍 DUPLICATE CHECK - Result: {transaction_duplicate_check}")
-        logger.info(f"🔍 DUPLICATE CHECK - is_duplicate={transaction_duplicate_check.get('is_duplicate')}, fraud_score={transaction_duplicate_check.get('fraud_score', 0)}")
+        logger.info("🔍 DUPLICATE CHECK - Transaction ID extracted: '%s' (type: %s)", transaction_id, type(transaction_id))
+        in_flight_owner = _claim_receipt_transaction_id(transaction_id, telegram_user_id)
+        if in_flight_owner is None and transaction_id:
+            claimed_transaction_id = transaction_id
 
         transfer_datetime = parse_transfer_datetime(gemini_result)  # Parse date + time
         sender_name = gemini_result.get('sender_name')
         extracted_amount = gemini_result.get('amount')
 
-        logger.info(f"Gemini validation result: is_valid={gemini_result.get('is_valid')}, amount={gemini_result.get('amount')}, tx_id={gemini_result.get('transaction_id')}")
+        logger.info("Gemini validation result: is_valid=%s, amount=%s, tx_id=%s", gemini_result.get('is_valid'), gemini_result.get('amount'), gemini_result.get('transaction_id'))
 
         # ==================== FRAUD DETECTION ====================
-        logger.info(f"🔍 Running fraud detection for user {telegram_user_id}")
-
-        # Extract transaction ID from Gemini result
-        transaction_id = gemini_result.get('transaction_id', 'N/A')
-        logger.info(f"📋 Extracted Transaction ID from receipt: {transaction_id}")
-
-        # ✅ NEW: Check transaction ID duplicate (returns 50 if duplicate, 0 otherwise)
-        transaction_duplicate_check = check_transaction_id_duplicate(transaction_id, internal_user_id)
-
-        # ✅ NEW: Image duplicate check (always returns 0 - disabled)
-        from services.duplicate_detector import check_duplicate_submission
-        image_duplicate_check = check_duplicate_submission(
-            user_id=internal_user_id,
-            image_path=file_path,
-            previous_receipt_paths=[e.receipt_image_path for e in enrollments_to_update if e.receipt_image_path]
+        fraud_analysis, duplicate_check_result, duplicate_image_check = await _run_fraud_checks(
+            temp_path, image_bytes, gemini_result, transaction_id, transfer_datetime,
+            telegram_user_id, internal_user_id, image_duplicate_task, in_flight_owner
         )
 
-        # Timezone-aware submission date (GMT+2)
-        egypt_tz = pytz.timezone('Africa/Cairo')
-        submission_date = datetime.now(egypt_tz)
-
-        gemini_result['submission_date'] = submission_date.isoformat()
-        gemini_result['transfer_date'] = transfer_datetime.isoformat() if transfer_datetime else None
-        # Calculate final fraud score
-        fraud_score = transaction_duplicate_check.get('fraud_score', 0)  # 50 if duplicate ID, 0 otherwise
-        logger.info(f"💯 FRAUD SCORE CALCULATION - Initial score from duplicate check: {fraud_score}")
-        fraud_analysis = calculate_consolidated_fraud_score(
-        gemini_result=gemini_result,
-        image_forensics_result={'is_forged': False, 'ela_score': 0},  # ✅ Disabled, pass empty dict
-        duplicate_check_result=duplicate_check_result  # ✅ Correct parameter name
-        )
-        image_similarity_score = image_duplicate_check.get('image_similarity_score', 0)  # Always 0
-
-        logger.info(f"📊 Fraud Scores - Transaction ID: {fraud_score}, Image: {image_similarity_score}")
-
-        # Build fraud analysis result
-        fraud_indicators = []
-        if transaction_duplicate_check.get('is_duplicate'):
-            fraud_indicators.append(
-                f"Duplicate transaction ID: {transaction_id} (previously used by user {transaction_duplicate_check.get('original_telegram_id')})"
-            )
-        # ✅ ADD THIS LOG BEFORE THE DECISION
-        logger.info(f"⚖️ DECISION POINT - Final fraud_score: {fraud_score}")
-        logger.info(f"⚖️ DECISION POINT - Thresholds: REJECT>=70, MANUAL_REVIEW>=40")
-
-        # Determine recommendation based on fraud score
-        if fraud_score >= 70:
-            recommendation = 'REJECT'
-        elif fraud_score >= 40:
-            recommendation = 'MANUAL_REVIEW'
-        else:
-            recommendation = 'APPROVE'
-
-        fraud_analysis = {
-            'fraud_score': fraud_score,
-            'recommendation': recommendation,
-            'fraud_indicators': fraud_indicators,
-            'duplicate_check_result': {
-                'is_duplicate': transaction_duplicate_check.get('is_duplicate', False),
-                'similarity_score': transaction_duplicate_check.get('similarity_score', 0)
-        },
-        'ai_validation': gemini_result,
-        'checks_performed': [
-            'Transaction ID duplicate check (from Transaction table)',
-            'Image similarity check (disabled - returns 0)',
-            'Gemini AI receipt validation'
-        ]
-        }
-
-        logger.info(f"🎯 Fraud Analysis: Score={fraud_score}, Recommendation={recommendation}")
-
-        # Store duplicate check details for admin notifications
-        duplicate_image_check = transaction_duplicate_check  # Use transaction check for admin display
-        duplicate_check_result = {
-        'is_duplicate': transaction_duplicate_check.get('is_duplicate', False),
-        'similarity_score': transaction_duplicate_check.get('similarity_score', 0),
-        'match_type': transaction_duplicate_check.get('match_type', 'NONE'),
-        'risk_level': transaction_duplicate_check.get('risk_level', 'LOW')
-        }
-        # ===== IMAGE FORENSICS ANALYSIS =====
-        from services.image_forensics import analyze_image_metadata
-        from services.ela_detector import perform_ela
-
-        metadata_analysis = analyze_image_metadata(temp_path)
-        ela_analysis = perform_ela(temp_path)
-
-        image_forensics_result = {
-        "is_forged": ela_analysis.get("is_suspicious", False) or metadata_analysis.get("risk_level") == "HIGH",
-        "ela_score": ela_analysis.get("risk_score", 0) * 20,
-        "metadata_risk": metadata_analysis.get("risk_level", "LOW"),
-        "metadata_flags": metadata_analysis.get("suspicious_flags", []),
-        "ela_reasons": ela_analysis.get("reasons", [])
-        }
-        logger.info(f"Image forensics: is_forged={image_forensics_result.get('is_forged')}, ela_score={image_forensics_result.get('ela_score', 0)}")
-
-        # ✅ COLLECT ALL PREVIOUS RECEIPTS FROM CURRENT USER'S ENROLLMENTS (FOR SAME-USER DUPLICATE CHECK)
-        all_previous_receipt_paths = []
-
-        with get_db() as dup_session:
-            current_payment_enrollment_ids = context.user_data.get("current_payment_enrollment_ids", [])
-            resubmission_enrollment_id = context.user_data.get("resubmission_enrollment_id")
-            
-            enrollment_ids_to_check = current_payment_enrollment_ids if not resubmission_enrollment_id else [resubmission_enrollment_id]
-            
-            for eid in enrollment_ids_to_check:
-                enrollment = crud.get_enrollment_by_id(dup_session, eid)
-                if enrollment and enrollment.receipt_image_path:
-                    # ✅ Split comma-separated paths
-                    receipt_paths = [p.strip() for p in enrollment.receipt_image_path.split(',') if p.strip()]
-                    all_previous_receipt_paths.extend(receipt_paths)
-
-        logger.info(f"Checking duplicate against {len(all_previous_receipt_paths)} previous receipts from SAME user for re-submission check")
-        # Now check duplicates against ALL previous receipts
-        all_previous_receipt_paths = []
-
-        with get_db() as dup_session:
-            current_payment_enrollment_ids = context.user_data.get("current_payment_enrollment_ids", [])
-            resubmission_enrollment_id = context.user_data.get("resubmission_enrollment_id")
-            
-            enrollment_ids_to_check = current_payment_enrollment_ids if not resubmission_enrollment_id else [resubmission_enrollment_id]
-            
-            for eid in enrollment_ids_to_check:
-                enrollment = crud.get_enrollment_by_id(dup_session, eid)
-                if enrollment and enrollment.receipt_image_path:
-                    # Split comma-separated paths
-                    receipt_paths = enrollment.receipt_image_path.split(',')
-                    # Filter out empty strings and add to list
-                    all_previous_receipt_paths.extend([path.strip() for path in receipt_paths if path.strip()])
-
-        logger.info(f"Checking duplicate against {len(all_previous_receipt_paths)} previous receipts for user {telegram_user_id}")
-
-        from services.duplicate_detector import check_duplicate_submission
-        duplicate_image_check = check_duplicate_submission(internal_user_id, temp_path, previous_receipt_paths=all_previous_receipt_paths)
-
-        duplicate_check_result["is_duplicate"] = duplicate_image_check.get("is_duplicate", False)
-        duplicate_check_result["similarity_score"] = duplicate_image_check.get("similarity_percentage", 0)
-
-        if duplicate_check_result["is_duplicate"]:
-            logger.warning(f"⚠️ DUPLICATE RECEIPT DETECTED! User {telegram_user_id} tried to reuse receipt")
-            logger.warning(f"   Original owner: {duplicate_image_check.get('original_user_name')} (@{duplicate_image_check.get('original_user_username')})")
-            logger.warning(f"   Similarity: {duplicate_check_result['similarity_score']:.1f}%")
-            logger.warning(f"   Match type: {duplicate_image_check.get('match_type')}")
-            
-            # Add high fraud contribution for duplicates
-            duplicate_check_result["fraud_contribution"] = 55
-            logger.info(f"⚠️ Duplicate detected - adding 55 points to fraud score")
-        else:
-            duplicate_check_result["fraud_contribution"] = 0
-        logger.info(f"🎯 Fraud Analysis - Score: {fraud_analysis.get('fraud_score', 0)}/100, Risk: {fraud_analysis.get('risk_level', 'UNKNOWN')}, Action: {fraud_analysis.get('recommendation', 'UNKNOWN')}")
-        logger.info(f"📋 Fraud indicators: {fraud_analysis['fraud_indicators']}")
-
         # ==================== STEP 3: UPLOAD TO S3 ====================
         try:
-            resubmission_enrollment_id = context.user_data.get("resubmission_enrollment_id")
-            if resubmission_enrollment_id:
-                enrollment_id_for_s3 = resubmission_enrollment_id
-            else:
-                current_payment_enrollment_ids = context.user_data.get("current_payment_enrollment_ids", [])
-                enrollment_id_for_s3 = current_payment_enrollment_ids[0] if current_payment_enrollment_ids else 0
-            
-            s3_url = upload_receipt_to_s3(temp_path, internal_user_id, enrollment_id_for_s3)
+            s3_url = await s3_upload_task
             file_path = s3_url
-            logger.info(f"✅ Receipt uploaded to S3: {s3_url}")
+            # Admin notifications below send this receipt again - serve it from memory
+            cache_receipt_bytes(s3_url, image_bytes)
+            logger.info("✅ Receipt uploaded to S3: %s", s3_url)
             
         except Exception as e:
-            logger.error(f"❌ S3 upload failed: {e}")
+            logger.error("❌ S3 upload failed: %s", e)
             file_path = temp_path
-            logger.warning(f"Using local temp path as fallback: {temp_path}")
+            logger.warning("Using local temp path as fallback: %s", temp_path)
         
         # ==================== DECISION LOGIC ====================
         
@@ -348,7 +674,7 @@ async def _process_receipt_async(update: Update, context: ContextTypes.DEFAULT_T
             enrollments_to_update = []
             
             if resubmission_enrollment_id:
-                logger.info(f"Processing resubmission for user {telegram_user_id}, enrollment {resubmission_enrollment_id}")
+                logger.info("Processing resubmission for user %s, enrollment %s", telegram_user_id, resubmission_enrollment_id)
                 enrollment = crud.get_enrollment_by_id(session, resubmission_enrollment_id)
                 if enrollment and enrollment.user_id == internal_user_id:
                     enrollments_to_update.append(enrollment)
@@ -363,148 +689,106 @@ async def _process_receipt_async(update: Update, context: ContextTypes.DEFAULT_T
                     else:
                         enrollment_ids = current_payment_enrollment_ids  # Already a list
                     
-                    logger.info(f"🔄 Continuing partial payment for user {telegram_user_id}, stored enrollments: {enrollment_ids}")
+                    logger.info("🔄 Continuing partial payment for user %s, stored enrollments: %s", telegram_user_id, enrollment_ids)
                     
-                    for eid in enrollment_ids:
-                        enrollment = crud.get_enrollment_by_id(session, eid)
-                        if enrollment and enrollment.user_id == internal_user_id:
-                            enrollments_to_update.append(enrollment)
+                    # One IN query, then restore the stored order (first ID owns the transaction)
+                    enrollments_by_id = {e.enrollment_id: e for e in crud.get_enrollments_by_ids(session, enrollment_ids)}
+                    enrollments_to_update = [
+                        enrollments_by_id[eid] for eid in enrollment_ids
+                        if eid in enrollments_by_id and enrollments_by_id[eid].user_id == internal_user_id
+                    ]
                 else:
                     # Initial payment - get PENDING enrollments
-                    logger.info(f"Processing initial payment for user {telegram_user_id}")
+                    logger.info("Processing initial payment for user %s", telegram_user_id)
                     enrollments_to_update = crud.get_user_pending_enrollments(session, internal_user_id)
             
                 if not enrollments_to_update:
-                    logger.error(f"No enrollments found for user {telegram_user_id}")
+                    logger.error("No enrollments found for user %s", telegram_user_id)
                     await update.message.reply_text(error_message("enrollment_not_found"), reply_markup=back_to_main_keyboard())
                     log_user_action(telegram_user_id, "receipt_upload_failed", "No enrollments to update/process")
                     context.user_data["awaiting_receipt_upload"] = False
-                    # Clean up temp file
-                    if os.path.exists(temp_path):
-                        os.remove(temp_path)
                     return
 
             
             enrollment_ids_to_update = [e.enrollment_id for e in enrollments_to_update]
             enrollment_ids_str = ', '.join(map(str, enrollment_ids_to_update))
             # ===== STORE RECEIPT METADATA IN DATABASE =====
-            logger.info(f"💾 Storing receipt metadata for enrollments: {enrollment_ids_str}")
+            logger.info("💾 Storing receipt metadata for enrollments: %s", enrollment_ids_str)
             
-            for enrollment_id in enrollment_ids_to_update:
-                metadata_stored = crud.update_enrollment_receipt_metadata(
-                    session,
-                    enrollment_id=enrollment_id,
-                    transaction_id=gemini_result.get("transaction_id"),
-                    transfer_date=gemini_result.get("transfer_datetime"),
-                    sender_name=gemini_result.get("sender_name") or gemini_result.get("recipient_name")
-                )
-                if metadata_stored:
-                    logger.info(f"✅ Metadata stored for enrollment {enrollment_id}")
-                else:
-                    logger.warning(f"⚠️ Failed to store metadata for enrollment {enrollment_id}")
-            
-            session.commit()
-            logger.info(f"💾 Receipt metadata committed to database")
+            metadata_stored = crud.update_enrollments_receipt_metadata(
+                session,
+                enrollment_ids_to_update,
+                transaction_id=gemini_result.get("transaction_id"),
+                transfer_date=gemini_result.get("transfer_datetime"),
+                sender_name=gemini_result.get("sender_name") or gemini_result.get("recipient_name"),
+                receipt_phash=duplicate_image_check.get("image_phash")
+            )
+            if metadata_stored:
+                logger.info("💾 Receipt metadata committed for %s enrollment(s)", metadata_stored)
+            else:
+                logger.warning("⚠️ Failed to store metadata for enrollments: %s", enrollment_ids_str)
         # ==================== FRAUD ACTION: REJECT ====================
         if fraud_analysis["recommendation"] == "REJECT":
-            logger.warning(f"Receipt REJECTED for user {telegram_user_id}: Fraud detected with score {fraud_analysis['fraud_score']}")
+            logger.warning("Receipt REJECTED for user %s: Fraud detected with score %s", telegram_user_id, fraud_analysis['fraud_score'])
+            # Serialize once for every transaction row; JSON stays machine-readable unlike str()
+            fraud_analysis_json = json.dumps(fraud_analysis, default=str, ensure_ascii=False)
             
             # Use a new session since the previous one closed
             with get_db() as session:
-                # Update transaction as rejected with fraud data
-                transaction = None
-                for enrollment_id in enrollment_ids_to_update:
-                    crud.update_enrollment_status(
+                # One UPDATE for all enrollments, one write for the transaction, one commit
+                crud.update_enrollments_status(
+                    session,
+                    enrollment_ids_to_update,
+                    PaymentStatus.FAILED,
+                    receipt_path=file_path,
+                    admin_notes=f"FRAUD DETECTED (Score: {fraud_analysis['fraud_score']}): " + "; ".join(fraud_analysis["fraud_indicators"][:2])
+                )
+                logger.info("Updated enrollments %s status to FAILED (fraud)", enrollment_ids_to_update)
+                
+                # Rejected transaction with fraud data
+                rejected_fields = dict(
+                    extracted_amount=gemini_result.get("amount"),
+                    failure_reason=f"FRAUD DETECTED: " + "; ".join(fraud_analysis["fraud_indicators"]),
+                    gemini_response=fraud_analysis_json,
+                    fraud_score=fraud_analysis['fraud_score'],
+                    fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
+                    receipt_transaction_id=transaction_id,
+                    receipt_transfer_datetime=transfer_datetime,
+                    receipt_sender_name=gemini_result.get('sender_name'),
+                    receipt_amount=gemini_result.get('amount')
+                )
+                if resubmission_enrollment_id:
+                    transaction = crud.get_latest_transaction(session, resubmission_enrollment_id)
+                    
+                    if transaction:
+                        crud.update_transaction(
+                            session,
+                            transaction.transaction_id,
+                            status=TransactionStatus.REJECTED,
+                            receipt_image_path=file_path,
+                            extracted_account=gemini_result.get("account_number"),
+                            **rejected_fields
+                        )
+                elif enrollment_ids_to_update:
+                    crud.create_transaction(
                         session,
-                        enrollment_id,
-                        PaymentStatus.FAILED,
-                        receipt_path=file_path,
-                        admin_notes=f"FRAUD DETECTED (Score: {fraud_analysis['fraud_score']}): " + "; ".join(fraud_analysis["fraud_indicators"][:2])
+                        enrollment_ids_to_update[0],
+                        file_path,
+                        status=TransactionStatus.REJECTED,
+                        extracted_account_number=gemini_result.get("account_number"),
+                        **rejected_fields
                     )
-                    logger.info(f"Updated enrollment {enrollment_id} status to FAILED (fraud)")
-                    
-                    if not transaction:
-                        if resubmission_enrollment_id:
-                            from database.models import Transaction
-                            transaction = session.query(Transaction).filter(
-                                Transaction.enrollment_id == resubmission_enrollment_id
-                            ).order_by(Transaction.submitted_date.desc()).first()
-                            
-                            if transaction:
-                                transaction = crud.update_transaction(
-                                    session,
-                                    transaction.transaction_id,
-                                    status=TransactionStatus.REJECTED,
-                                    receipt_image_path=file_path,
-                                    extracted_account=gemini_result.get("account_number"),
-                                    extracted_amount=gemini_result.get("amount"),
-                                    failure_reason=f"FRAUD DETECTED: " + "; ".join(fraud_analysis["fraud_indicators"]),
-                                    gemini_response=str(fraud_analysis),
-                                    fraud_score=fraud_analysis['fraud_score'],
-                                    fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                    receipt_transaction_id=transaction_id,
-                                    receipt_transfer_datetime=transfer_datetime,
-
-                                    receipt_sender_name=gemini_result.get('sender_name'),
-                                    receipt_amount=gemini_result.get('amount')
-                                )
-                        else:
-                            transaction = crud.create_transaction(session, enrollment_id, file_path)
-                            transaction = crud.update_transaction(
-                                session,
-                                transaction.transaction_id,
-                                status=TransactionStatus.REJECTED,
-                                receipt_image_path=file_path,
-                                extracted_account=gemini_result.get("account_number"),
-                                extracted_amount=gemini_result.get("amount"),
-                                failure_reason=f"FRAUD DETECTED: " + "; ".join(fraud_analysis["fraud_indicators"]),
-                                gemini_response=str(fraud_analysis),
-                                fraud_score=fraud_analysis['fraud_score'],
-                                fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                receipt_transaction_id=transaction_id,
-                                receipt_transfer_datetime=transfer_datetime,
-                                receipt_sender_name=gemini_result.get('sender_name'),
-                                receipt_amount=gemini_result.get('amount')
-                            )
                 
                 session.commit()
 
             
-            # Build detailed rejection message for user
-            rejection_msg = user_message = """
-❌ **لم يتم قبول الإيصال**
-
-عذراً، لم نتمكن من التحقق من الإيصال المرسل.
-
-سيتم مراجعته من قبل الإدارة خلال 24-48 ساعة.
-
-إذا كانت لديك أية استفسارات، يرجى التواصل مع الإدارة.
-
----
-❌ **Receipt Not Accepted**
-
-Sorry, we couldn't verify the submitted receipt.
-
-It will be reviewed by administration within 24-48 hours.
-
-If you have any questions, please contact administration.
-"""
-
-            
-            await update.message.reply_text(rejection_msg, reply_markup=back_to_main_keyboard(), parse_mode='HTML')
-            
-            # Send detailed admin alert with fraud analysis
+            # Build detailed admin alert with fraud analysis
             # Fetch course names using enrollment IDs (session was closed)
-            course_names = []
             with get_db() as session_for_courses:
-                from database.models import Course, Enrollment
-                for enrollment_id in enrollment_ids_to_update:
-                    enrollment = session_for_courses.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
-                    if enrollment and enrollment.course:
-                        course_names.append(enrollment.course.course_name)
+                course_names = [e.course.course_name for e in crud.get_enrollments_by_ids(session_for_courses, enrollment_ids_to_update) if e.course]
             course_names_str = ", ".join(course_names) if course_names else "N/A"
             
-            admin_msg = f"""
+            admin_parts = [f"""
 🚨 <b>FRAUD ALERT - Receipt Auto-Rejected</b>
 
 👤 <b>User Information:</b>
@@ -516,35 +800,33 @@ ID: <code>{telegram_user_id}</code>
 ⚠️ <b>Risk Level: {fraud_analysis.get('risk_level', 'UNKNOWN')}</b>
 
 📊 <b>Fraud Indicators:</b>
-"""
-            for ind in fraud_analysis["fraud_indicators"]:
-                admin_msg += f"- {ind}\n"
+"""]
+            admin_parts.extend(f"- {ind}\n" for ind in fraud_analysis["fraud_indicators"])
             
             # Add duplicate receipt info if detected
             if duplicate_check_result.get("is_duplicate"):
-                admin_msg += f"\n🔄 <b>DUPLICATE RECEIPT DETECTED:</b>\n"
-                admin_msg += f"- Original Owner: {duplicate_image_check.get('original_user_name')} (@{duplicate_image_check.get('original_user_username')})\n"
-                admin_msg += f"- Original User ID: <code>{duplicate_image_check.get('original_telegram_id')}</code>\n"
-                admin_msg += f"- Similarity: {duplicate_check_result['similarity_score']:.1f}%\n"
-                admin_msg += f"- Match Type: {duplicate_image_check.get('match_type')}\n"
-                admin_msg += f"- Risk Level: {duplicate_image_check.get('risk_level')}\n"
-
+                admin_parts.append(
+                    f"\n🔄 <b>DUPLICATE RECEIPT DETECTED:</b>\n"
+                    f"- Original Owner: {duplicate_image_check.get('original_user_name')} (@{duplicate_image_check.get('original_user_username')})\n"
+                    f"- Original User ID: <code>{duplicate_image_check.get('original_telegram_id')}</code>\n"
+                    f"- Similarity: {duplicate_check_result['similarity_score']:.1f}%\n"
+                    f"- Match Type: {duplicate_image_check.get('match_type')}\n"
+                    f"- Risk Level: {duplicate_image_check.get('risk_level')}\n"
+                )
             
             # Add ELA visual analysis if available
             ela_data = fraud_analysis.get("ela_check", {})
             if ela_data.get("suspicious_regions"):
-                admin_msg += f"\n🔍 Suspected Edited Areas:\n"
-                for region in ela_data["suspicious_regions"][:3]:
-                    admin_msg += f"- {region}\n"
+                admin_parts.append("\n🔍 Suspected Edited Areas:\n")
+                admin_parts.extend(f"- {region}\n" for region in ela_data["suspicious_regions"][:3])
             
             # Add Gemini tampering indicators if available
             gemini_tampering = fraud_analysis.get("ai_validation", {}).get("tampering_indicators", [])
             if gemini_tampering:
-                admin_msg += f"\n🤖 AI Detected Issues:\n"
-                for indicator in gemini_tampering[:3]:
-                    admin_msg += f"- {indicator}\n"
+                admin_parts.append("\n🤖 AI Detected Issues:\n")
+                admin_parts.extend(f"- {indicator}\n" for indicator in gemini_tampering[:3])
             
-            admin_msg += f"""
+            admin_parts.append(f"""
 🔍 Checks Performed:
 {fraud_analysis.get('checks_performed', ['Fraud checks completed'])}
 
@@ -558,292 +840,140 @@ ID: <code>{telegram_user_id}</code>
 
 📚 Courses: {course_names_str}
 📝 Enrollment IDs: {enrollment_ids_str}
-"""
+""")
+            admin_msg = "".join(admin_parts)
             
-            try:
-                # If duplicate detected, send BOTH receipts to admin
-                if duplicate_check_result.get("is_duplicate"):
-                    # Download and send ORIGINAL receipt first
-                    original_receipt_path = duplicate_image_check.get("original_receipt_path")
-                    if original_receipt_path:
-                        if original_receipt_path.startswith('https://'):
-                            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as orig_temp:
-                                orig_temp_path = orig_temp.name
-                            download_receipt_from_s3(original_receipt_path, orig_temp_path)
-                            original_photo = orig_temp_path
-                        else:
-                            original_photo = original_receipt_path
-                        
-                        # Send original receipt
-                        with open(original_photo, "rb") as f_orig:
-                            await context.bot.send_photo(
-                                chat_id=config.ADMIN_CHAT_ID,
-                                photo=f_orig,
-                                caption=f"📸 <b>ORIGINAL RECEIPT (FIRST SUBMISSION)</b>\n\nFrom: {duplicate_image_check.get('original_user_name')}\nUsername: @{duplicate_image_check.get('original_user_username')}\nTelegram ID: <code>{duplicate_image_check.get('original_telegram_id')}</code>\n\n⬇️ See next photo for duplicate attempt",
-                                parse_mode='HTML'
-                            )
-                        
-                        # Clean up original temp file
-                        if original_receipt_path.startswith('https://') and os.path.exists(original_photo):
-                            os.remove(original_photo)
-                
-                # Download current (duplicate) receipt from S3 if needed
-                if file_path.startswith('https://'):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as download_temp:
-                        download_temp_path = download_temp.name
-                    download_receipt_from_s3(file_path, download_temp_path)
-                    photo_to_send = download_temp_path
-                else:
-                    photo_to_send = file_path
-                
-                # Send current receipt with fraud alert
-                with open(photo_to_send, "rb") as f:
-                    await context.bot.send_photo(
-                        chat_id=config.ADMIN_CHAT_ID,
-                        photo=f,
-                        caption=admin_msg[:1024],
-                        reply_markup=failed_receipt_admin_keyboard(enrollment_ids_str, telegram_user_id),
-                        parse_mode='HTML'
-                    )
-                
-                # Clean up downloaded temp file
-                if file_path.startswith('https://') and os.path.exists(photo_to_send):
-                    os.remove(photo_to_send)
-                
-                logger.info(f"Sent fraud alert to admin for user {telegram_user_id}")
-            except Exception as e:
-                logger.error(f"Failed to send admin fraud alert: {e}")
-                await send_admin_notification(context, admin_msg[:4096])
+            # Rejection reply and admin alert are independent round-trips - send them together.
+            # If duplicate detected, send BOTH receipts to admin
+            _, alert_sent = await asyncio.gather(
+                update.message.reply_text(RECEIPT_REJECTED_MSG, reply_markup=back_to_main_keyboard(), parse_mode='HTML'),
+                _send_admin_receipt_alert(
+                    context,
+                    file_path,
+                    admin_msg,
+                    reply_markup=failed_receipt_admin_keyboard(enrollment_ids_str, telegram_user_id),
+                    duplicate_info=duplicate_image_check if duplicate_check_result.get("is_duplicate") else None
+                )
+            )
+            if alert_sent:
+                logger.info("Sent fraud alert to admin for user %s", telegram_user_id)
 
             
-            # Clean up context and temp file
-            context.user_data["awaiting_receipt_upload"] = False
-            context.user_data.pop("cart_total_for_payment", None)
-            context.user_data.pop("pending_enrollment_ids_for_payment", None)
-            context.user_data.pop("current_payment_enrollment_ids", None)
-            context.user_data.pop("current_payment_total", None)
-            context.user_data.pop("resubmission_enrollment_id", None)
-            context.user_data.pop("reupload_amount", None)
-            
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            # Clean up context (temp file is removed in finally)
+            _reset_payment_state(context.user_data)
             
             return
         
         # ==================== FRAUD ACTION: MANUAL REVIEW ====================
         elif fraud_analysis["recommendation"] == "MANUAL_REVIEW":
-            logger.warning(f"Receipt flagged for MANUAL REVIEW for user {telegram_user_id}: Score {fraud_analysis['fraud_score']}")
+            logger.warning("Receipt flagged for MANUAL REVIEW for user %s: Score %s", telegram_user_id, fraud_analysis['fraud_score'])
+            # Serialize once for every transaction row; JSON stays machine-readable unlike str()
+            fraud_analysis_json = json.dumps(fraud_analysis, default=str, ensure_ascii=False)
             
             # Use a new session since the previous one closed
             with get_db() as session:
-                # Update as pending review
-                transaction = None
-                for enrollment_id in enrollment_ids_to_update:
-                    crud.update_enrollment_status(
-                        session,
-                        enrollment_id,
-                        PaymentStatus.PENDING,
-                        receipt_path=file_path,
-                        admin_notes=f"MANUAL REVIEW REQUIRED (Score: {fraud_analysis['fraud_score']}): " + "; ".join(fraud_analysis["fraud_indicators"][:2])
-                    )
-                    logger.info(f"Updated enrollment {enrollment_id} status to PENDING (manual review)")
+                # Update as pending review - one UPDATE for all enrollments
+                crud.update_enrollments_status(
+                    session,
+                    enrollment_ids_to_update,
+                    PaymentStatus.PENDING,
+                    receipt_path=file_path,
+                    admin_notes=f"MANUAL REVIEW REQUIRED (Score: {fraud_analysis['fraud_score']}): " + "; ".join(fraud_analysis["fraud_indicators"][:2])
+                )
+                logger.info("Updated enrollments %s status to PENDING (manual review)", enrollment_ids_to_update)
+                
+                review_fields = dict(
+                    extracted_amount=gemini_result.get("amount"),
+                    failure_reason=f"FLAGGED FOR REVIEW: " + "; ".join(fraud_analysis["fraud_indicators"]),
+                    gemini_response=fraud_analysis_json,
+                    fraud_score=fraud_analysis['fraud_score'],
+                    fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
+                    receipt_transaction_id=transaction_id,
+                    receipt_transfer_datetime=transfer_datetime,
+                    receipt_sender_name=gemini_result.get('sender_name'),
+                    receipt_amount=gemini_result.get('amount')
+                )
+                new_transaction_enrollment_ids = enrollment_ids_to_update
+                if resubmission_enrollment_id:
+                    transaction = crud.get_latest_transaction(session, resubmission_enrollment_id)
                     
-                    if not transaction:
-                        if resubmission_enrollment_id:
-                            from database.models import Transaction
-                            transaction = session.query(Transaction).filter(
-                                Transaction.enrollment_id == resubmission_enrollment_id
-                            ).order_by(Transaction.submitted_date.desc()).first()
-                            
-                            if transaction:
-                                transaction = crud.update_transaction(
-                                    session,
-                                    transaction.transaction_id,
-                                    status=TransactionStatus.PENDING,
-                                receipt_image_path=file_path,
-                                extracted_account=gemini_result.get("account_number"),
-                                extracted_amount=gemini_result.get("amount"),
-                                failure_reason=f"FLAGGED FOR REVIEW: " + "; ".join(fraud_analysis["fraud_indicators"]),
-                                gemini_response=str(fraud_analysis),
-                                fraud_score=fraud_analysis['fraud_score'],
-                                fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                receipt_transaction_id=transaction_id,
-                                receipt_transfer_datetime=transfer_datetime,
-                                receipt_sender_name=gemini_result.get('sender_name'),
-                                receipt_amount=gemini_result.get('amount')
-                            )
-                        else:
-                            transaction = crud.create_transaction(session, enrollment_id, file_path)
-                            transaction = crud.update_transaction(
-                                session,
-                                transaction.transaction_id,
-                                status=TransactionStatus.PENDING,
-                                receipt_image_path=file_path,
-                                extracted_account=gemini_result.get("account_number"),
-                                extracted_amount=gemini_result.get("amount"),
-                                failure_reason=f"FLAGGED FOR REVIEW: " + "; ".join(fraud_analysis["fraud_indicators"]),
-                                gemini_response=str(fraud_analysis),
-                                fraud_score=fraud_analysis['fraud_score'],
-                                fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                receipt_transaction_id=transaction_id,
-                                receipt_transfer_datetime=transfer_datetime,
-                                receipt_sender_name=gemini_result.get('sender_name'),
-                                receipt_amount=gemini_result.get('amount')
-                            )
-                    else:
-                        transaction = crud.create_transaction(session, enrollment_id, file_path)
-                        transaction = crud.update_transaction(
+                    # The resubmitted transaction is reused for the first enrollment
+                    if transaction:
+                        crud.update_transaction(
                             session,
                             transaction.transaction_id,
                             status=TransactionStatus.PENDING,
                             receipt_image_path=file_path,
                             extracted_account=gemini_result.get("account_number"),
-                            extracted_amount=gemini_result.get("amount"),
-                            failure_reason=f"FLAGGED FOR REVIEW: " + "; ".join(fraud_analysis["fraud_indicators"]),
-                            gemini_response=str(fraud_analysis),
-                            fraud_score=fraud_analysis['fraud_score'],
-                            fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                            receipt_transaction_id=transaction_id,
-                            receipt_transfer_datetime=transfer_datetime,
-                            receipt_sender_name=gemini_result.get('sender_name'),
-                            receipt_amount=gemini_result.get('amount')
+                            **review_fields
                         )
-
-            
-            session.commit()
-            
-            # Notify user about manual review
-            review_msg = f"""
-        ⏳ **قيد المراجعة**
-        تم استلام الإيصال وسيتم مراجعته من قبل الإدارة.
-        ⏱️ سيتم الرد خلال 24-48 ساعة.
-        شكراً لتفهمك.
-
-        ---
-
-        ⏳ **Under Review**
-        Receipt received and will be reviewed by administration.
-        ⏱️ You will receive a response within 24-48 hours.
-        Thank you for your patience.
-        """
-            await update.message.reply_text(review_msg, reply_markup=back_to_main_keyboard(), parse_mode='HTML')
+                        new_transaction_enrollment_ids = enrollment_ids_to_update[1:]
+                
+                crud.create_transactions(
+                    session,
+                    new_transaction_enrollment_ids,
+                    file_path,
+                    status=TransactionStatus.PENDING,
+                    extracted_account_number=gemini_result.get("account_number"),
+                    **review_fields
+                )
+                
+                session.commit()
             
-            # Send admin notification for manual review
+            # Build admin notification for manual review
             # Fetch course names using enrollment IDs (session was closed)
-            course_names = []
             with get_db() as session_for_courses:
-                from database.models import Course, Enrollment
-                for enrollment_id in enrollment_ids_to_update:
-                    enrollment = session_for_courses.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
-                    if enrollment and enrollment.course:
-                        course_names.append(enrollment.course.course_name)
+                course_names = [e.course.course_name for e in crud.get_enrollments_by_ids(session_for_courses, enrollment_ids_to_update) if e.course]
             course_names_str = ", ".join(course_names) if course_names else "N/A"
             
-            review_admin_msg = f"""
-        ⚠️ <b>MANUAL REVIEW REQUIRED</b>
-
-        👤 <b>User Information:</b>
-        Name: {user.first_name} {user.last_name or ''}
-        Username: @{user.username or 'N/A'}
-        ID: <code>{telegram_user_id}</code>
-
-        🟡 <b>Fraud Score: {fraud_analysis['fraud_score']}/100</b>
-        ⚠️ <b>Risk Level: {fraud_analysis.get('risk_level', 'UNKNOWN')}</b>
-
-        <b>⚠️ Warning Indicators:</b>
-        """
-            
-            for ind in fraud_analysis["fraud_indicators"]:
-                review_admin_msg += f"• {ind}\n"
+            review_parts = [MANUAL_REVIEW_ADMIN_HEADER.format(
+                first_name=user.first_name,
+                last_name=user.last_name or '',
+                username=user.username or 'N/A',
+                telegram_user_id=telegram_user_id,
+                fraud_score=fraud_analysis['fraud_score'],
+                risk_level=fraud_analysis.get('risk_level', 'UNKNOWN')
+            )]
+            review_parts.extend(f"• {ind}\n" for ind in fraud_analysis["fraud_indicators"])
             
             # ADD DUPLICATE DETECTION INFO
             if duplicate_check_result.get('is_duplicate'):
-                review_admin_msg += f"\n<b>🚨 DUPLICATE RECEIPT DETECTED</b>\n"
-                review_admin_msg += f"• <b>Original Owner:</b> {duplicate_image_check.get('original_user_name')} (@{duplicate_image_check.get('original_user_username')})\n"
-                review_admin_msg += f"• <b>Original User ID:</b> <code>{duplicate_image_check.get('original_telegram_id')}</code>\n"
-                review_admin_msg += f"• <b>Similarity:</b> {duplicate_check_result.get('similarity_score', 0):.1f}%\n"
-                review_admin_msg += f"• <b>Match Type:</b> {duplicate_image_check.get('match_type')}\n"
-                review_admin_msg += f"• <b>Risk Level:</b> {duplicate_image_check.get('risk_level')}\n"
-            
-            review_admin_msg += f"""
-        📄 <b>Extracted Data:</b>
-        • Account: {gemini_result.get('account_number', 'N/A')}
-        • Amount: {(gemini_result.get('amount') or 0):.2f} {gemini_result.get('currency', 'SDG')}
-        • Expected: {expected_amount_for_gemini:.2f} SDG
-
-        📚 <b>Courses:</b> {course_names_str}
-        📝 <b>Enrollment IDs:</b> {enrollment_ids_str}
-
-        🔍 <b>Action Required:</b> Please review and approve/reject manually.
-        """
+                review_parts.append(
+                    f"\n<b>🚨 DUPLICATE RECEIPT DETECTED</b>\n"
+                    f"• <b>Original Owner:</b> {duplicate_image_check.get('original_user_name')} (@{duplicate_image_check.get('original_user_username')})\n"
+                    f"• <b>Original User ID:</b> <code>{duplicate_image_check.get('original_telegram_id')}</code>\n"
+                    f"• <b>Similarity:</b> {duplicate_check_result.get('similarity_score', 0):.1f}%\n"
+                    f"• <b>Match Type:</b> {duplicate_image_check.get('match_type')}\n"
+                    f"• <b>Risk Level:</b> {duplicate_image_check.get('risk_level')}\n"
+                )
             
-            try:
-                # If duplicate detected, send BOTH receipts
-                if duplicate_check_result.get("is_duplicate"):
-                    # Download and send ORIGINAL receipt first
-                    original_receipt_path = duplicate_image_check.get("original_receipt_path")
-                    if original_receipt_path:
-                        if original_receipt_path.startswith('https://'):
-                            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as orig_temp:
-                                orig_temp_path = orig_temp.name
-                            download_receipt_from_s3(original_receipt_path, orig_temp_path)
-                            original_photo = orig_temp_path
-                        else:
-                            original_photo = original_receipt_path
-                        
-                        # Send original receipt
-                        with open(original_photo, "rb") as f_orig:
-                            await context.bot.send_photo(
-                                chat_id=config.ADMIN_CHAT_ID,
-                                photo=f_orig,
-                                caption=f"📸 <b>ORIGINAL RECEIPT</b>\n\n👤 Original Owner: {duplicate_image_check.get('original_user_name')}\n🆔 User ID: <code>{duplicate_image_check.get('original_telegram_id')}</code>\n\n⬇️ See next photo for duplicate attempt",
-                                parse_mode='HTML'
-                            )
-                        
-                        # Clean up original temp file
-                        if original_receipt_path.startswith('https://') and os.path.exists(original_photo):
-                            os.remove(original_photo)
-                
-                # Download current (duplicate or normal) receipt from S3 if needed
-                if file_path.startswith('https://'):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as download_temp:
-                        download_temp_path = download_temp.name
-                    download_receipt_from_s3(file_path, download_temp_path)
-                    photo_to_send = download_temp_path
-                else:
-                    photo_to_send = file_path
-                
-                with open(photo_to_send, "rb") as f:
-                    await context.bot.send_photo(
-                        chat_id=config.ADMIN_CHAT_ID,
-                        photo=f,
-                        caption=review_admin_msg[:1024],
-                        reply_markup=failed_receipt_admin_keyboard(enrollment_ids_str, telegram_user_id),
-                        parse_mode='HTML'
-                    )
-                
-                # Clean up downloaded temp file
-                if file_path.startswith('https://') and os.path.exists(photo_to_send):
-                    os.remove(photo_to_send)
-                
-                logger.info(f"Sent manual review request to admin for user {telegram_user_id}")
-            except Exception as e:
-                logger.error(f"Failed to send admin review request: {e}")
-                await send_admin_notification(context, review_admin_msg[:4096])
+            review_parts.append(MANUAL_REVIEW_ADMIN_FOOTER.format(
+                account=gemini_result.get('account_number', 'N/A'),
+                amount=gemini_result.get('amount') or 0,
+                currency=gemini_result.get('currency', 'SDG'),
+                expected=expected_amount_for_gemini,
+                course_names=course_names_str,
+                enrollment_ids=enrollment_ids_str
+            ))
+            review_admin_msg = "".join(review_parts)
             
-            # Clean up context and temp file
-            context.user_data["awaiting_receipt_upload"] = False
-            context.user_data.pop("cart_total_for_payment", None)
-            context.user_data.pop("pending_enrollment_ids_for_payment", None)
-            context.user_data.pop("current_payment_enrollment_ids", None)
-            context.user_data.pop("current_payment_total", None)
-            context.user_data.pop("resubmission_enrollment_id", None)
-            context.user_data.pop("reupload_amount", None)
+            # Notify user about manual review and alert the admin concurrently.
+            # If duplicate detected, send BOTH receipts
+            _, alert_sent = await asyncio.gather(
+                update.message.reply_text(RECEIPT_UNDER_REVIEW_MSG, reply_markup=back_to_main_keyboard(), parse_mode='HTML'),
+                _send_admin_receipt_alert(
+                    context,
+                    file_path,
+                    review_admin_msg,
+                    reply_markup=failed_receipt_admin_keyboard(enrollment_ids_str, telegram_user_id),
+                    duplicate_info=duplicate_image_check if duplicate_check_result.get("is_duplicate") else None
+                )
+            )
+            if alert_sent:
+                logger.info("Sent manual review request to admin for user %s", telegram_user_id)
             
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            # Clean up context (temp file is removed in finally)
+            _reset_payment_state(context.user_data)
             
             return
         
@@ -857,28 +987,21 @@ ID: <code>{telegram_user_id}</code>
         if result["is_valid"] and extracted_amount < (expected_amount_for_gemini - 5):
             # PARTIAL PAYMENT DETECTED
             remaining_total = expected_amount_for_gemini - extracted_amount
-            logger.info(f"⚠️ Partial payment detected for user {telegram_user_id}: paid {extracted_amount:.0f}, expected {expected_amount_for_gemini:.0f}, remaining {remaining_total:.0f}")
-            
-            # Get course names for notifications (need new session)
-            course_names = []
-            with get_db() as session_for_courses:
-                from database.models import Course, Enrollment
-                for enrollment_id in enrollment_ids_to_update:
-                    enrollment = session_for_courses.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
-                    if enrollment and enrollment.course:
-                        course_names.append(enrollment.course.course_name)
-            course_names_str = ", ".join(course_names) if course_names else "N/A"
+            logger.info("⚠️ Partial payment detected for user %s: paid %.0f, expected %.0f, remaining %.0f", telegram_user_id, extracted_amount, expected_amount_for_gemini, remaining_total)
             
             # ✅ CALCULATE REMAINING BALANCE FOR EACH ENROLLMENT AND DISTRIBUTE PAYMENT
-            # Use a new session for partial payment processing
+            # One session and one query (courses eager-loaded) serve the update, the
+            # verification check and the notification texts below
             with get_db() as session:
-                from database.models import Enrollment
                 enrollment_remaining_balances = []
                 total_remaining_needed = 0
                 
-                # Fetch enrollments fresh from database
+                # Fetch enrollments fresh from database, keeping the cart order
+                enrollments_by_id = {e.enrollment_id: e for e in crud.get_enrollments_by_ids(session, enrollment_ids_to_update)}
+                course_names = [e.course.course_name for e in enrollments_by_id.values() if e.course]
+                course_names_str = ", ".join(course_names) if course_names else "N/A"
                 for enrollment_id in enrollment_ids_to_update:
-                    enrollment = session.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
+                    enrollment = enrollments_by_id.get(enrollment_id)
                     if enrollment:
                         current_paid = enrollment.amount_paid or 0
                         remaining_for_this = enrollment.payment_amount - current_paid
@@ -889,25 +1012,14 @@ ID: <code>{telegram_user_id}</code>
                         })
                         total_remaining_needed += remaining_for_this
                 
-                logger.info(f"Total remaining needed across all enrollments: {total_remaining_needed:.2f}")
+                logger.info("Total remaining needed across all enrollments: %.2f", total_remaining_needed)
                 
                 # ✅ DISTRIBUTE PAYMENT PROPORTIONALLY ACROSS ENROLLMENTS
-                remaining_to_distribute = extracted_amount
+                # All shares are computed up front; the loop only applies them
+                shares = _split_payment(extracted_amount, [item['remaining'] for item in enrollment_remaining_balances])
                 
-                # Fix: Remove nested loop - iterate only once
-                for idx, item in enumerate(enrollment_remaining_balances):
+                for item, amount_for_this_enrollment in zip(enrollment_remaining_balances, shares):
                     enrollment = item['enrollment']
-                    enrollment_id = item['enrollment_id']
-                    enrollment_remaining = item['remaining']
-                    
-                    # Calculate proportional amount
-                    if idx == len(enrollment_remaining_balances) - 1:
-                        # Last enrollment gets the remainder to avoid rounding errors
-                        amount_for_this_enrollment = remaining_to_distribute
-                    else:
-                        proportion = enrollment_remaining / total_remaining_needed
-                        amount_for_this_enrollment = extracted_amount * proportion
-                        remaining_to_distribute -= amount_for_this_enrollment
                     
                     # ✅ Update amount_paid by adding the new payment
                     current_paid = enrollment.amount_paid or 0
@@ -917,156 +1029,103 @@ ID: <code>{telegram_user_id}</code>
                     if enrollment.amount_paid >= enrollment.payment_amount:
                         enrollment.payment_status = PaymentStatus.VERIFIED
                         enrollment.verification_date = datetime.now()
-                        logger.info(f"✅ Full payment reached for enrollment {enrollment.enrollment_id}")
+                        logger.info("✅ Full payment reached for enrollment %s", enrollment.enrollment_id)
                     else:
                         enrollment.payment_status = PaymentStatus.PENDING
-                        logger.info(f"⚠️ Still partial for enrollment {enrollment.enrollment_id}: {enrollment.amount_paid:.2f}/{enrollment.payment_amount:.2f}")
+                        logger.info("⚠️ Still partial for enrollment %s: %.2f/%.2f", enrollment.enrollment_id, enrollment.amount_paid, enrollment.payment_amount)
                     
-                    # Store receipt path (append if exists)
+                    # Store receipt path (append if exists); compare whole paths so
+                    # receipts/1.jpg isn't mistaken for part of receipts/10.jpg
                     existing_receipts = enrollment.receipt_image_path
                     if existing_receipts:
-                        enrollment.receipt_image_path = existing_receipts + "," + file_path
+                        if file_path not in set(filter(None, existing_receipts.split(","))):
+                            enrollment.receipt_image_path = existing_receipts + "," + file_path
                     else:
                         enrollment.receipt_image_path = file_path
                     
-                    logger.info(f"📝 Updated enrollment {enrollment.enrollment_id}: amount_paid={enrollment.amount_paid:.2f} (added {amount_for_this_enrollment:.2f})")
+                    logger.info("📝 Updated enrollment %s: amount_paid=%.2f (added %.2f)", enrollment.enrollment_id, enrollment.amount_paid, amount_for_this_enrollment)
                 
                 # Create/update transaction within the same session
+                tx_fields = dict(
+                    extracted_amount=extracted_amount,
+                    failure_reason=f"Partial payment: {extracted_amount:.0f}/{expected_amount_for_gemini:.0f} SDG. Remaining: {remaining_total:.0f} SDG",
+                    gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
+                    fraud_score=fraud_analysis['fraud_score'],
+                    fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
+                    receipt_transaction_id=transaction_id,
+                    receipt_transfer_datetime=transfer_datetime,
+                    receipt_sender_name=gemini_result.get('sender_name'),
+                    receipt_amount=extracted_amount
+                )
                 transaction = None
                 if resubmission_enrollment_id:
-                    from database.models import Transaction
-                    transaction = session.query(Transaction).filter(
-                        Transaction.enrollment_id == resubmission_enrollment_id
-                    ).order_by(Transaction.submitted_date.desc()).first()
+                    transaction = crud.get_latest_transaction(session, resubmission_enrollment_id)
+                
+                if transaction:
+                    transaction = crud.update_transaction(
+                        session,
+                        transaction.transaction_id,
+                        status=TransactionStatus.PENDING,
+                        receipt_image_path=file_path,
+                        extracted_account=result.get("account_number"),
+                        **tx_fields
+                    )
+                elif enrollment_ids_to_update:
+                    # Otherwise use first enrollment ID for transaction - one INSERT with all fields
+                    transaction = crud.create_transaction(
+                        session,
+                        enrollment_ids_to_update[0],
+                        file_path,
+                        status=TransactionStatus.PENDING,
+                        extracted_account_number=result.get("account_number"),
+                        **tx_fields
+                    )
+                
+                # ✅ CHECK IF ALL ENROLLMENTS ARE VERIFIED and build the per-course breakdown
+                # from the updated objects, before commit expires them
+                all_verified = all(e.payment_status == PaymentStatus.VERIFIED for e in enrollments_by_id.values())
+                verified_course_ids = [e.course.course_id for e in enrollments_by_id.values() if e.course]
+                breakdown_lines = []
+                for item in enrollment_remaining_balances:
+                    enrollment = item['enrollment']
+                    course_name = enrollment.course.course_name if enrollment.course else "Unknown"
+                    current_paid = enrollment.amount_paid or 0
+                    total_price = enrollment.payment_amount
+                    remaining = total_price - current_paid
                     
-                    if transaction:
-                        transaction = crud.update_transaction(
-                            session,
-                            transaction.transaction_id,
-                            status=TransactionStatus.PENDING,
-                            receipt_image_path=file_path,
-                            extracted_account=result.get("account_number"),
-                            extracted_amount=extracted_amount,
-                            failure_reason=f"Partial payment: {extracted_amount:.0f}/{expected_amount_for_gemini:.0f} SDG. Remaining: {remaining_total:.0f} SDG",
-                            gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
-                            fraud_score=fraud_analysis['fraud_score'],
-                            fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                            receipt_transaction_id=transaction_id,
-                            receipt_transfer_datetime=transfer_datetime,
-                            receipt_sender_name=gemini_result.get('sender_name'),
-                            receipt_amount=extracted_amount
-                        )
-                    else:
-                        # Use first enrollment ID for transaction
-                        first_enrollment_id = enrollment_ids_to_update[0] if enrollment_ids_to_update else None
-                        if first_enrollment_id:
-                            transaction = crud.create_transaction(session, first_enrollment_id, file_path)
-                            transaction = crud.update_transaction(
-                                session,
-                                transaction.transaction_id,
-                                status=TransactionStatus.PENDING,
-                                receipt_image_path=file_path,
-                                extracted_account=result.get("account_number"),
-                                extracted_amount=extracted_amount,
-                                failure_reason=f"Partial payment: {extracted_amount:.0f}/{expected_amount_for_gemini:.0f} SDG. Remaining: {remaining_total:.0f} SDG",
-                                gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
-                                fraud_score=fraud_analysis['fraud_score'],
-                                fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                receipt_transaction_id=transaction_id,
-                                receipt_transfer_datetime=transfer_datetime,
-                                receipt_sender_name=gemini_result.get('sender_name'),
-                                receipt_amount=extracted_amount
-                            )
-                else:
-                    # Use first enrollment ID for transaction
-                    first_enrollment_id = enrollment_ids_to_update[0] if enrollment_ids_to_update else None
-                    if first_enrollment_id:
-                        transaction = crud.create_transaction(session, first_enrollment_id, file_path)
-                        if transaction:
-                            transaction = crud.update_transaction(
-                                session,
-                                transaction.transaction_id,
-                                status=TransactionStatus.PENDING,
-                                receipt_image_path=file_path,
-                                extracted_account=result.get("account_number"),
-                                extracted_amount=extracted_amount,
-                                failure_reason=f"Partial payment: {extracted_amount:.0f}/{expected_amount_for_gemini:.0f} SDG. Remaining: {remaining_total:.0f} SDG",
-                                gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
-                                fraud_score=fraud_analysis['fraud_score'],
-                                fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                receipt_transaction_id=transaction_id,
-                                receipt_transfer_datetime=transfer_datetime,
-                                receipt_sender_name=gemini_result.get('sender_name'),
-                                receipt_amount=extracted_amount
-                            )
+                    status_text = f" (متبقي: {remaining:.0f})\n" if remaining > 0 else " ✅ مكتمل\n"
+                    breakdown_lines.append(f"• {course_name}: {current_paid:.0f}/{total_price:.0f} SDG{status_text}")
                 
-                # ✅ COMMIT CHANGES BEFORE CHECKING - MUST BE INSIDE SESSION CONTEXT
+                # ✅ COMMIT CHANGES - MUST BE INSIDE SESSION CONTEXT
                 session.commit()
-                logger.info(f"💾 Committed all {len(enrollment_remaining_balances)} enrollment updates and transaction to database")
+                logger.info("💾 Committed all %s enrollment updates and transaction to database", len(enrollment_remaining_balances))
             
-            # ✅ NOW CHECK IF ALL ENROLLMENTS ARE VERIFIED
-            enrollment_ids = enrollment_ids_to_update  # ← ADD THIS LINE - use IDs from earlier, not detached objects
-            with get_db() as new_session:
-                verified_enrollments = new_session.query(Enrollment).filter(
-                    Enrollment.enrollment_id.in_(enrollment_ids)
-                ).all()
-                
-                all_verified = all(e.payment_status == PaymentStatus.VERIFIED for e in verified_enrollments)
             if all_verified:
-                logger.info(f"✅ Payment completed for user {telegram_user_id}")
+                logger.info("✅ Payment completed for user %s", telegram_user_id)
                 
                 # Send SUCCESS message FIRST
                 success_msg = "✅ تم التحقق من الإيصال وإضافة المبلغ!\n📊 تم تفعيل التسجيل في الدورات"
                 await update.message.reply_text(success_msg, parse_mode='Markdown', reply_markup=back_to_main_keyboard())
                 
                 # THEN send group invites
-                from handlers.group_registration import send_course_invite_link
-                for e in enrollments_to_update:
-                    if e.course:
-                        await send_course_invite_link(update, context, telegram_user_id, e.course.course_id)
+                await _send_course_invites(update, context, telegram_user_id, verified_course_ids)
                 # Clean up context
-                context.user_data["awaiting_receipt_upload"] = False
-                context.user_data.pop("cart_total_for_payment", None)
-                context.user_data.pop("pending_enrollment_ids_for_payment", None)
-                context.user_data.pop("current_payment_enrollment_ids", None)
-                context.user_data.pop("current_payment_total", None)
-                context.user_data.pop("resubmission_enrollment_id", None)
-                context.user_data.pop("reupload_amount", None)
-                
-                # Clean up temp file
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
+                _reset_payment_state(context.user_data)
                 
                 return  # Exit - payment complete!
             
             # ELSE: Still partial - send partial payment notification with breakdown
-            partial_message = (
+            partial_parts = [
                 f"⚠️ **المبلغ المدفوع ناقص**\n"
                 f"💰 **المبلغ المدفوع:** {extracted_amount:.0f} SDG\n"
                 f"✅ تم التحقق من الإيصال وإضافة المبلغ\n\n"
                 f"📊 **توزيع الدفع:**\n"
-            )
+            ]
             
             # Show breakdown for each course
-            # Fetch course names from database (enrollment_remaining_balances has enrollments from closed session)
-            with get_db() as session_for_courses:
-                from database.models import Course, Enrollment
-                for item in enrollment_remaining_balances:
-                    enrollment_id = item['enrollment_id']
-                    enrollment = session_for_courses.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
-                    if enrollment:
-                        course_name = enrollment.course.course_name if enrollment.course else "Unknown"
-                        current_paid = enrollment.amount_paid or 0
-                        total_price = enrollment.payment_amount
-                        remaining = total_price - current_paid
-                        
-                        partial_message += f"• {course_name}: {current_paid:.0f}/{total_price:.0f} SDG"
-                        if remaining > 0:
-                            partial_message += f" (متبقي: {remaining:.0f})\n"
-                        else:
-                            partial_message += f" ✅ مكتمل\n"
+            partial_parts.extend(breakdown_lines)
             
-            partial_message += (
+            partial_parts.append(
                 f"\n📊 **المبلغ المطلوب الكلي:** {expected_amount_for_gemini:.0f} SDG\n"
                 f"⚠️ **المبلغ المتبقي:** {remaining_total:.0f} SDG\n\n"
                 f"1️⃣ اذهب إلى **دوراتي** من القائمة الرئيسية\n"
@@ -1075,224 +1134,146 @@ ID: <code>{telegram_user_id}</code>
                 f"✅ سيتم تفعيل التسجيل تلقائياً عند استلام المبلغ الكامل\n"
                 f"📝 يمكنك الدفع على دفعات متعددة - كل دفعة تُضاف للسابقة"
             )
+            partial_message = "".join(partial_parts)
             
-            await update.message.reply_text(
-                partial_message,
-                reply_markup=back_to_main_keyboard(),
-                parse_mode='Markdown'
+            # Admin notification
+            admin_partial_msg = PARTIAL_PAYMENT_ADMIN_MSG.format(
+                first_name=user.first_name,
+                last_name=user.last_name or '',
+                telegram_user_id=telegram_user_id,
+                paid=extracted_amount,
+                required=expected_amount_for_gemini,
+                remaining=remaining_total,
+                course_names=course_names_str,
+                enrollment_ids=enrollment_ids_str,
+                account=result.get('account_number'),
+                fraud_score=fraud_analysis['fraud_score']
             )
-            context.user_data["awaiting_receipt_upload"] = True
-            context.user_data["current_payment_enrollment_ids"] = enrollment_ids_str
-            context.user_data["current_payment_total"] = remaining_total
-            context.user_data["partial_payment_mode"] = True  # NEW FLAG
-
-            logger.info(f"Set up immediate receipt listening for partial payment - user {telegram_user_id}, remaining: {remaining_total:.0f}")
-            # Send admin notification
-            admin_partial_msg = f"""
-        ⚠️ PARTIAL PAYMENT RECEIVED
-
-        👤 User: {user.first_name} {user.last_name or ''}
-        🆔 ID: {telegram_user_id}
-
-        💰 Paid: {extracted_amount:.0f} SDG
-        📊 Required: {expected_amount_for_gemini:.0f} SDG
-        ⚠️ Remaining: {remaining_total:.0f} SDG
-
-        📚 Courses: {course_names_str}
-        📝 Enrollment IDs: {enrollment_ids_str}
-
-        ✅ Account verified: {result.get('account_number')}
-        🟢 Fraud score: {fraud_analysis['fraud_score']}/100
-
-        ⏳ Waiting for remaining payment...
-        """
             
-            try:
-                # Download from S3 if needed
-                if file_path.startswith('https://'):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as download_temp:
-                        download_temp_path = download_temp.name
-                    download_receipt_from_s3(file_path, download_temp_path)
-                    photo_to_send = download_temp_path
-                else:
-                    photo_to_send = file_path
-                
-                with open(photo_to_send, "rb") as f:
-                    await context.bot.send_photo(
-                        chat_id=config.ADMIN_CHAT_ID,
-                        photo=f,
+            async def notify_admin_partial():
+                try:
+                    # Load receipt (S3 via receipt cache, or local fallback) and remember its file_id
+                    await _send_admin_receipt_photo(
+                        context,
+                        file_path,
                         caption=admin_partial_msg[:1024],
                         parse_mode='HTML'
                     )
-                
-                if file_path.startswith('https://') and os.path.exists(photo_to_send):
-                    os.remove(photo_to_send)
-            except Exception as e:
-                logger.error(f"Failed to send admin notification: {e}")
+                except Exception as e:
+                    logger.error("Failed to send admin notification: %s", e)
+            
+            # User reply and admin notification don't depend on each other - send them together
+            await asyncio.gather(
+                update.message.reply_text(
+                    partial_message,
+                    reply_markup=back_to_main_keyboard(),
+                    parse_mode='Markdown'
+                ),
+                notify_admin_partial()
+            )
+            context.user_data["partial_payment_mode"] = True  # NEW FLAG
             
             # ✅ KEEP CONTEXT ALIVE for immediate next receipt
             context.user_data["awaiting_receipt_upload"] = True  # KEEP TRUE
             context.user_data["current_payment_enrollment_ids"] = enrollment_ids_str
             context.user_data["current_payment_total"] = remaining_total
             # Don't clear these - keep them for next receipt
-            logger.info(f"Set up immediate receipt listening for partial payment - user {telegram_user_id}, remaining: {remaining_total:.0f}")
+            logger.info("Set up immediate receipt listening for partial payment - user %s, remaining: %.0f", telegram_user_id, remaining_total)
 
-            # Clean up temp file
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
             return  # ✅ STOP HERE for partial payment
         
         # ✅ CONTINUE WITH FULL PAYMENT (existing logic)
         # Use a new session since the previous one closed
         with get_db() as session:
-            from database.models import Enrollment
-            transaction = None
-            for enrollment_id in enrollment_ids_to_update:
-                enrollment = session.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
-                if not enrollment:
-                    continue
-                    
-                payment_status = PaymentStatus.VERIFIED if result["is_valid"] else PaymentStatus.FAILED
-                
-                # ✅ If verified, set amount_paid to full amount
-                if result["is_valid"]:
-                    enrollment.amount_paid = enrollment.payment_amount
-                
-                # ✅ APPEND RECEIPT PATH (don't overwrite)
-                existing_receipts = enrollment.receipt_image_path
-                if existing_receipts:
-                    new_receipt_path = existing_receipts + "," + file_path
-                else:
-                    new_receipt_path = file_path
-                
-                crud.update_enrollment_status(
-                    session,
-                    enrollment_id,
-                    payment_status,
-                    receipt_path=new_receipt_path,  # ✅ USE APPENDED PATH
-                    admin_notes=result.get("reason") if not result["is_valid"] else f"Fraud score: {fraud_analysis['fraud_score']}"
+            # One IN query (courses eager-loaded) serves the update, the invites and the admin caption
+            enrollments_by_id = {e.enrollment_id: e for e in crud.get_enrollments_by_ids(session, enrollment_ids_to_update)}
+            
+            # One UPDATE for every enrollment: status, notes, full amount when verified,
+            # and this receipt appended (not overwritten) to each row's receipt list
+            crud.update_enrollments_status(
+                session,
+                list(enrollments_by_id),
+                PaymentStatus.VERIFIED if result["is_valid"] else PaymentStatus.FAILED,
+                receipt_path=file_path,
+                admin_notes=result.get("reason") if not result["is_valid"] else f"Fraud score: {fraud_analysis['fraud_score']}",
+                append_receipt_path=True,
+                mark_fully_paid=result["is_valid"]
+            )
+            logger.info("📝 Appended receipt %s to enrollments %s", file_path, list(enrollments_by_id))
+            
+            # One transaction per receipt: reuse the resubmitted one, else attach it to the first enrollment
+            first_enrollment_id = next((eid for eid in enrollment_ids_to_update if eid in enrollments_by_id), None)
+            if first_enrollment_id is not None:
+                tx_status = TransactionStatus.APPROVED if result["is_valid"] else TransactionStatus.REJECTED
+                tx_fields = dict(
+                    extracted_amount=result.get("amount"),
+                    failure_reason=result.get("reason", ""),
+                    gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
+                    fraud_score=fraud_analysis['fraud_score'],
+                    fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
+                    receipt_transaction_id=transaction_id,
+                    receipt_transfer_datetime=transfer_datetime,
+                    receipt_sender_name=gemini_result.get('sender_name'),
+                    receipt_amount=result.get('amount')
                 )
+                transaction = None
+                if resubmission_enrollment_id:
+                    transaction = crud.get_latest_transaction(session, resubmission_enrollment_id)
                 
-                logger.info(f"📝 Updated receipt path for enrollment {enrollment_id}: {new_receipt_path}")
-                
-                if not transaction:
-                    if resubmission_enrollment_id:
-                        from database.models import Transaction
-                        transaction = session.query(Transaction).filter(
-                            Transaction.enrollment_id == resubmission_enrollment_id
-                        ).order_by(Transaction.submitted_date.desc()).first()
-                        
-                        if transaction:
-                            transaction = crud.update_transaction(
-                                session,
-                                transaction.transaction_id,
-                                status=TransactionStatus.APPROVED if result["is_valid"] else TransactionStatus.REJECTED,
-                                receipt_image_path=file_path,
-                                extracted_account=result.get("account_number"),
-                                extracted_amount=result.get("amount"),
-                                failure_reason=result.get("reason", ""),
-                                gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
-                                fraud_score=fraud_analysis['fraud_score'],
-                                fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                receipt_transaction_id=transaction_id,
-                                receipt_transfer_datetime=transfer_datetime,
-                                receipt_sender_name=gemini_result.get('sender_name'),
-                                receipt_amount=result.get('amount')
-                            )
-                            logger.info(f"Updated transaction {transaction.transaction_id}")
-                        else:
-                            transaction = crud.create_transaction(session, enrollment_id, file_path)
-                            transaction = crud.update_transaction(
-                                session,
-                                transaction.transaction_id,
-                                status=TransactionStatus.APPROVED if result["is_valid"] else TransactionStatus.REJECTED,
-                                receipt_image_path=file_path,
-                                extracted_account=result.get("account_number"),
-                                extracted_amount=result.get("amount"),
-                                failure_reason=result.get("reason", ""),
-                                gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
-                                fraud_score=fraud_analysis['fraud_score'],
-                                fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                                receipt_transaction_id=transaction_id,
-                                receipt_transfer_datetime=transfer_datetime,
-                                receipt_sender_name=gemini_result.get('sender_name'),
-                                receipt_amount=result.get('amount')
-                            )
-                            logger.info(f"Created new transaction {transaction.transaction_id}")
-                    else:
-                        transaction = crud.create_transaction(session, enrollment_id, file_path)
-                        transaction = crud.update_transaction(
-                            session,
-                            transaction.transaction_id,
-                            status=TransactionStatus.APPROVED if result["is_valid"] else TransactionStatus.REJECTED,
-                            receipt_image_path=file_path,
-                            extracted_account=result.get("account_number"),
-                            extracted_amount=result.get("amount"),
-                            failure_reason=result.get("reason", ""),
-                            gemini_response=(result.get("raw_response") or "") + f"\n\nFraud Score: {fraud_analysis['fraud_score']}",
-                            fraud_score=fraud_analysis['fraud_score'],
-                            fraud_indicators=", ".join(fraud_analysis.get('fraud_indicators', [])),
-                            receipt_transaction_id=transaction_id,
-                            receipt_transfer_datetime=transfer_datetime,
-                            receipt_sender_name=gemini_result.get('sender_name'),
-                            receipt_amount=result.get('amount')
-                        )
-                        logger.info(f"Created transaction {transaction.transaction_id}")
-                
-                session.commit()
-
-        if result["is_valid"]:
-            # Fetch enrollments fresh from database for course invites
-            course_data_list = []
-            group_links_list = []
+                if transaction:
+                    crud.update_transaction(
+                        session,
+                        transaction.transaction_id,
+                        status=tx_status,
+                        receipt_image_path=file_path,
+                        extracted_account=result.get("account_number"),
+                        **tx_fields
+                    )
+                    logger.info("Updated transaction %s", transaction.transaction_id)
+                else:
+                    transaction = crud.create_transaction(
+                        session,
+                        first_enrollment_id,
+                        file_path,
+                        status=tx_status,
+                        extracted_account_number=result.get("account_number"),
+                        **tx_fields
+                    )
+                    logger.info("Created transaction %s", transaction.transaction_id)
             
-            # Import the group invitation function
-            from handlers.group_registration import send_course_invite_link
+            # Extract course data while still in session (commit expires the objects)
+            enrolled_courses = [enrollments_by_id[eid] for eid in enrollment_ids_to_update if eid in enrollments_by_id]
+            invite_course_ids = [e.course.course_id for e in enrolled_courses if e.course] if result["is_valid"] else []
+            course_names = [e.course.course_name for e in enrolled_courses if e.course]
             
-            with get_db() as session_for_invites:
-                from database.models import Enrollment
-                for enrollment_id in enrollment_ids_to_update:
-                    enrollment = session_for_invites.query(Enrollment).filter(Enrollment.enrollment_id == enrollment_id).first()
-                    if enrollment and enrollment.payment_status == PaymentStatus.VERIFIED:
-                        course = enrollment.course
-                        if course:
-                            # Extract data immediately while in session
-                            course_data_list.append({
-                                'course_id': course.course_id,
-                                'course_name': course.course_name
-                            })
-                            
-                            # Send course group invite link (auto-fetches if missing)
-                            await send_course_invite_link(update, context, telegram_user_id, course.course_id)
-                            
-                            # Also keep for backwards compatibility in success message
-                            if course.telegram_group_link:
-                                group_links_list.append(course.telegram_group_link)
+            # Clear cart if not a resubmission (same transaction as the verification)
+            if result["is_valid"] and not resubmission_enrollment_id:
+                crud.clear_user_cart(session, internal_user_id)
+                logger.info("Cleared cart for user %s", telegram_user_id)
             
-            # Clear cart if not a resubmission
-            if not resubmission_enrollment_id:
-                with get_db() as session_for_cart:
-                    crud.clear_user_cart(session_for_cart, internal_user_id)
-                    logger.info(f"Cleared cart for user {telegram_user_id}")
+            session.commit()
+
+        if result["is_valid"]:
+            # Send course group invite links (auto-fetches if missing)
+            await _send_course_invites(update, context, telegram_user_id, invite_course_ids)
     
         # ==================== USER NOTIFICATIONS ====================
     
         if result["is_valid"]:
-            logger.info(f"Payment SUCCESS for user {telegram_user_id}, enrollments: {enrollment_ids_str}, Fraud Score: {fraud_analysis['fraud_score']}")
+            logger.info("Payment SUCCESS for user %s, enrollments: %s, Fraud Score: %s", telegram_user_id, enrollment_ids_str, fraud_analysis['fraud_score'])
             
             # ✅ DELETE PROCESSING MESSAGE FIRST
             try:
                 if update.message:
                     await update.message.delete()
             except Exception as e:
-                logger.warning(f"Could not delete processing message: {e}")
+                logger.warning("Could not delete processing message: %s", e)
             
             # ✅ NO redundant success message - send_course_invite_link already sent the success message with group link
             
             log_user_action(telegram_user_id, "payment_success", f"enrollment_ids={enrollment_ids_str}, fraud_score={fraud_analysis['fraud_score']}")
         else:
-            logger.warning(f"Payment FAILED for user {telegram_user_id}: {result.get('reason')}, Fraud Score: {fraud_analysis['fraud_score']}")
+            logger.warning("Payment FAILED for user %s: %s, Fraud Score: %s", telegram_user_id, result.get('reason'), fraud_analysis['fraud_score'])
             
             # ✅ Only send admin notification when validation FAILED (not for successful validations)
             # Send admin notification with receipt image
@@ -1300,95 +1281,114 @@ ID: <code>{telegram_user_id}</code>
             extracted_amount = result.get('amount', 0)
             extracted_currency = result.get('currency', 'SDG')
             
-            # Get course names for admin notification
-            course_names = []
-            with get_db() as temp_session:
-                for eid in enrollment_ids_to_update:
-                    enrollment = crud.get_enrollment_by_id(temp_session, eid)
-                    if enrollment and enrollment.course:
-                        course_names.append(enrollment.course.course_name)
+            # Course names for admin notification (collected in the update session)
             course_names_str = ", ".join(course_names) if course_names else "N/A"
             
-            admin_caption = f"""
-🔴 Receipt Validation Failed
-
-👤 User: {user.first_name} {user.last_name or ''}
-Username: @{user.username or 'N/A'}
-ID: {telegram_user_id}
-
-📄 Extracted Data:
-• Account: {extracted_account}
-• Amount: {gemini_result.get('amount') or 0:.2f} {gemini_result.get('currency', 'SDG')}
-• Expected: {expected_amount_for_gemini:.2f} SDG
-
-🟢 Fraud Score: {fraud_analysis['fraud_score']}/100 (LOW RISK)
-
-❌ Validation Issue:
-{result.get('reason', 'Validation failed')[:150]}...
-
-📚 Courses: {course_names_str}
-📝 Enrollment IDs: {enrollment_ids_str}
-
-⚠️ Action Required: Manual review recommended
-"""
+            admin_caption = FAILED_RECEIPT_ADMIN_CAPTION.format(
+                first_name=user.first_name,
+                last_name=user.last_name or '',
+                username=user.username or 'N/A',
+                telegram_user_id=telegram_user_id,
+                account=extracted_account,
+                amount=gemini_result.get('amount') or 0,
+                currency=gemini_result.get('currency', 'SDG'),
+                expected=expected_amount_for_gemini,
+                fraud_score=fraud_analysis['fraud_score'],
+                reason=result.get('reason', 'Validation failed')[:150],
+                course_names=course_names_str,
+                enrollment_ids=enrollment_ids_str
+            )
             
             try:
-                # Download from S3 if needed
-                if file_path.startswith('https://'):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as download_temp:
-                        download_temp_path = download_temp.name
-                    download_receipt_from_s3(file_path, download_temp_path)
-                    photo_to_send = download_temp_path
-                else:
-                    photo_to_send = file_path
-                
-                with open(photo_to_send, "rb") as f:
-                    await context.bot.send_photo(
-                        chat_id=config.ADMIN_CHAT_ID,
-                        photo=f,
-                        caption=admin_caption,
-                        reply_markup=failed_receipt_admin_keyboard(enrollment_ids_str, telegram_user_id),
-                        parse_mode='HTML'
-                    )
-                
-                # Clean up downloaded temp file
-                if file_path.startswith('https://') and os.path.exists(photo_to_send):
-                    os.remove(photo_to_send)
+                # Load receipt (S3 via receipt cache, or local fallback) and remember its file_id
+                await _send_admin_receipt_photo(
+                    context,
+                    file_path,
+                    caption=admin_caption,
+                    reply_markup=failed_receipt_admin_keyboard(enrollment_ids_str, telegram_user_id),
+                    parse_mode='HTML'
+                )
                 
-                logger.info(f"Sent admin notification with image for user {telegram_user_id}")
+                logger.info("Sent admin notification with image for user %s", telegram_user_id)
             except Exception as e:
-                logger.error(f"Failed to send admin notification for user {telegram_user_id}: {e}")
+                logger.error("Failed to send admin notification for user %s: %s", telegram_user_id, e)
                 await send_admin_notification(
                     context,
                     f"Receipt validation failed for user {telegram_user_id}. File: {file_path}"
                 )
     
     except Exception as e:
-        logger.error(f"Error processing receipt for user {telegram_user_id}: {e}", exc_info=True)
+        logger.error("Error processing receipt for user %s: %s", telegram_user_id, e, exc_info=True)
         try:
             await update.message.reply_text(
                 error_message("processing_error"),
                 reply_markup=back_to_main_keyboard()
             )
         except Exception as reply_error:
-            logger.error(f"Failed to send error message to user {telegram_user_id}: {reply_error}")
+            logger.error("Failed to send error message to user %s: %s", telegram_user_id, reply_error)
     finally:
         # Clean up context data
-        context.user_data["awaiting_receipt_upload"] = False
-        context.user_data.pop("cart_total_for_payment", None)
-        context.user_data.pop("pending_enrollment_ids_for_payment", None)
-        context.user_data.pop("current_payment_enrollment_ids", None)
-        context.user_data.pop("current_payment_total", None)
-        context.user_data.pop("resubmission_enrollment_id", None)
-        context.user_data.pop("reupload_amount", None)
+        _reset_payment_state(context.user_data)
+        
+        # The transaction (if any) is committed by now, so the duplicate-ID check sees it
+        if claimed_transaction_id:
+            _receipt_ids_in_flight.pop(claimed_transaction_id, None)
         
-        # Clean up temporary file
+        # Don't delete the temp file while the background upload may still be reading it
+        if s3_upload_task:
+            await asyncio.gather(s3_upload_task, return_exceptions=True)
+        
+        # Clean up temporary file - the only place it is removed, on every exit path
+        _safe_unlink(temp_path)
+
+# Receipts are processed by a fixed pool of workers draining a bounded queue, so a
+# burst of uploads can't pile up unbounded Gemini/S3/DB work; when the queue is
+# full the user is asked to resend instead.
+RECEIPT_WORKERS = 8
+RECEIPT_QUEUE_SIZE = 200
+RECEIPT_QUEUE_FULL_MSG = (
+    "⏳ النظام مشغول حالياً، يرجى إعادة إرسال الإيصال بعد قليل.\n\n"
+    "⏳ The system is busy right now, please resend your receipt in a moment."
+)
+_receipt_queue: Optional[asyncio.Queue] = None
+_receipt_workers: List[asyncio.Task] = []
+
+
+async def _receipt_worker():
+    """Process queued receipts one at a time until cancelled"""
+    while True:
+        update, context, *args = await _receipt_queue.get()
         try:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-                logger.info(f"Cleaned up temp file: {temp_path}")
-        except Exception as cleanup_error:
-            logger.warning(f"Failed to clean up temp file {temp_path}: {cleanup_error}")
+            await _process_receipt_async(update, context, *args)
+        except Exception as e:
+            # Same route as the application's own tasks: to the error handler
+            await context.application.process_error(update, e)
+        finally:
+            _receipt_queue.task_done()
+
+
+async def start_receipt_workers(application):
+    """Create the receipt queue and its workers (post_init)"""
+    global _receipt_queue
+    _receipt_queue = asyncio.Queue(maxsize=RECEIPT_QUEUE_SIZE)
+    _receipt_workers[:] = [
+        asyncio.create_task(_receipt_worker(), name=f"receipt-worker-{i}")
+        for i in range(RECEIPT_WORKERS)
+    ]
+    logger.info("Started %s receipt workers (queue size %s)", RECEIPT_WORKERS, RECEIPT_QUEUE_SIZE)
+
+
+async def stop_receipt_workers(application):
+    """Finish the receipts already accepted, then stop the workers (post_stop)"""
+    if _receipt_queue is None:
+        return
+    await _receipt_queue.join()
+    for worker in _receipt_workers:
+        worker.cancel()
+    await asyncio.gather(*_receipt_workers, return_exceptions=True)
+    _receipt_workers.clear()
+    logger.info("Receipt workers stopped")
+
 
 async def receipt_upload_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle receipt image/document uploads with comprehensive fraud detection and S3 storage"""
@@ -1402,21 +1402,12 @@ async def receipt_upload_message_handler(update: Update, context: ContextTypes.D
     
     user = update.effective_user
     telegram_user_id = user.id
-    logger.info(f"Receipt upload started for user {telegram_user_id}")
+    logger.info("Receipt upload started for user %s", telegram_user_id)
     
     # GET INTERNAL USER ID FIRST
-    with get_db() as session:
-        db_user = crud.get_or_create_user(
-            session,
-            telegram_user_id=telegram_user_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
-        session.flush()
-        internal_user_id = db_user.user_id
+    internal_user_id = resolve_internal_user_id(user)
     
-    logger.info(f"User {telegram_user_id} has internal ID: {internal_user_id}")
+    logger.info("User %s has internal ID: %s", telegram_user_id, internal_user_id)
     
     # Validate file type
     if update.message.document:
@@ -1424,26 +1415,30 @@ async def receipt_upload_message_handler(update: Update, context: ContextTypes.D
     elif update.message.photo:
         file = update.message.photo[-1]
     else:
-        logger.warning(f"User {telegram_user_id} sent invalid file type")
+        logger.warning("User %s sent invalid file type", telegram_user_id)
         await update.message.reply_text("❌ Please send a valid image or PDF receipt.", reply_markup=payment_upload_keyboard())
         return
     
     if not validate_receipt_file(file):
-        logger.warning(f"User {telegram_user_id} receipt validation failed")
+        logger.warning("User %s receipt validation failed", telegram_user_id)
         await update.message.reply_text("❌ Please send a valid image or PDF receipt.", reply_markup=payment_upload_keyboard())
         return
     
     # Download file to temporary location first
     file_info = await file.get_file()
     
-    # Create temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-        temp_path = temp_file.name
+    # Create temporary file; download_to_drive reopens the path, so close our fd right away
+    fd, temp_path = tempfile.mkstemp(suffix='.jpg')
+    os.close(fd)
     
     # Download to temp path
-    await file_info.download_to_drive(temp_path)
+    try:
+        await file_info.download_to_drive(temp_path)
+    except Exception:
+        _safe_unlink(temp_path)
+        raise
     
-    logger.info(f"Receipt downloaded to temp path for user {telegram_user_id}: {temp_path}")
+    logger.info("Receipt downloaded to temp path for user %s: %s", telegram_user_id, temp_path)
     log_user_action(telegram_user_id, "receipt_uploaded", f"temp_path={temp_path}")
 
     # Notify user that processing started
@@ -1454,13 +1449,17 @@ async def receipt_upload_message_handler(update: Update, context: ContextTypes.D
     if certificate_enrollment_id:
         expected_amount = context.user_data.get("expected_amount_for_gemini")
         if expected_amount is None:
-            logger.error(f"User {telegram_user_id} missing expected amount for certificate.")
+            logger.error("User %s missing expected amount for certificate.", telegram_user_id)
             await update.message.reply_text(error_message("payment_amount_missing"), reply_markup=back_to_main_keyboard())
+            _safe_unlink(temp_path)
             return
         
         try:
-            # 1. Gemini Validation
-            gemini_result = await validate_receipt_with_gemini_ai(temp_path, expected_amount, config.EXPECTED_ACCOUNTS)
+            # 1. Gemini Validation (receipt read once; the bytes also seed the S3 receipt cache)
+            image_bytes = await asyncio.to_thread(_read_file_bytes, temp_path)
+            gemini_result = await validate_receipt_with_gemini_ai(
+                temp_path, expected_amount, config.EXPECTED_ACCOUNTS, image_bytes=image_bytes
+            )
             transaction_id = gemini_result.get('transaction_id')
             extracted_amount = gemini_result.get('amount')
 
@@ -1470,9 +1469,14 @@ async def receipt_upload_message_handler(update: Update, context: ContextTypes.D
             if not gemini_result.get("is_valid") or duplicate_check.get('is_duplicate'):
                 reason = "Duplicate transaction ID found." if duplicate_check.get('is_duplicate') else gemini_result.get("reason", "Validation failed.")
                 await update.message.reply_text(f"❌ **فشل التحقق من إيصال الشهادة**\n\nالسبب: {reason}\n\nيرجى المحاولة مرة أخرى.", reply_markup=back_to_main_keyboard())
-                logger.warning(f"Certificate upgrade FAILED for user {telegram_user_id}, reason: {reason}")
+                logger.warning("Certificate upgrade FAILED for user %s, reason: %s", telegram_user_id, reason)
                 return
 
+            # Store the receipt before opening the session, so no DB connection
+            # is held for the duration of the S3 upload
+            file_path = await asyncio.to_thread(upload_receipt_to_s3, temp_path, internal_user_id, certificate_enrollment_id, image_bytes)
+            cache_receipt_bytes(file_path, image_bytes)
+
             # 3. Create Transaction Record & 4. Update Enrollment
             course_name_for_message = "Unknown Course"
             with get_db() as session:
@@ -1483,17 +1487,16 @@ async def receipt_upload_message_handler(update: Update, context: ContextTypes.D
                 
                 if enrollment.course:
                     course_name_for_message = enrollment.course.course_name
-
-                file_path = upload_receipt_to_s3(temp_path, internal_user_id, certificate_enrollment_id)
                 
-                transaction = crud.create_transaction(session, enrollment.enrollment_id, file_path)
-                crud.update_transaction(
+                # Approved transaction written in its final state - one INSERT
+                crud.create_transaction(
                     session,
-                    transaction.transaction_id,
+                    enrollment.enrollment_id,
+                    file_path,
                     status=TransactionStatus.APPROVED,
                     extracted_amount=extracted_amount,
                     receipt_transaction_id=transaction_id,
-                    gemini_response=str(gemini_result)
+                    gemini_response=json.dumps(gemini_result, default=str, ensure_ascii=False)
                 )
                 
                 enrollment.with_certificate = True
@@ -1501,36 +1504,36 @@ async def receipt_upload_message_handler(update: Update, context: ContextTypes.D
                 enrollment.payment_amount = (enrollment.payment_amount or 0) + (enrollment.course.certificate_price or 0)
                 
                 session.commit()
-                logger.info(f"Certificate upgrade SUCCESS for user {telegram_user_id}, enrollment {certificate_enrollment_id}")
+                logger.info("Certificate upgrade SUCCESS for user %s, enrollment %s", telegram_user_id, certificate_enrollment_id)
 
             success_message = f"✅ **تم تسجيل الشهادة بنجاح!**\n\nلقد تم تحديث تسجيلك في دورة '{course_name_for_message}' ليشمل الشهادة."
             await update.message.reply_text(success_message, reply_markup=back_to_main_keyboard())
 
         except Exception as e:
-            logger.error(f"Error in certificate upgrade flow for user {telegram_user_id}: {e}", exc_info=True)
+            logger.error("Error in certificate upgrade flow for user %s: %s", telegram_user_id, e, exc_info=True)
             await update.message.reply_text(error_message("processing_error"), reply_markup=back_to_main_keyboard())
         finally:
-            context.user_data.pop('awaiting_receipt_upload', None)
-            context.user_data.pop('certificate_upgrade_enrollment_id', None)
-            context.user_data.pop('expected_amount_for_gemini', None)
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            user_data = context.user_data
+            for key in CERTIFICATE_UPGRADE_STATE_KEYS:
+                user_data.pop(key, None)
+            _safe_unlink(temp_path)
         return # End of certificate flow
 
     # --- REGULAR PAYMENT FLOW (UNCHANGED) ---
     expected_amount_for_gemini = context.user_data.get("reupload_amount") or context.user_data.get("current_payment_total")
 
     if expected_amount_for_gemini is None:
-        logger.error(f"User {telegram_user_id} missing expected payment amount")
+        logger.error("User %s missing expected payment amount", telegram_user_id)
         await update.message.reply_text(error_message("payment_amount_missing"), reply_markup=back_to_main_keyboard())
         log_user_action(telegram_user_id, "receipt_upload_failed", "expected_amount_for_gemini missing")
         context.user_data["awaiting_receipt_upload"] = False
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        _safe_unlink(temp_path)
         return
 
-    asyncio.create_task(
-        _process_receipt_async(
+    # Hand off to the receipt workers; errors reach the error handler and
+    # shutdown waits for queued receipts (see stop_receipt_workers)
+    try:
+        _receipt_queue.put_nowait((
             update,
             context,
             temp_path,
@@ -1538,9 +1541,13 @@ async def receipt_upload_message_handler(update: Update, context: ContextTypes.D
             internal_user_id,
             expected_amount_for_gemini,
             user
-        )
-    )
-    logger.info(f"Regular receipt processing started as background task for user {telegram_user_id}")
+        ))
+    except asyncio.QueueFull:
+        logger.warning("Receipt queue full, asking user %s to resend", telegram_user_id)
+        _safe_unlink(temp_path)
+        await update.message.reply_text(RECEIPT_QUEUE_FULL_MSG, reply_markup=payment_upload_keyboard())
+        return
+    logger.info("Regular receipt queued for processing for user %s (%s waiting)", telegram_user_id, _receipt_queue.qsize())
 
 
 async def cancel_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1551,30 +1558,26 @@ async def cancel_payment_callback(update: Update, context: ContextTypes.DEFAULT_
     telegram_user_id = query.from_user.id
     
     try:
+        internal_user_id = resolve_internal_user_id(query.from_user)
         with get_db() as session:
-            db_user = crud.get_or_create_user(
-                session,
-                telegram_user_id=telegram_user_id,
-                username=query.from_user.username,
-                first_name=query.from_user.first_name,
-                last_name=query.from_user.last_name
-            )
-            session.flush()
-            internal_user_id = db_user.user_id
-            
-            # Get pending enrollments for this user
-            from database.models import Enrollment
-            pending_enrollments = session.query(Enrollment).filter(
-                Enrollment.user_id == internal_user_id,
-                Enrollment.payment_status == PaymentStatus.PENDING
-            ).all()
-            
-            count = len(pending_enrollments)
-            for enrollment in pending_enrollments:
-                session.delete(enrollment)
+            # Lock this user's pending enrollments; rows a concurrent receipt
+            # verification already holds are skipped rather than deleted under it
+            pending_ids = [
+                enrollment_id for (enrollment_id,) in session.query(Enrollment.enrollment_id).filter(
+                    Enrollment.user_id == internal_user_id,
+                    Enrollment.payment_status == PaymentStatus.PENDING
+                ).with_for_update(skip_locked=True).all()
+            ]
+
+            count = len(pending_ids)
+            if pending_ids:
+                # Transactions/reviews go with them via ON DELETE CASCADE
+                session.query(Enrollment).filter(
+                    Enrollment.enrollment_id.in_(pending_ids)
+                ).delete(synchronize_session=False)
             session.commit()
             
-            logger.info(f"Cancelled {count} pending enrollments for user {telegram_user_id}")
+            logger.info("Cancelled %s pending enrollments for user %s", count, telegram_user_id)
             
         await query.edit_message_text(
             f"🛑 **تم إلغاء الدفع**\n\n"
@@ -1585,14 +1588,10 @@ async def cancel_payment_callback(update: Update, context: ContextTypes.DEFAULT_
         )
         
         # Clear context
-        context.user_data["awaiting_receipt_upload"] = False
-        context.user_data.pop("cart_total_for_payment", None)
-        context.user_data.pop("pending_enrollment_ids_for_payment", None)
-        context.user_data.pop("current_payment_enrollment_ids", None)
-        context.user_data.pop("current_payment_total", None)
+        _reset_payment_state(context.user_data)
         
     except Exception as e:
-        logger.error(f"Cancel payment error for user {telegram_user_id}: {e}")
+        logger.error("Cancel payment error for user %s: %s", telegram_user_id, e)
         await query.edit_message_text(
             "❌ Error cancelling payment. Please contact admin.",
             reply_markup=back_to_main_keyboard()
@@ -82,7 +82,7 @@ async def review_course_select_callback(update: Update, context: ContextTypes.DE
         return ConversationHandler.END
     
     # Extract enrollment_id
-    enrollment_id = int(query.data.split('_')[-1])
+    enrollment_id = int(query.data.rpartition('_')[2])
     context.user_data['review_enrollment_id'] = enrollment_id
     
     # Get course name
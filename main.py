@@ -4,6 +4,8 @@
 from venv import logger
 import os
 import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 import logging
 from telegram import Update
@@ -15,7 +17,8 @@ from telegram.ext import (
     MessageHandler, 
     ChatJoinRequestHandler, 
     ConversationHandler,
-    ContextTypes
+    ContextTypes,
+    AIORateLimiter
 )
 from handlers import (
     menu_handlers,
@@ -280,6 +283,19 @@ def ensure_admin_users():
                 session.rollback()
 
 
+async def configure_default_executor(application: Application):
+    """Size the loop's default executor used by asyncio.to_thread (Gemini, S3, fraud checks)"""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=32, thread_name_prefix="bot-io")
+    )
+
+
+async def on_startup(application: Application):
+    """post_init: thread pool for blocking calls, then the receipt workers"""
+    await configure_default_executor(application)
+    await payment_handlers.start_receipt_workers(application)
+
+
 def main():
     """Main bot application"""
     logger.info("Starting Course Registration Bot...")
@@ -296,7 +312,18 @@ def main():
     logger.info("Admin configuration complete!")
     
     # Create application
-    application = Application.builder().token(config.BOT_TOKEN).build()
+    # HTTP/2 lets concurrent sends (admin alerts + user replies) share one connection.
+    # The rate limiter keeps bursts of receipt alerts to the admin group under Telegram's
+    # per-chat flood limits and retries (after the requested wait) on RetryAfter.
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .http_version("2")
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .post_init(on_startup)
+        .post_stop(payment_handlers.stop_receipt_workers)
+        .build()
+    )
     
     # ==========================
     # COMMAND HANDLERS
@@ -543,7 +570,7 @@ def main():
     ))
     application.add_handler(CallbackQueryHandler(
         menu_handlers.my_course_select_deselect_callback, 
-        pattern=r'^my_course_(select|deselect)_'
+        pattern=r'^my_course_(select|deselect)_(\d+)$'
     ))
     application.add_handler(CallbackQueryHandler(
         menu_handlers.proceed_to_pay_selected_pending_callback, 
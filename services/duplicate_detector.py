@@ -8,8 +8,7 @@ import logging
 from database import get_db, crud
 import imagehash
 from PIL import Image
-import os
-import tempfile
+import io
 
 logger = logging.getLogger(__name__)
 
@@ -18,18 +17,13 @@ def compute_multi_hash(image_path: str) -> Dict[str, str]:
     Compute multiple perceptual hashes for better duplicate detection
     Returns dict with different hash types
     """
-    temp_file = None
     try:
-        # If S3 URL, download first
+        # Load image with PIL for imagehash library (S3 URLs are read straight into memory)
         if image_path.startswith('http'):
-            from utils.s3_storage import download_receipt_from_s3
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp:
-                temp_file = tmp.name
-            download_receipt_from_s3(image_path, temp_file)
-            image_path = temp_file
-
-        # Load image with PIL for imagehash library
-        img_pil = Image.open(image_path)
+            from utils.s3_storage import download_receipt_bytes_from_s3
+            img_pil = Image.open(io.BytesIO(download_receipt_bytes_from_s3(image_path)))
+        else:
+            img_pil = Image.open(image_path)
         
         # Compute multiple hash types (more resistant to edits)
         hashes = {
@@ -42,38 +36,21 @@ def compute_multi_hash(image_path: str) -> Dict[str, str]:
     except Exception as e:
         logger.error(f"Failed to compute hash for {image_path}: {e}")
         return None
-    finally:
-        # Clean up temp file if created
-        if temp_file and os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
 
 
 def compute_file_hash(image_path: str) -> Optional[str]:
     """Compute exact file hash (SHA256) for exact duplicate detection"""
-    temp_file = None
     try:
-        # Download if S3 URL
+        # S3 URLs are read straight into memory
         if image_path.startswith('http'):
-            from utils.s3_storage import download_receipt_from_s3
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp:
-                temp_file = tmp.name
-            download_receipt_from_s3(image_path, temp_file)
-            image_path = temp_file
+            from utils.s3_storage import download_receipt_bytes_from_s3
+            return hashlib.sha256(download_receipt_bytes_from_s3(image_path)).hexdigest()
         
         with open(image_path, 'rb') as f:
             return hashlib.sha256(f.read()).hexdigest()
     except Exception as e:
         logger.error(f"Failed to compute file hash: {e}")
         return None
-    finally:
-        if temp_file and os.path.exists(temp_file):
-            try:
-                os.remove(temp_file)
-            except:
-                pass
 
 
 def calculate_similarity(hash1: Dict[str, str], hash2: Dict[str, str]) -> Tuple[float, str]:
@@ -123,23 +100,71 @@ def calculate_similarity(hash1: Dict[str, str], hash2: Dict[str, str]) -> Tuple[
         return 0.0, 'ERROR'
 
 
-def check_duplicate_submission(user_id: int, image_path: str, similarity_threshold: float = 75.0, previous_receipt_paths: list = None) -> Dict[str, Any]:
+def compute_phash_bytes(image_path: str, image_bytes: bytes = None) -> Optional[bytes]:
+    """Compute a 64-bit perceptual hash packed into 8 bytes (stored in Enrollment.receipt_phash)"""
+    try:
+        with Image.open(io.BytesIO(image_bytes) if image_bytes is not None else image_path) as img_pil:
+            return np.packbits(imagehash.phash(img_pil).hash.flatten()).tobytes()
+    except Exception as e:
+        logger.error(f"Failed to compute pHash for {image_path}: {e}")
+        return None
+
+
+def best_phash_similarity(current_hash: bytes, previous_hashes: List[bytes]) -> float:
+    """
+    Compare one packed pHash against many in a single vectorised pass
+    Returns best similarity percentage (100 = identical)
     """
-    IMAGE DUPLICATE CHECK - DISABLED (Always returns 0 score)
-    Kept for compatibility but returns no fraud risk
+    if not current_hash or not previous_hashes:
+        return 0.0
+    
+    previous = np.frombuffer(b''.join(previous_hashes), dtype=np.uint8).reshape(-1, 8)
+    current = np.frombuffer(current_hash, dtype=np.uint8)
+    
+    # Hamming distance = popcount of XOR
+    distances = np.unpackbits(previous ^ current, axis=1).sum(axis=1)
+    return float((1 - distances.min() / 64) * 100)
+
+
+def check_duplicate_submission(user_id: int, image_path: str, similarity_threshold: float = 75.0, previous_receipt_paths: list = None, previous_hashes: List[bytes] = None, image_bytes: bytes = None) -> Dict[str, Any]:
+    """
+    IMAGE DUPLICATE CHECK - compares stored pHashes only (never adds to fraud score)
+    
+    Without previous_hashes the check stays disabled, as before. With them, the
+    current receipt is hashed once and compared in memory - no S3 downloads.
+    previous_receipt_paths is kept for compatibility and ignored.
     """
     try:
-        logger.info(f"🔍 Image duplicate check: DISABLED (returns 0 score)")
+        if previous_hashes is None:
+            logger.info(f"🔍 Image duplicate check: DISABLED (returns 0 score)")
+            
+            # Return immediately with 0 score
+            return {
+                'is_duplicate': False,
+                'risk_level': 'LOW',
+                'match_type': 'NONE',
+                'similarity_score': 0,
+                'image_similarity_score': 0,
+                'best_similarity': 0,
+                'message': 'Image duplicate check disabled'
+            }
+        
+        image_phash = compute_phash_bytes(image_path, image_bytes)
+        best_similarity = best_phash_similarity(image_phash, previous_hashes)
+        is_duplicate = best_similarity >= similarity_threshold
+        
+        logger.info(f"🔍 Image duplicate check: {len(previous_hashes)} stored hashes, best similarity {best_similarity:.1f}%")
         
-        # Return immediately with 0 score
         return {
-            'is_duplicate': False,
-            'risk_level': 'LOW',
-            'match_type': 'NONE',
-            'similarity_score': 0,
+            'is_duplicate': is_duplicate,
+            'risk_level': 'HIGH' if is_duplicate else 'LOW',
+            'match_type': 'EXACT' if best_similarity >= 95 else ('HIGH' if is_duplicate else 'NONE'),
+            'similarity_percentage': best_similarity,
+            'similarity_score': best_similarity,
             'image_similarity_score': 0,
-            'best_similarity': 0,
-            'message': 'Image duplicate check disabled'
+            'best_similarity': best_similarity,
+            'image_phash': image_phash,
+            'message': 'Matches a previous receipt' if is_duplicate else 'No matching previous receipt'
         }
 
         
@@ -168,19 +193,21 @@ def check_transaction_id_duplicate(transaction_id: str, user_id: int = None) ->
         with get_db() as session:
             from database.models import Transaction, Enrollment, User
             
-            # Search for matching transaction ID
-            existing_transaction = session.query(Transaction).filter(
+            # Matching transaction and its owner in one query (no separate
+            # enrollment lookup / lazy user load)
+            existing_transaction = session.query(
+                Transaction.transaction_id,
+                User.user_id,
+                User.telegram_user_id
+            ).outerjoin(
+                Enrollment, Enrollment.enrollment_id == Transaction.enrollment_id
+            ).outerjoin(
+                User, User.user_id == Enrollment.user_id
+            ).filter(
                 Transaction.receipt_transaction_id == transaction_id
             ).first()
             
             if existing_transaction:
-                # Get enrollment and user info
-                enrollment = session.query(Enrollment).filter(
-                    Enrollment.enrollment_id == existing_transaction.enrollment_id
-                ).first()
-                
-                original_user = enrollment.user if enrollment else None
-                
                 logger.warning(f"🚨 DUPLICATE TRANSACTION ID: {transaction_id}")
                 
                 return {
@@ -189,8 +216,8 @@ def check_transaction_id_duplicate(transaction_id: str, user_id: int = None) ->
                     'risk_level': 'HIGH',
                     'match_type': 'TRANSACTION_ID',
                     'message': f'Transaction ID {transaction_id} already used',
-                    'original_user_id': original_user.user_id if original_user else None,
-                    'original_telegram_id': original_user.telegram_user_id if original_user else None,
+                    'original_user_id': existing_transaction.user_id,
+                    'original_telegram_id': existing_transaction.telegram_user_id,
                     'original_transaction_id': existing_transaction.transaction_id
                 }
             
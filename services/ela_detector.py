@@ -1,30 +1,31 @@
 # services/ela_detector.py
 from PIL import Image, ImageChops, ImageEnhance
+import io
 import numpy as np
 import logging
 from typing import Dict, Any, List
 
 logger = logging.getLogger(__name__)
 
-def perform_ela(image_path: str, quality: int = 90) -> Dict[str, Any]:
+def perform_ela(image_path: str, quality: int = 90, image_bytes: bytes = None) -> Dict[str, Any]:
     """
     Perform Error Level Analysis to detect image tampering with region analysis
     Edited areas will have different compression levels
+    Pass image_bytes to reuse an already-read receipt instead of opening image_path
     """
     try:
         # Open original image
-        original = Image.open(image_path)
+        original = Image.open(io.BytesIO(image_bytes) if image_bytes is not None else image_path)
         
         # Convert to RGB if needed
         if original.mode != 'RGB':
             original = original.convert('RGB')
         
-        # Save at specified quality
-        temp_path = image_path + "_ela_temp.jpg"
-        original.save(temp_path, 'JPEG', quality=quality)
-        
-        # Reopen compressed version
-        compressed = Image.open(temp_path)
+        # Re-compress at specified quality in memory
+        buffer = io.BytesIO()
+        original.save(buffer, 'JPEG', quality=quality)
+        buffer.seek(0)
+        compressed = Image.open(buffer)
         
         # Calculate difference
         ela_image = ImageChops.difference(original, compressed)
@@ -41,11 +42,6 @@ def perform_ela(image_path: str, quality: int = 90) -> Dict[str, Any]:
         # Analyze regions to find suspicious areas
         suspicious_regions = analyze_suspicious_regions(ela_array, original.size)
         
-        # Clean up temp file
-        import os
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        
         # Analyze results
         is_suspicious = False
         risk_score = 0
@@ -4,8 +4,13 @@
 Google Gemini Vision AI service for receipt validation with old receipt detection
 """
 
+import copy
+import hashlib
+import io
 import json
 import os
+import time
+from collections import OrderedDict
 from typing import Dict, Any
 from datetime import datetime, timedelta
 import google.generativeai as genai
@@ -14,7 +19,6 @@ import config
 import asyncio
 import logging
 import threading
-from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -22,10 +26,34 @@ logger = logging.getLogger(__name__)
 genai.configure(api_key=config.GEMINI_API_KEY)
 model = genai.GenerativeModel('gemini-2.5-flash')
 
-GEMINI_THREAD_POOL = ThreadPoolExecutor(
-    max_workers=10,
-    thread_name_prefix="GeminiWorker"
-)
+# Recent validation results by (image content hash, expected amount, accounts), so a
+# re-sent identical receipt (retries, "try again" flows) skips the Gemini call.
+# Short TTL: the prompt embeds today's date for the old-receipt check.
+VALIDATION_CACHE_SIZE = 256
+VALIDATION_CACHE_TTL = 600
+_validation_cache = OrderedDict()
+_validation_cache_lock = threading.Lock()
+
+def _get_cached_validation(key):
+    """Copy of a cached validation result (callers add fields to it), or None"""
+    with _validation_cache_lock:
+        entry = _validation_cache.get(key)
+        if entry is None:
+            return None
+        result, expires_at = entry
+        if expires_at <= time.monotonic():
+            del _validation_cache[key]
+            return None
+        _validation_cache.move_to_end(key)
+    return copy.deepcopy(result)
+
+def _cache_validation(key, result: Dict[str, Any]):
+    """Remember a successfully parsed validation result"""
+    with _validation_cache_lock:
+        _validation_cache[key] = (copy.deepcopy(result), time.monotonic() + VALIDATION_CACHE_TTL)
+        _validation_cache.move_to_end(key)
+        while len(_validation_cache) > VALIDATION_CACHE_SIZE:
+            _validation_cache.popitem(last=False)
 
 # Track active processing per user (optional - for monitoring)
 _active_users = {}
@@ -46,15 +74,16 @@ def _track_user_end(user_id: int):
             logger.info(f"✅ User {user_id} completed Gemini processing on thread {thread_name}")
             logger.info(f"📊 Active users processing: {len(_active_users)}")
 
-def _process_gemini_sync(image_path: str, prompt: str, user_id: int = None) -> str:
+def _process_gemini_sync(image_path: str, prompt: str, user_id: int = None, image_bytes: bytes = None) -> str:
     """
-    Synchronous Gemini processing function that runs in a dedicated thread
+    Synchronous Gemini processing function that runs in a worker thread
     This is the actual blocking I/O operation
     
     Args:
         image_path: Path to receipt image
         prompt: Gemini prompt
         user_id: Optional user ID for tracking
+        image_bytes: Optional already-read image content (skips opening image_path)
     
     Returns:
         Response text from Gemini
@@ -64,7 +93,7 @@ def _process_gemini_sync(image_path: str, prompt: str, user_id: int = None) -> s
             _track_user_start(user_id)
         
         logger.debug(f"🧵 Thread {threading.current_thread().name} processing Gemini request")
-        image = Image.open(image_path)
+        image = Image.open(io.BytesIO(image_bytes) if image_bytes is not None else image_path)
         
         # This is the blocking call that runs in its own thread
         response = model.generate_content([prompt, image])
@@ -165,7 +194,8 @@ async def validate_receipt_with_gemini_ai(
     expected_amount: float,
     expected_accounts: list,
     max_retries: int = 1,
-    user_id: int = None  # ✅ NEW: Optional user_id for tracking
+    user_id: int = None,  # ✅ NEW: Optional user_id for tracking
+    image_bytes: bytes = None
 ) -> Dict[str, Any]:
 
     """
@@ -176,10 +206,21 @@ async def validate_receipt_with_gemini_ai(
         expected_amount: Expected MINIMUM payment amount in SDG
         expected_accounts: List of expected account numbers (supports multiple + masked formats)
         max_retries: Maximum retry attempts
+        image_bytes: Optional already-read image content (skips opening image_path)
     
     Returns:
         Dict with validation results and metadata for duplicate detection
     """
+    # Same image, amount and accounts validated recently - reuse that result
+    cache_key = None
+    if image_bytes is not None:
+        cache_key = (hashlib.sha256(image_bytes).hexdigest(), round(float(expected_amount), 2), tuple(expected_accounts))
+        cached = _get_cached_validation(cache_key)
+        if cached is not None:
+            logger.info(f"♻️ Gemini cache hit for {image_path} (user {user_id or 'unknown'})")
+            return cached
+        logger.info(f"Gemini cache miss for {image_path}")
+    
     # Calculate dates for validation
     current_date = datetime.now()
     current_date_str = current_date.strftime("%Y-%m-%d")
@@ -189,8 +230,6 @@ async def validate_receipt_with_gemini_ai(
         try:
             logger.info(f"Gemini validation attempt {attempt + 1}/{max_retries} for image: {image_path}")
             
-            image = Image.open(image_path)
-            
             # Enhanced prompt with multilingual and old receipt detection
             prompt = f"""
 Analyze this payment receipt and extract information in JSON format:
@@ -310,21 +349,17 @@ Return ONLY the JSON object.
             
             # Generate response
             logger.debug(f"Sending to Gemini: {image_path}")
-            # Run Gemini in a separate thread to avoid blocking the asyncio event loop.
-            # The `run_in_executor` function runs the specified function in a separate
-            # thread, which prevents it from blocking the main asyncio event loop.
-            # This is the recommended way to run blocking I/O operations in an
-            # asyncio application.
+            # Run Gemini in a worker thread to avoid blocking the asyncio event loop.
+            # asyncio.to_thread uses the loop's default executor, shared with the
+            # other blocking offloads (S3, fraud checks) instead of a private pool.
             logger.info(f"🚀 Submitting Gemini task to thread pool for user {user_id or 'unknown'}")
-            loop = asyncio.get_event_loop()
 
-            # Each user gets their own thread from the pool
-            response_text = await loop.run_in_executor(
-                GEMINI_THREAD_POOL,  # ✅ Use dedicated thread pool
+            response_text = await asyncio.to_thread(
                 _process_gemini_sync,  # Function to run
                 image_path,
                 prompt,
-                user_id  # Pass user_id for tracking
+                user_id,  # Pass user_id for tracking
+                image_bytes
             )
 
             logger.info(f"✅ Gemini response received for user {user_id or 'unknown'}")
@@ -427,6 +462,8 @@ Return ONLY the JSON object.
             logger.info(f"✅ Validation complete - Scores: Acc={result['account_match_confidence']}%, Amt={result['amount_match_confidence']}%, Auth={result['authenticity_score']}%")
             logger.info(f"📋 Metadata: TxID={transaction_id}, Sender={final_sender_name}, Date={extracted_date}, DaysOld={days_since_transfer}")
             
+            if cache_key is not None:
+                _cache_validation(cache_key, result)
             return result
             
         except Exception as e:
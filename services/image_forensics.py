@@ -2,19 +2,20 @@
 
 from PIL import Image
 from PIL.ExifTags import TAGS
+import io
 import logging
 from datetime import datetime
 from typing import Dict, Any
 
 logger = logging.getLogger(__name__)
 
-def is_probable_screenshot(image_path: str) -> bool:
+def is_probable_screenshot(image_path: str, image_bytes: bytes = None) -> bool:
     """
     Determine if image is likely a screenshot
     Screenshots are NORMAL and EXPECTED in this application
     """
     try:
-        image = Image.open(image_path)
+        image = Image.open(io.BytesIO(image_bytes) if image_bytes is not None else image_path)
         exif_data = image._getexif()
         
         # No EXIF at all = likely screenshot (NORMAL)
@@ -38,16 +39,16 @@ def is_probable_screenshot(image_path: str) -> bool:
         return True  # Assume screenshot on error (safer)
 
 
-def analyze_image_metadata(image_path: str) -> Dict[str, Any]:
+def analyze_image_metadata(image_path: str, image_bytes: bytes = None) -> Dict[str, Any]:
     """
     Analyze EXIF metadata for signs of tampering
     IMPORTANT: Screenshots are considered NORMAL and NOT flagged as risky
     """
     try:
-        image = Image.open(image_path)
+        image = Image.open(io.BytesIO(image_bytes) if image_bytes is not None else image_path)
         exif_data = image._getexif()
         
-        screenshot_flag = is_probable_screenshot(image_path)
+        screenshot_flag = is_probable_screenshot(image_path, image_bytes)
         
         # If it's a screenshot, that's NORMAL - no risk
         if screenshot_flag:
@@ -2,7 +2,9 @@
 Utility helper functions
 """
 import os
+import time
 import logging
+from collections import OrderedDict
 from typing import Optional
 from datetime import datetime
 from telegram import Update, User as TelegramUser
@@ -50,6 +52,41 @@ def is_admin_user(user_id: int) -> bool:
     return False
 
 
+# telegram_user_id -> (internal user_id, expiry). A user's row id never changes, so
+# hot handlers (receipt uploads, my-courses callbacks) can skip the users lookup;
+# the TTL still lets profile changes (username/name) reach the row now and then.
+INTERNAL_USER_ID_CACHE_SIZE = 50_000
+INTERNAL_USER_ID_CACHE_TTL = 3600
+_internal_user_ids = OrderedDict()
+
+
+def resolve_internal_user_id(tg_user: TelegramUser) -> int:
+    """Internal user_id for a Telegram user, creating/refreshing the row on a cache miss"""
+    cached = _internal_user_ids.get(tg_user.id)
+    if cached and cached[1] > time.monotonic():
+        _internal_user_ids.move_to_end(tg_user.id)
+        return cached[0]
+    
+    from database import crud, get_db
+    
+    with get_db() as session:
+        db_user = crud.get_or_create_user(
+            session,
+            telegram_user_id=tg_user.id,
+            username=tg_user.username,
+            first_name=tg_user.first_name,
+            last_name=tg_user.last_name
+        )
+        session.commit()
+        internal_user_id = db_user.user_id
+    
+    _internal_user_ids[tg_user.id] = (internal_user_id, time.monotonic() + INTERNAL_USER_ID_CACHE_TTL)
+    _internal_user_ids.move_to_end(tg_user.id)
+    while len(_internal_user_ids) > INTERNAL_USER_ID_CACHE_SIZE:
+        _internal_user_ids.popitem(last=False)
+    return internal_user_id
+
+
 def save_receipt_image(file_path: str, user_id: int, timestamp: datetime = None) -> str:
     """Generate unique filename for receipt image"""
     if timestamp is None:
@@ -64,6 +101,14 @@ def format_currency(amount: float) -> str:
     """Format currency amount"""
     return f"${amount:.2f}"
 
+def remaining_balance(enrollments, only_ids=None) -> float:
+    """Total still owed (payment_amount - amount_paid) across enrollments, optionally only those in only_ids"""
+    return sum(
+        e.payment_amount - (e.amount_paid or 0)
+        for e in enrollments
+        if e.payment_amount and (only_ids is None or e.enrollment_id in only_ids)
+    )
+
 def log_user_action(user_id: int, action: str, details: str = ""):
     """Log user actions for debugging"""
     logger.info(f"User {user_id}: {action} {details}")
@@ -2,14 +2,17 @@
 """
 Keyboard layouts and inline markup generators
 """
+from functools import lru_cache
 from typing import List, Optional
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from config import CallbackPrefix
 from database.models import Enrollment # Import Enrollment for type hinting
 
+@lru_cache(maxsize=None)
 def main_menu_reply_keyboard() -> ReplyKeyboardMarkup:
     """
     Creates the persistent Reply Keyboard for the main menu.
+    Static keyboards like this one are built once and shared (PTB markups are immutable).
     """
     keyboard = [
         [KeyboardButton("1- الدورات المتاحة 📚")],
@@ -19,6 +22,7 @@ def main_menu_reply_keyboard() -> ReplyKeyboardMarkup:
     ]
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+@lru_cache(maxsize=None)
 def courses_menu_keyboard() -> InlineKeyboardMarkup:
     """Courses submenu keyboard (remains Inline)"""
     keyboard = [
@@ -127,6 +131,7 @@ def course_detail_keyboard(course_id: int) -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def cart_confirmation_keyboard() -> InlineKeyboardMarkup:
     """Keyboard for cart confirmation before payment"""
     keyboard = [
@@ -139,6 +144,7 @@ def cart_confirmation_keyboard() -> InlineKeyboardMarkup:
 def my_courses_selection_keyboard(all_enrollments: List[Enrollment], selected_ids: List[int]) -> InlineKeyboardMarkup:
     """New keyboard that shows ALL enrollments as clickable buttons."""
     keyboard = []
+    selected = set(selected_ids)  # one hash lookup per row instead of a list scan
 
     # Sort enrollments to show verified first, then pending, then failed
     all_enrollments.sort(key=lambda e: (e.payment_status.value != 'VERIFIED', e.payment_status.value != 'PENDING'))
@@ -154,7 +160,7 @@ def my_courses_selection_keyboard(all_enrollments: List[Enrollment], selected_id
         
         else: # PENDING or FAILED
             # These are selectable for payment
-            is_selected = enrollment.enrollment_id in selected_ids
+            is_selected = enrollment.enrollment_id in selected
             icon = "✅" if is_selected else ("⏳" if enrollment.payment_status.value == 'PENDING' else "❌")
             
             total_price = enrollment.payment_amount or 0.0
@@ -183,6 +189,7 @@ def my_courses_selection_keyboard(all_enrollments: List[Enrollment], selected_id
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=None)
 def payment_upload_keyboard() -> InlineKeyboardMarkup:
     """Keyboard during receipt upload process"""
     keyboard = [
@@ -190,6 +197,7 @@ def payment_upload_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=None)
 def back_to_main_keyboard() -> InlineKeyboardMarkup:
     """Simple back to main menu keyboard"""
     keyboard = [
@@ -198,6 +206,7 @@ def back_to_main_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 # Admin keyboards remain in English for clarity
+@lru_cache(maxsize=None)
 def admin_menu_keyboard():
     """Admin dashboard keyboard"""
     keyboard = [
@@ -221,6 +230,7 @@ def admin_transaction_keyboard(transaction_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=None)
 def cart_keyboard() -> InlineKeyboardMarkup:
     """Keyboard for viewing and managing cart"""
     keyboard = [
@@ -231,9 +241,12 @@ def cart_keyboard() -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@lru_cache(maxsize=256)
 def failed_receipt_admin_keyboard(enrollment_ids_str: str, telegram_user_id: int) -> InlineKeyboardMarkup:
     """
     Keyboard for admin to approve/reject a failed receipt immediately
+    Cached per (enrollment_ids_str, telegram_user_id): PTB markups are immutable,
+    so repeat alerts for the same cart share one instance
     Args:
         enrollment_ids_str: Comma-separated enrollment IDs
         telegram_user_id: User's Telegram ID for reference
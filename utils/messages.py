@@ -271,8 +271,10 @@ def my_courses_message(enrollments: list, pending_count: int = 0, selected_count
     if not enrollments:
         return "📋 لا توجد دورات مسجلة\n\nسجل في الدورات من القائمة الرئيسية."
 
-    message = "📋 **دوراتي المسجلة:**\n\n"
-    message += "اضغط على أي دورة لعرض التفاصيل أو إكمال الدفع.\n\n"
+    parts = [
+        "📋 **دوراتي المسجلة:**\n\n"
+        "اضغط على أي دورة لعرض التفاصيل أو إكمال الدفع.\n\n"
+    ]
 
     # Sort enrollments to show verified first, then pending, then failed
     enrollments.sort(key=lambda e: (e.payment_status.value != 'VERIFIED', e.payment_status.value != 'PENDING'))
@@ -287,17 +289,21 @@ def my_courses_message(enrollments: list, pending_count: int = 0, selected_count
         else:
             status_icon = "❓"
         
-        message += f"{status_icon} {e.course.course_name}\n"
+        parts.append(f"{status_icon} {e.course.course_name}\n")
 
     if pending_count > 0:
-        message += "━━━━━━━━━━━━━━━━━━━━\n"
-        message += f"📝 **لديك {pending_count} تسجيلات معلقة.**\n"
-        message += "يمكنك تحديدها من الأزرار أدناه لإكمال الدفع.\n"
+        parts.append(
+            "━━━━━━━━━━━━━━━━━━━━\n"
+            f"📝 **لديك {pending_count} تسجيلات معلقة.**\n"
+            "يمكنك تحديدها من الأزرار أدناه لإكمال الدفع.\n"
+        )
         if selected_count > 0:
-            message += f"\n✓ المحدد للدفع: {selected_count}\n"
-            message += f"💰 المبلغ الإجمالي: **{total_selected:.0f} جنيه**\n"
+            parts.append(
+                f"\n✓ المحدد للدفع: {selected_count}\n"
+                f"💰 المبلغ الإجمالي: **{total_selected:.0f} جنيه**\n"
+            )
     
-    return message
+    return "".join(parts)
 
 
 def admin_stats_message(stats: dict) -> str:
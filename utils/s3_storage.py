@@ -2,16 +2,43 @@
 AWS S3 Storage Helper
 """
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import config
 import logging
 from datetime import datetime
+from collections import OrderedDict
 import os
+import threading
 
 logger = logging.getLogger(__name__)
 
 # Don't initialize at import time - do it lazily
 _s3_client = None
+_s3_client_lock = threading.Lock()
+
+# Uploads/downloads run from worker threads concurrently; keep enough pooled
+# keep-alive connections for them to reuse TCP/TLS instead of reconnecting
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=32,
+    retries={'max_attempts': 3, 'mode': 'standard'},
+    tcp_keepalive=True
+)
+
+# Small LRU of receipt contents by S3 URL. Receipt keys are timestamped and never
+# overwritten, so cached bytes can't go stale and need no ETag revalidation.
+RECEIPT_CACHE_SIZE = 32
+_receipt_cache = OrderedDict()
+_receipt_cache_lock = threading.Lock()
+
+# Telegram file_id of each receipt already sent to the admin chat, by S3 URL, so
+# repeat sends (e.g. the original of several duplicate attempts) skip the upload
+RECEIPT_FILE_ID_CACHE_SIZE = 256
+_receipt_file_ids = OrderedDict()
+
+# Lifetime of the pre-signed receipt URLs handed to Telegram; it fetches them
+# right away, so this only needs to cover the send itself
+RECEIPT_PRESIGNED_URL_TTL = 3600
 
 def get_s3_client():
     """Get or create S3 client (lazy initialization)"""
@@ -23,24 +50,29 @@ def get_s3_client():
             logger.warning("AWS credentials not configured - S3 storage disabled")
             return None
         
-        try:
-            _s3_client = boto3.client(
-                's3',
-                aws_access_key_id=config.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
-                region_name=config.AWS_S3_REGION
-            )
-            logger.info("✅ S3 client initialized successfully")
-        except Exception as e:
-            logger.error(f"❌ Failed to initialize S3 client: {e}")
-            return None
+        # Worker threads can get here together; only one should build the client
+        with _s3_client_lock:
+            if _s3_client is None:
+                try:
+                    _s3_client = boto3.client(
+                        's3',
+                        aws_access_key_id=config.AWS_ACCESS_KEY_ID,
+                        aws_secret_access_key=config.AWS_SECRET_ACCESS_KEY,
+                        region_name=config.AWS_S3_REGION,
+                        config=S3_CLIENT_CONFIG
+                    )
+                    logger.info("✅ S3 client initialized successfully")
+                except Exception as e:
+                    logger.error(f"❌ Failed to initialize S3 client: {e}")
+                    return None
     
     return _s3_client
 
 
-def upload_receipt_to_s3(file_path: str, user_id: int, enrollment_id: int) -> str:
+def upload_receipt_to_s3(file_path: str, user_id: int, enrollment_id: int, content: bytes = None) -> str:
     """
     Upload receipt image to S3
+    content: already-read file content - uploaded from memory instead of re-reading file_path
     Returns: S3 URL of uploaded file
     """
     s3_client = get_s3_client()
@@ -56,12 +88,20 @@ def upload_receipt_to_s3(file_path: str, user_id: int, enrollment_id: int) -> st
         s3_key = f"receipts/{user_id}/{enrollment_id}_{timestamp}{file_extension}"
         
         # Upload to S3
-        s3_client.upload_file(
-            file_path,
-            config.AWS_S3_BUCKET_NAME,
-            s3_key,
-            ExtraArgs={'ContentType': 'image/jpeg'}
-        )
+        if content is not None:
+            s3_client.put_object(
+                Bucket=config.AWS_S3_BUCKET_NAME,
+                Key=s3_key,
+                Body=content,
+                ContentType='image/jpeg'
+            )
+        else:
+            s3_client.upload_file(
+                file_path,
+                config.AWS_S3_BUCKET_NAME,
+                s3_key,
+                ExtraArgs={'ContentType': 'image/jpeg'}
+            )
         
         # Generate URL
         s3_url = f"https://{config.AWS_S3_BUCKET_NAME}.s3.{config.AWS_S3_REGION}.amazonaws.com/{s3_key}"
@@ -114,6 +154,104 @@ def download_receipt_from_s3(s3_url: str, local_path: str) -> str:
         raise
 
 
+def cache_receipt_bytes(s3_url: str, content: bytes):
+    """Remember receipt content for an S3 URL (e.g. right after uploading it)"""
+    with _receipt_cache_lock:
+        _receipt_cache[s3_url] = content
+        _receipt_cache.move_to_end(s3_url)
+        while len(_receipt_cache) > RECEIPT_CACHE_SIZE:
+            _receipt_cache.popitem(last=False)
+
+
+def get_receipt_file_id(s3_url: str):
+    """Telegram file_id of a receipt sent before, or None"""
+    with _receipt_cache_lock:
+        file_id = _receipt_file_ids.get(s3_url)
+        if file_id is not None:
+            _receipt_file_ids.move_to_end(s3_url)
+        return file_id
+
+
+def remember_receipt_file_id(s3_url: str, file_id: str):
+    """Remember the Telegram file_id a receipt got when it was sent"""
+    with _receipt_cache_lock:
+        _receipt_file_ids[s3_url] = file_id
+        _receipt_file_ids.move_to_end(s3_url)
+        while len(_receipt_file_ids) > RECEIPT_FILE_ID_CACHE_SIZE:
+            _receipt_file_ids.popitem(last=False)
+
+
+def forget_receipt_file_id(s3_url: str):
+    """Drop a file_id Telegram no longer accepts"""
+    with _receipt_cache_lock:
+        _receipt_file_ids.pop(s3_url, None)
+
+
+def download_receipt_bytes_from_s3(s3_url: str) -> bytes:
+    """
+    Download receipt from S3 straight into memory (no temp file)
+    Served from the receipt cache when this URL was uploaded or fetched recently
+    Returns: File content
+    """
+    with _receipt_cache_lock:
+        cached = _receipt_cache.get(s3_url)
+        if cached is not None:
+            _receipt_cache.move_to_end(s3_url)
+            return cached
+    
+    s3_client = get_s3_client()
+    
+    if not s3_client:
+        logger.warning("S3 not configured - cannot download")
+        raise Exception("S3 storage not configured")
+    
+    try:
+        # Format: https://bucket.s3.region.amazonaws.com/key
+        if '.amazonaws.com/' not in s3_url:
+            raise ValueError(f"Invalid S3 URL format: {s3_url}")
+        
+        s3_key = s3_url.split('.amazonaws.com/')[1]
+        
+        response = s3_client.get_object(Bucket=config.AWS_S3_BUCKET_NAME, Key=s3_key)
+        content = response['Body'].read()
+        cache_receipt_bytes(s3_url, content)
+        
+        logger.info(f"✅ Downloaded receipt from S3 into memory: {s3_key}")
+        return content
+        
+    except ClientError as e:
+        logger.error(f"❌ Failed to download from S3: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"❌ Unexpected error downloading from S3: {e}")
+        raise
+
+
+def get_receipt_presigned_url(s3_url: str, expires_in: int = RECEIPT_PRESIGNED_URL_TTL) -> str:
+    """
+    Time-limited GET URL for a receipt, so Telegram can fetch it from S3 itself
+    Signed locally - no request to S3
+    Returns: Pre-signed URL
+    """
+    s3_client = get_s3_client()
+    
+    if not s3_client:
+        logger.warning("S3 not configured - cannot sign URL")
+        raise Exception("S3 storage not configured")
+    
+    # Format: https://bucket.s3.region.amazonaws.com/key
+    if '.amazonaws.com/' not in s3_url:
+        raise ValueError(f"Invalid S3 URL format: {s3_url}")
+    
+    s3_key = s3_url.split('.amazonaws.com/')[1]
+    
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': config.AWS_S3_BUCKET_NAME, 'Key': s3_key},
+        ExpiresIn=expires_in
+    )
+
+
 def delete_receipt_from_s3(s3_url: str):
     """Delete receipt from S3"""
     s3_client = get_s3_client()